@@ -0,0 +1,119 @@
+import re
+import time
+import threading
+
+import metrics
+
+# Largest burst, in seconds of the configured rate, a flow can send after being idle
+BURST_SECONDS = 0.25
+
+_RATE_RE = re.compile(r"^(\d+(?:\.\d+)?)\s*([kmg]?i?b?)(?:/s|ps)?$")
+_RATE_UNITS = {'': 1, 'b': 1, 'k': 1024, 'kb': 1024, 'kib': 1024, 'm': 1024 ** 2, 'mb': 1024 ** 2, 'mib': 1024 ** 2, 'g': 1024 ** 3, 'gb': 1024 ** 3, 'gib': 1024 ** 3}
+
+
+def parse_bandwidth(spec):
+    # "0" or a blank value (e.g. "max_bandwidth =" in the config) means unlimited; otherwise bytes
+    # per second with an optional unit, e.g. "500KB" or "2MB/s"
+    if spec is None or (isinstance(spec, str) and not spec.strip()):
+        return 0
+    if isinstance(spec, (int, float)):
+        rate = spec
+    else:
+        match = _RATE_RE.match(str(spec).strip().lower())
+        if not match or match.group(2) not in _RATE_UNITS:
+            raise ValueError(f"Invalid bandwidth limit '{spec}'. Use bytes per second, e.g. 500KB or 2MB")
+        rate = float(match.group(1)) * _RATE_UNITS[match.group(2)]
+    if rate < 0:
+        raise ValueError(f"Invalid bandwidth limit '{spec}'")
+    return int(rate)
+
+
+def format_bandwidth(rate):
+    if not rate:
+        return "unlimited"
+    for unit, size in (('GB/s', 1024 ** 3), ('MB/s', 1024 ** 2), ('KB/s', 1024)):
+        if rate >= size:
+            return f"{rate / size:.1f} {unit}"
+    return f"{rate} B/s"
+
+
+class BandwidthLimiter:
+    # Process-wide token bucket shared by every download. When transfers have to wait, the
+    # job that has received the least bytes goes first, then the least-served host within
+    # that job, so one large job or one fast CDN cannot starve the others.
+    def __init__(self, bytes_per_second=0):
+        self.rate = bytes_per_second
+        self._tokens = 0.0
+        self._last_refill = time.monotonic()
+        self._cond = threading.Condition()
+        self._served = {}
+        self._waiters = []
+        self._seq = 0
+
+    def set_rate(self, bytes_per_second):
+        # Takes effect immediately, including for transfers that are already waiting
+        with self._cond:
+            self.rate = max(0, int(bytes_per_second or 0))
+            self._tokens = min(self._tokens, self._capacity())
+            self._cond.notify_all()
+        metrics.set_value('bandwidth_limit', self.rate)
+
+    def _capacity(self):
+        return self.rate * BURST_SECONDS
+
+    def _refill(self, now):
+        self._tokens = min(self._capacity(), self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def _priority(self, waiter):
+        job, host, seq, _ = waiter
+        return (self._served.get(job, 0), self._served.get((job, host), 0), seq)
+
+    def _join(self, key, peers):
+        # A flow that (re)joins starts level with the least-served waiting peer instead of at zero
+        floor = min((self._served.get(peer, 0) for peer in peers), default=0)
+        self._served[key] = max(self._served.get(key, 0), floor)
+
+    def acquire(self, num_bytes, job=None, host=None):
+        if not self.rate or num_bytes <= 0:
+            return
+        started = time.monotonic()
+        with self._cond:
+            waiting_jobs = {w[0] for w in self._waiters}
+            if job not in waiting_jobs:
+                self._join(job, waiting_jobs)
+            job_flows = {(w[0], w[1]) for w in self._waiters if w[0] == job}
+            if (job, host) not in job_flows:
+                self._join((job, host), job_flows)
+            self._seq += 1
+            waiter = (job, host, self._seq, num_bytes)
+            self._waiters.append(waiter)
+            try:
+                while self.rate:
+                    now = time.monotonic()
+                    self._refill(now)
+                    head = min(self._waiters, key=self._priority)
+                    if head is waiter and self._tokens > 0:
+                        # Tokens may go negative; the debt delays the next transfer instead of splitting chunks
+                        self._tokens -= num_bytes
+                        break
+                    timeout = -self._tokens / self.rate if self._tokens <= 0 else None
+                    self._cond.wait(timeout=max(timeout, 0.001) if timeout is not None else 0.05)
+            finally:
+                self._waiters.remove(waiter)
+                self._served[job] = self._served.get(job, 0) + num_bytes
+                self._served[(job, host)] = self._served.get((job, host), 0) + num_bytes
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        metrics.increment('bandwidth_bytes', num_bytes)
+        if waited > 0.001:
+            metrics.increment('bandwidth_wait_seconds', waited)
+
+    def forget(self, job):
+        # Drops the fairness counters of a finished job
+        with self._cond:
+            for key in [k for k in self._served if k == job or (isinstance(k, tuple) and k[0] == job)]:
+                del self._served[key]
+
+
+limiter = BandwidthLimiter()
@@ -3,7 +3,11 @@ import os
 import logging
 import gzip
 import shutil
-from urllib.parse import urljoin
+import time
+import threading
+from urllib.parse import urljoin, urlparse
+
+import bandwidth
 
 # Ensure logging is always configured to use a log file in the script's directory
 def _get_log_dir():
@@ -40,97 +44,264 @@ def _setup_logging():
 
 _setup_logging()
 
+# Sites rate posts on different scales, so ratings are stored by name. Danbooru's 's' is
+# "sensitive" (general/sensitive/questionable/explicit); on the gelbooru-style sites it is
+# "safe" (safe/questionable/explicit), which covers both general and sensitive posts.
+DANBOORU_RATINGS = {'g': 'general', 's': 'sensitive', 'q': 'questionable', 'e': 'explicit'}
+GELBOORU_RATINGS = {'s': 'safe', 'q': 'questionable', 'e': 'explicit'}
+
 BOORU_APIS = {
     'rule34': {
         'url': "https://api.rule34.xxx/index.php?page=dapi&s=post&q=index",
-        'params': lambda tags, limit: {'tags': tags, 'limit': limit, 'json': 1},
+        'params': lambda tags, limit, page=0: {'tags': tags, 'limit': limit, 'pid': page, 'json': 1},
         'headers': {'Accept': 'application/json'},
-        'process': lambda data: data
+        'process': lambda data: data,
+        'max_page_size': 1000,  # Largest 'limit' the API honours; bigger requests are cut to this
+        'ratings': GELBOORU_RATINGS  # What a one-letter rating means on this site
     },
     'safebooru': {
         'url': "https://safebooru.org/index.php?page=dapi&s=post&q=index",
-        'params': lambda tags, limit: {'tags': tags, 'limit': limit, 'json': 1},
+        'params': lambda tags, limit, page=0: {'tags': tags, 'limit': limit, 'pid': page, 'json': 1},
         'headers': {'Accept': 'application/json'},
-        'process': lambda data: data
+        'process': lambda data: data,
+        'max_page_size': 1000,
+        'ratings': GELBOORU_RATINGS
     },
     'danbooru': {
         'url': "https://danbooru.donmai.us/posts.json",
-        'params': lambda tags, limit: {'tags': tags or '', 'limit': limit},
+        'params': lambda tags, limit, page=0: {'tags': tags or '', 'limit': limit, 'page': page + 1},  # Danbooru pages start at 1
         'headers': {'Accept': 'application/json'},
-        'process': lambda data: data  # Danbooru returns a list of posts
+        'process': lambda data: data,  # Danbooru returns a list of posts
+        'requests_per_second': 10,  # Global read limit for all users
+        'max_page_size': 200,
+        'ratings': DANBOORU_RATINGS
     },
     # Add more booru types here
 }
 
-def fetch_booru_posts(booru_type, tags=None, limit=10):
+# Page size for sites without a 'max_page_size' entry
+DEFAULT_MAX_PAGE_SIZE = 100
+
+def get_max_page_size(booru_type):
+    # Largest number of posts the site returns for one request
+    return BOORU_APIS.get(booru_type, {}).get('max_page_size', DEFAULT_MAX_PAGE_SIZE)
+
+# One pooled session per process so API and CDN connections are reused across posts and jobs
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    global _session
+    with _session_lock:
+        if _session is None:
+            # The adapter is live HTTP, or records to / replays from a cassette; see transport.py
+            from transport import create_adapter
+            session = requests.Session()
+            adapter = create_adapter(pool_connections=16, pool_maxsize=64)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session = session
+        return _session
+
+def reset_session():
+    # The next request builds a new session, e.g. after the transport mode changed
+    global _session
+    with _session_lock:
+        if _session is not None:
+            _session.close()
+        _session = None
+
+class RateLimiter:
+    # Spaces out requests per key; state is kept for the life of the process
+    def __init__(self):
+        self._next_slot = {}
+        self._lock = threading.Lock()
+
+    def wait(self, key, requests_per_second):
+        if not requests_per_second:
+            return
+        interval = 1.0 / requests_per_second
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot.get(key, now))
+            self._next_slot[key] = slot + interval
+        if slot > now:
+            time.sleep(slot - now)
+
+api_rate_limiter = RateLimiter()
+
+def fetch_booru_posts(booru_type, tags=None, limit=10, page=0):
+    # Raises requests.RequestException or ValueError (bad JSON), so a failed request is never
+    # mistaken for an empty page
     api = BOORU_APIS.get(booru_type)
     if not api:
         logging.getLogger("booru_api").error(f"[booru_api.fetch_booru_posts] Unsupported booru type: {booru_type}")
         return []
     url = api['url']
-    params = api['params'](tags, limit)
+    params = api['params'](tags, limit, page)
     headers = api.get('headers', {})
+    api_rate_limiter.wait(booru_type, api.get('requests_per_second'))
     try:
-        response = requests.get(url, params=params, headers=headers, timeout=10)
+        response = get_session().get(url, params=params, headers=headers, timeout=10)
         response.raise_for_status()
     except requests.RequestException as e:
         logging.getLogger("booru_api").error(f"[booru_api.fetch_booru_posts] Error fetching data from {booru_type} API: {e}\nURL: {url}\nParams: {params}")
-        return []
+        raise
     try:
         data = response.json()
     except ValueError as e:
         logging.getLogger("booru_api").error(f"[booru_api.fetch_booru_posts] Invalid JSON response from {booru_type} API. Error: {e}\nURL: {url}\nParams: {params}\nResponse text: {response.text[:500]}")
-        return []
+        raise
     posts = api['process'](data)
     if not posts:
         logging.getLogger("booru_api").warning(f"[booru_api.fetch_booru_posts] Empty results from {booru_type} API.\nURL: {url}\nParams: {params}\nResponse: {data}")
     return posts
 
-def download_image(post, image_url, output_dir):
+def get_image_extension(image_url, content_type):
+    # Remove query parameters from filename (for sancomplex and similar)
+    filename_part = image_url.split('/')[-1].split('?')[0]
+    _, ext = os.path.splitext(filename_part)
+    if ext:
+        return ext
+    if 'image/jpeg' in content_type:
+        return '.jpg'
+    elif 'image/png' in content_type:
+        return '.png'
+    elif 'image/gif' in content_type:
+        return '.gif'
+    elif 'video/mp4' in content_type:
+        return '.mp4'
+    return '.jpg'
+
+def fetch_image(image_url, hedge=False, desc=None, job=None, spill_dir=None):
+    # Streams image_url and returns (body, content_type), body being a writer.DownloadBuffer that
+    # spills large files to spill_dir; raises requests.RequestException.
+    # Every chunk is drawn from the process-wide bandwidth limiter, shared fairly per job and host.
+    from tqdm import tqdm
+    from writer import DownloadBuffer
+    if hedge:
+        # Race a second request against stragglers; see hedging.py
+        from hedging import hedged_fetch
+        with tqdm(unit='B', unit_scale=True, unit_divisor=1024, desc=f"Downloading {desc or image_url}") as pbar:
+            if bandwidth.limiter.rate:
+                pbar.set_postfix_str(f"cap {bandwidth.format_bandwidth(bandwidth.limiter.rate)}")
+            return hedged_fetch(image_url, pbar=pbar, job=job, spill_dir=spill_dir)
+
+    response = get_session().get(image_url, stream=True, timeout=10)
+    response.raise_for_status()
+    content_type = response.headers.get('Content-Type', '')
+    total_size = int(response.headers.get('content-length', 0))
+    block_size = 64 * 1024
+    body = DownloadBuffer(spill_dir)
+    host = urlparse(image_url).netloc
+    with tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024, desc=f"Downloading {desc or image_url}") as pbar:
+        if bandwidth.limiter.rate:
+            pbar.set_postfix_str(f"cap {bandwidth.format_bandwidth(bandwidth.limiter.rate)}")
+        try:
+            for chunk in response.iter_content(chunk_size=block_size):
+                if chunk:
+                    body.append(chunk)
+                    pbar.update(len(chunk))
+                    bandwidth.limiter.acquire(len(chunk), job=job, host=host)
+        except BaseException:
+            body.discard()
+            raise
+    return body.finish(), content_type
+
+# Filter values and the stored ratings they match. 's' is each site's own 's' rating: "safe"
+# on the gelbooru-style sites, "sensitive" on Danbooru.
+RATING_ALIASES = {
+    'g': {'general'}, 'general': {'general'},
+    's': {'safe', 'sensitive'}, 'safe': {'safe'}, 'sensitive': {'sensitive'},
+    'q': {'questionable'}, 'questionable': {'questionable'},
+    'e': {'explicit'}, 'explicit': {'explicit'}
+}
+
+def normalize_rating(rating, letters=GELBOORU_RATINGS):
+    rating = str(rating or '').lower()
+    return letters.get(rating, rating or None)
+
+def _to_int(value):
     try:
-        if not image_url or not image_url.startswith(('http://', 'https://')):
-            logging.getLogger("booru_api").warning(f"[booru_api.download_image] Invalid image URL for post ID {post['id']}: {image_url}")
-            return
+        return int(value)
+    except (TypeError, ValueError):
+        return None
 
-        response = requests.get(image_url, stream=True, timeout=10)
-        response.raise_for_status()
+def normalize_post(post):
+    # Map the different booru response shapes onto one set of fields; unknown values are None
+    file_url = post.get('file_url') or ''
+    ext = post.get('file_ext') or os.path.splitext(file_url.split('?')[0])[1]
+    tags = post.get('tag_string') if 'tag_string' in post else post.get('tags', '')
+    return {
+        'id': post.get('id'),
+        'tags': tags.split() if isinstance(tags, str) else list(tags or []),
+        'rating': normalize_rating(post.get('rating'), DANBOORU_RATINGS if 'tag_string' in post else GELBOORU_RATINGS),
+        'score': _to_int(post.get('score')),
+        'width': _to_int(post.get('image_width', post.get('width'))),
+        'height': _to_int(post.get('image_height', post.get('height'))),
+        'file_size': _to_int(post.get('file_size')),
+        'ext': ext.lower().lstrip('.') or None,
+        'md5': post.get('md5') or post.get('hash'),
+        'source': post.get('source') or None,
+        'file_url': file_url or None,
+        'sample_url': post.get('sample_url') or post.get('large_file_url') or None,
+        'preview_url': post.get('preview_url') or post.get('preview_file_url') or None
+    }
 
-        content_type = response.headers.get('Content-Type', '')
-        extension = ''
+# Download variants: full original, the site's resized sample, the thumbnail,
+# or "min:<N>" for the smallest variant whose longer side is at least N pixels
+VARIANTS = ['original', 'sample', 'preview']
 
-        # Remove query parameters from filename (for sancomplex and similar)
-        filename_part = image_url.split('/')[-1].split('?')[0]
-        _, ext = os.path.splitext(filename_part)
-        if ext:
-            extension = ext
+def parse_variant(spec):
+    spec = (spec or 'original').strip().lower()
+    if spec in VARIANTS:
+        return spec, None
+    if spec.startswith('min:') and spec[len('min:'):].isdigit():
+        return 'min', int(spec[len('min:'):])
+    raise ValueError(f"Unsupported download variant '{spec}'. Use original, sample, preview or min:<pixels>.")
+
+def get_post_variants(post):
+    file_url = post.get('file_url')
+    width = _to_int(post.get('image_width', post.get('width')))
+    height = _to_int(post.get('image_height', post.get('height')))
+    variants = {}
+    if file_url:
+        variants['original'] = {'url': file_url, 'width': width, 'height': height}
+    sample_url = post.get('sample_url') or post.get('large_file_url')
+    if sample_url and sample_url != file_url:
+        variants['sample'] = {'url': sample_url, 'width': _to_int(post.get('sample_width')), 'height': _to_int(post.get('sample_height'))}
+    preview_url = post.get('preview_url') or post.get('preview_file_url')
+    if preview_url:
+        variants['preview'] = {'url': preview_url, 'width': _to_int(post.get('preview_width')), 'height': _to_int(post.get('preview_height'))}
+    # Danbooru lists exact dimensions for each generated variant
+    for asset in (post.get('media_asset') or {}).get('variants', []) or []:
+        name = {'sample': 'sample', '180x180': 'preview'}.get(asset.get('type'))
+        if name in variants and asset.get('url') == variants[name]['url']:
+            variants[name]['width'] = _to_int(asset.get('width'))
+            variants[name]['height'] = _to_int(asset.get('height'))
+    return variants
+
+def select_variant(post, spec='original'):
+    # Returns (variant_name, url); falls back to the original when the requested variant is missing
+    name, min_px = parse_variant(spec)
+    variants = get_post_variants(post)
+    if name == 'min':
+        candidates = []
+        for variant_name, variant in variants.items():
+            sizes = [v for v in (variant['width'], variant['height']) if v]
+            if sizes and max(sizes) >= min_px:
+                candidates.append((max(sizes), variant_name))
+        if candidates:
+            name = min(candidates)[1]
         else:
-            if 'image/jpeg' in content_type:
-                extension = '.jpg'
-            elif 'image/png' in content_type:
-                extension = '.png'
-            elif 'image/gif' in content_type:
-                extension = '.gif'
-            elif 'video/mp4' in content_type:
-                extension = '.mp4'
-            else:
-                extension = '.jpg'
-
-        filename = os.path.join(output_dir, f"post_{post['id']}{extension}")
-
-        total_size = int(response.headers.get('content-length', 0))
-        block_size = 1024
-
-        from tqdm import tqdm
-        with open(filename, 'wb') as f:
-            with tqdm(total=total_size, unit='B', unit_scale=True, unit_divisor=1024, desc=f"Downloading {filename}") as pbar:
-                for chunk in response.iter_content(chunk_size=block_size):
-                    if chunk:
-                        f.write(chunk)
-                        pbar.update(len(chunk))
-
-        logging.getLogger("booru_api").info(f"[booru_api.download_image] Downloaded image for post ID {post['id']} -> {filename}")
+            name = 'original'
+    if name not in variants:
+        if name != 'original':
+            logging.getLogger("booru_api").info(f"[booru_api.select_variant] No {name} variant for post ID {post.get('id')}, using original.")
+        name = 'original'
+    if name not in variants:
+        return name, None
+    return name, variants[name]['url']
 
-    except requests.RequestException as e:
-        logging.getLogger("booru_api").error(f"[booru_api.download_image] Failed to download image for post ID {post['id']}: {e}")
-    except Exception as e:
-        logging.getLogger("booru_api").error(f"[booru_api.download_image] Error saving image for post ID {post['id']}: {e}")
+def get_variant_basename(post, variant):
+    return f"post_{post['id']}" if variant == 'original' else f"post_{post['id']}_{variant}"
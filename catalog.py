@@ -0,0 +1,301 @@
+import os
+import csv
+import json
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+import metrics
+from booru_api import normalize_post
+from library import get_metadata_dir, load_post_metadata, iter_library_files
+from post_filter import compile_filter
+
+# One catalog per library, next to the metadata sidecars: images/<booru>/.metadata/catalog.sqlite
+CATALOG_FILENAME = "catalog.sqlite"
+
+# Ingest batching: rows are committed in one transaction per batch, off the download threads
+INGEST_BATCH_SIZE = 500
+INGEST_FLUSH_INTERVAL = 1.0
+
+EXPORT_FORMATS = ['csv', 'json', 'jsonl']
+
+POST_COLUMNS = ['id', 'path', 'variant', 'tags', 'rating', 'score', 'width', 'height', 'file_size', 'ext', 'md5', 'file_md5', 'source', 'file_url', 'downloaded_at']
+
+# One posts row per downloaded file: an original and its sample or preview are separate rows.
+# post_tags is the inverted index: one (tag, post_id) row per posting, clustered by tag
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS posts (
+        id INTEGER NOT NULL,
+        path TEXT,
+        variant TEXT NOT NULL DEFAULT 'original',
+        tags TEXT,
+        rating TEXT,
+        score INTEGER,
+        width INTEGER,
+        height INTEGER,
+        file_size INTEGER,
+        ext TEXT,
+        md5 TEXT,
+        file_md5 TEXT,
+        source TEXT,
+        file_url TEXT,
+        downloaded_at REAL,
+        PRIMARY KEY (id, variant)
+    )""",
+    """CREATE TABLE IF NOT EXISTS post_tags (
+        tag TEXT NOT NULL,
+        post_id INTEGER NOT NULL,
+        PRIMARY KEY (tag, post_id)
+    ) WITHOUT ROWID""",
+    "CREATE INDEX IF NOT EXISTS post_tags_post ON post_tags (post_id)",
+    "CREATE INDEX IF NOT EXISTS posts_md5 ON posts (md5)"
+]
+
+_NUMERIC_COLUMNS = {'score', 'width', 'height', 'file_size'}
+_SQL_OPERATORS = {'>=': '>=', '<=': '<=', '>': '>', '<': '<', '=': '='}
+
+
+def get_catalog_path(output_dir):
+    return os.path.join(get_metadata_dir(output_dir), CATALOG_FILENAME)
+
+
+def build_catalog_row(post, path=None, variant=None, file_md5=None, downloaded_at=None):
+    meta = normalize_post(post)
+    return {
+        'id': meta['id'],
+        'path': path,
+        'variant': variant or 'original',
+        'tags': " ".join(meta['tags']),
+        'rating': meta['rating'],
+        'score': meta['score'],
+        'width': meta['width'],
+        'height': meta['height'],
+        'file_size': meta['file_size'],
+        'ext': meta['ext'],
+        'md5': meta['md5'],
+        'file_md5': file_md5,
+        'source': meta['source'],
+        'file_url': meta['file_url'],
+        'downloaded_at': downloaded_at
+    }
+
+
+class Catalog:
+    # SQLite catalog of downloaded posts with an inverted tag index. add() only queues a row;
+    # a background thread commits queued rows in batches so the download path never waits on SQLite.
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = get_catalog_path(output_dir)
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_lock = threading.Lock()
+        self._closed = False
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = self._connect()
+        try:
+            with conn:
+                for statement in _SCHEMA:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        # WAL lets queries and concurrent jobs (e.g. in the daemon) read while a batch is written
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def add(self, post, path=None, variant=None, file_md5=None):
+        if self._closed:
+            raise RuntimeError("Catalog is closed")
+        if path is not None:
+            path = os.path.relpath(path, self.output_dir)
+        self._queue.put(build_catalog_row(post, path=path, variant=variant, file_md5=file_md5, downloaded_at=time.time()))
+        with self._thread_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="rulescrape-catalog", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        conn = self._connect()
+        try:
+            done = False
+            while not done:
+                batch = []
+                deadline = time.monotonic() + INGEST_FLUSH_INTERVAL
+                while len(batch) < INGEST_BATCH_SIZE:
+                    try:
+                        row = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+                    if row is None:
+                        done = True
+                        break
+                    batch.append(row)
+                if batch:
+                    try:
+                        self._write_rows(conn, batch)
+                    except sqlite3.Error as e:
+                        logging.getLogger("catalog").error(f"[catalog.Catalog] Failed to ingest {len(batch)} posts into {self.path}: {e}")
+                        metrics.increment('catalog_failures')
+        finally:
+            conn.close()
+
+    def _write_rows(self, conn, rows):
+        with conn:
+            conn.executemany(
+                f"INSERT OR REPLACE INTO posts ({', '.join(POST_COLUMNS)}) VALUES ({', '.join('?' for _ in POST_COLUMNS)})",
+                [tuple(row[column] for column in POST_COLUMNS) for row in rows]
+            )
+            conn.executemany("DELETE FROM post_tags WHERE post_id = ?", [(row['id'],) for row in rows])
+            conn.executemany(
+                "INSERT OR IGNORE INTO post_tags (tag, post_id) VALUES (?, ?)",
+                [(tag, row['id']) for row in rows for tag in row['tags'].split()]
+            )
+        metrics.increment('catalog_posts_ingested', len(rows))
+        metrics.increment('catalog_batches')
+
+    def ingest(self, rows):
+        # Synchronous bulk ingest, used when rebuilding the catalog
+        conn = self._connect()
+        try:
+            batch = []
+            count = 0
+            for row in rows:
+                batch.append(row)
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    self._write_rows(conn, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                self._write_rows(conn, batch)
+                count += len(batch)
+            return count
+        finally:
+            conn.close()
+
+    def update_paths(self, moves):
+        # moves: (old_path, new_path) pairs, e.g. after a library reorganize
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "UPDATE posts SET path = ? WHERE path = ?",
+                    [(os.path.relpath(dest, self.output_dir), os.path.relpath(src, self.output_dir)) for src, dest in moves]
+                )
+        finally:
+            conn.close()
+
+    def close(self):
+        # Commits every queued row before returning
+        if self._closed:
+            return
+        self._closed = True
+        with self._thread_lock:
+            thread = self._thread
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def count(self):
+        conn = self._connect()
+        try:
+            return conn.execute("SELECT COUNT(*) FROM posts").fetchone()[0]
+        finally:
+            conn.close()
+
+    def query(self, expression="", limit=None):
+        # Same syntax as the download filter: "a b -c ~d ~e rating:s score>=10 ext:png".
+        # Tag terms are answered from the inverted index; unknown values never reject a post.
+        sql, params = build_query_sql(expression, limit=limit)
+        conn = self._connect()
+        try:
+            return [dict(row) for row in conn.execute(sql, params)]
+        finally:
+            conn.close()
+
+
+def build_query_sql(expression, limit=None):
+    post_filter = compile_filter(expression)
+    clauses = []
+    params = []
+    for tag in sorted(post_filter.include_tags):
+        clauses.append("p.id IN (SELECT post_id FROM post_tags WHERE tag = ?)")
+        params.append(tag)
+    if post_filter.any_tags:
+        clauses.append(f"p.id IN (SELECT post_id FROM post_tags WHERE tag IN ({', '.join('?' for _ in post_filter.any_tags)}))")
+        params.extend(sorted(post_filter.any_tags))
+    for tag in sorted(post_filter.exclude_tags):
+        clauses.append("p.id NOT IN (SELECT post_id FROM post_tags WHERE tag = ?)")
+        params.append(tag)
+    if post_filter.ratings is not None:
+        clauses.append(f"(p.rating IS NULL OR p.rating IN ({', '.join('?' for _ in post_filter.ratings)}))")
+        params.extend(sorted(post_filter.ratings))
+    if post_filter.extensions is not None:
+        clauses.append(f"(p.ext IS NULL OR p.ext IN ({', '.join('?' for _ in post_filter.extensions)}))")
+        params.extend(sorted(post_filter.extensions))
+    for field, op_symbol, value in post_filter.comparisons:
+        if field not in _NUMERIC_COLUMNS:
+            continue
+        clauses.append(f"(p.{field} IS NULL OR p.{field} {_SQL_OPERATORS[op_symbol]} ?)")
+        params.append(value)
+    sql = f"SELECT {', '.join('p.' + column for column in POST_COLUMNS)} FROM posts p"
+    if clauses:
+        sql += " WHERE " + " AND ".join(clauses)
+    sql += " ORDER BY p.id, p.variant"
+    if limit:
+        sql += " LIMIT ?"
+        params.append(int(limit))
+    return sql, params
+
+
+def export_rows(rows, path, fmt=None):
+    fmt = fmt or os.path.splitext(path)[1].lstrip('.').lower()
+    if fmt not in EXPORT_FORMATS:
+        raise ValueError(f"Unsupported export format '{fmt}'. Use one of: {', '.join(EXPORT_FORMATS)}")
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        if fmt == 'csv':
+            writer = csv.DictWriter(f, fieldnames=POST_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        elif fmt == 'json':
+            json.dump(rows, f, indent=2)
+        else:
+            for row in rows:
+                f.write(json.dumps(row, separators=(',', ':')) + "\n")
+    return len(rows)
+
+
+def rebuild_catalog(booru_type):
+    # Re-creates the catalog of images/<booru>/ from the stored metadata sidecars
+    logger = logging.getLogger("catalog")
+    output_dir = os.path.join("images", booru_type)
+    if not os.path.isdir(output_dir):
+        logger.warning(f"[catalog.rebuild_catalog] No library found at {output_dir}")
+        return 0
+    metadata = load_post_metadata(output_dir)
+    rows = []
+    for path, post_id, ext in iter_library_files(output_dir):
+        post = metadata.get(post_id)
+        if post is None:
+            continue
+        basename = os.path.splitext(os.path.basename(path))[0]
+        variant = basename.rsplit('_', 1)[1] if basename.endswith(('_sample', '_preview')) else 'original'
+        rows.append(build_catalog_row(post, path=os.path.relpath(path, output_dir), variant=variant, downloaded_at=os.path.getmtime(path)))
+    catalog_path = get_catalog_path(output_dir)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(catalog_path + suffix):
+            os.remove(catalog_path + suffix)
+    count = Catalog(output_dir).ingest(rows)
+    logger.info(f"[catalog.rebuild_catalog] Rebuilt {catalog_path} with {count} posts.")
+    return count
@@ -0,0 +1,381 @@
+import os
+import json
+import time
+import queue
+import logging
+import threading
+import itertools
+import socketserver
+import urllib.request
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import metrics
+import bandwidth
+from booru_api import BOORU_APIS, parse_variant
+from post_filter import compile_filter, build_search_tags
+from hashing import check_algorithm
+from library import ORG_METHODS
+from writer import check_fsync_policy
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8675
+
+# Fields accepted by POST /jobs and their defaults
+JOB_DEFAULTS = {
+    'booru_type': 'rule34',
+    'tag': '',
+    'limit': 10,
+    'anti_ai': False,
+    'org_method': 'By extension and first tag',
+    'post_filter': '',
+    'variant': 'original',
+    'multithread': False,
+    'max_workers': None,
+    'hedge': None,
+    'fsync_policy': None,
+    'resume': False,
+    'hash_algorithm': None
+}
+
+FINAL_STATES = {'finished', 'failed', 'cancelled'}
+
+# Finished jobs kept for GET /jobs; older ones are dropped as new jobs are submitted
+MAX_FINISHED_JOBS = 100
+
+
+class DaemonJob:
+    def __init__(self, job_id, params):
+        self.id = job_id
+        self.params = params
+        self.state = 'queued'
+        self.processed = 0
+        self.total = 0
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.cancel_event = threading.Event()
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'state': self.state,
+            'params': self.params,
+            'processed': self.processed,
+            'total': self.total,
+            'result': self.result,
+            'error': self.error,
+            'created': self.created,
+            'started': self.started,
+            'finished': self.finished
+        }
+
+
+class RulescrapeDaemon:
+    # Runs download jobs in a long-lived process so HTTP connection pools, the per-booru
+    # hash index and API rate-limiter state stay warm between jobs.
+    def __init__(self, max_jobs=1):
+        self.jobs = {}
+        self._ids = itertools.count(1)
+        self._jobs_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self.hash_indexes = {}
+        self._index_locks = {}
+        self._index_locks_lock = threading.Lock()
+        self._runners = []
+        for i in range(max(1, max_jobs)):
+            t = threading.Thread(target=self._run, name=f"rulescrape-daemon-job-{i}", daemon=True)
+            t.start()
+            self._runners.append(t)
+
+    def submit(self, request):
+        unknown = set(request) - set(JOB_DEFAULTS)
+        if unknown:
+            raise ValueError(f"Unknown job fields: {', '.join(sorted(unknown))}")
+        params = dict(JOB_DEFAULTS, **request)
+        for field in ('booru_type', 'tag', 'org_method', 'post_filter', 'variant'):
+            if not isinstance(params[field], str):
+                raise ValueError(f"{field} must be a string")
+        for field in ('fsync_policy', 'hash_algorithm'):
+            if params[field] is not None and not isinstance(params[field], str):
+                raise ValueError(f"{field} must be a string or null")
+        if params['booru_type'] not in BOORU_APIS:
+            raise ValueError(f"Unsupported booru type: {params['booru_type']}")
+        if not isinstance(params['limit'], int) or isinstance(params['limit'], bool) or params['limit'] <= 0:
+            raise ValueError("limit must be a positive integer")
+        if params['max_workers'] is not None and (not isinstance(params['max_workers'], int) or isinstance(params['max_workers'], bool) or params['max_workers'] <= 0):
+            raise ValueError("max_workers must be a positive integer")
+        for field in ('anti_ai', 'multithread', 'resume'):
+            if not isinstance(params[field], bool):
+                raise ValueError(f"{field} must be true or false")
+        if params['hedge'] is not None and not isinstance(params['hedge'], bool):
+            raise ValueError("hedge must be true or false")
+        if params['org_method'] not in ORG_METHODS:
+            raise ValueError(f"Unsupported organization method: {params['org_method']}")
+        compile_filter(params['post_filter'])
+        parse_variant(params['variant'])
+        if params['hash_algorithm'] is not None:
+            check_algorithm(params['hash_algorithm'])
+        # Writer options are checked here, so a bad value is a 400 and not a job that fails later;
+        # without one the job uses the daemon's user_settings.config, which is checked as well
+        from rulescrape import load_user_settings
+        check_fsync_policy(params['fsync_policy'] or load_user_settings().get('fsync_policy', 'batch'))
+        with self._jobs_lock:
+            self._prune_jobs()
+            job = DaemonJob(str(next(self._ids)), params)
+            self.jobs[job.id] = job
+        self._queue.put(job)
+        logging.getLogger("daemon").info(f"[daemon.RulescrapeDaemon.submit] Queued job {job.id}: {params}")
+        return job
+
+    def _prune_jobs(self):
+        # Called with _jobs_lock held
+        finished = [job for job in self.jobs.values() if job.state in FINAL_STATES]
+        if len(finished) <= MAX_FINISHED_JOBS:
+            return
+        finished.sort(key=lambda job: job.finished or job.created)
+        for job in finished[:len(finished) - MAX_FINISHED_JOBS]:
+            del self.jobs[job.id]
+
+    def get_job(self, job_id):
+        with self._jobs_lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self._jobs_lock:
+            return list(self.jobs.values())
+
+    def cancel(self, job_id):
+        job = self.get_job(job_id)
+        if job is None:
+            return None
+        job.cancel_event.set()
+        if job.state == 'queued':
+            job.state = 'cancelled'
+            job.finished = time.time()
+        return job
+
+    def get_hash_index(self, booru_type, algorithm='md5'):
+        # Scanned once per booru and hash algorithm, then shared and updated by every job
+        key = (booru_type, algorithm)
+        with self._index_locks_lock:
+            lock = self._index_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in self.hash_indexes:
+                from library import scan_library_hashes
+                output_dir = os.path.join("images", booru_type)
+                started = time.monotonic()
+                self.hash_indexes[key] = scan_library_hashes(output_dir, algorithm=algorithm)
+                logging.getLogger("daemon").info(f"[daemon.RulescrapeDaemon.get_hash_index] Indexed {len(self.hash_indexes[key])} files in {output_dir} with {algorithm} in {time.monotonic() - started:.2f}s")
+            return self.hash_indexes[key]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            if job.cancel_event.is_set():
+                continue
+            self._run_job(job)
+
+    def _run_job(self, job):
+        from rulescrape import run_script, load_user_settings
+        params = job.params
+        hash_algorithm = params['hash_algorithm'] or load_user_settings().get('hash_algorithm', 'md5')
+        job.state = 'running'
+        job.started = time.time()
+        metrics.increment('daemon_jobs_started')
+
+        def on_progress(processed, total):
+            job.processed = processed
+            job.total = total
+
+        try:
+            job.result = run_script(
+                params['booru_type'],
+                build_search_tags(params['tag'], params['anti_ai']),
+                params['limit'],
+                multithread=params['multithread'],
+                max_workers=params['max_workers'],
+                org_method=params['org_method'],
+                post_filter=params['post_filter'],
+                variant=params['variant'],
+                hedge=params['hedge'],
+                fsync_policy=params['fsync_policy'],
+                resume=params['resume'],
+                progress_callback=on_progress,
+                hash_algorithm=hash_algorithm,
+                hash_index=self.get_hash_index(params['booru_type'], hash_algorithm),
+                cancel_event=job.cancel_event
+            )
+            job.state = 'cancelled' if job.cancel_event.is_set() else 'finished'
+        except Exception as e:
+            logging.getLogger("daemon").error(f"[daemon.RulescrapeDaemon._run_job] Job {job.id} failed: {e}")
+            job.error = str(e)
+            job.state = 'failed'
+        finally:
+            job.finished = time.time()
+            metrics.increment(f"daemon_jobs_{job.state}")
+
+    def set_bandwidth(self, max_bandwidth):
+        # Adjusts the cap shared by all running jobs; raises ValueError
+        rate = bandwidth.parse_bandwidth(max_bandwidth)
+        bandwidth.limiter.set_rate(rate)
+        logging.getLogger("daemon").info(f"[daemon.RulescrapeDaemon.set_bandwidth] Bandwidth cap set to {bandwidth.format_bandwidth(rate)}")
+        return rate
+
+    def get_metrics(self):
+        values = metrics.snapshot()
+        values['bandwidth_limit'] = bandwidth.limiter.rate
+        states = {}
+        for job in self.list_jobs():
+            states[job.state] = states.get(job.state, 0) + 1
+        values['daemon_jobs_by_state'] = states
+        values['daemon_hash_index_sizes'] = {f"{booru}/{algorithm}": len(index) for (booru, algorithm), index in self.hash_indexes.items()}
+        return values
+
+
+class _DaemonRequestHandler(BaseHTTPRequestHandler):
+    server_version = "rulescrape-daemon"
+
+    def address_string(self):
+        # Unix-socket clients have no host/port
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+    def log_message(self, format, *args):
+        logging.getLogger("daemon").info(f"[daemon.request] {self.address_string()} {format % args}")
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def do_GET(self):
+        daemon = self.server.rulescrape_daemon
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if parts == ['health']:
+            self._send_json(200, {'status': 'ok'})
+        elif parts == ['metrics']:
+            self._send_json(200, daemon.get_metrics())
+        elif parts == ['jobs']:
+            self._send_json(200, [job.to_dict() for job in daemon.list_jobs()])
+        elif parts == ['bandwidth']:
+            self._send_json(200, {'max_bandwidth': bandwidth.limiter.rate})
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = daemon.get_job(parts[1])
+            if job is None:
+                self._send_json(404, {'error': f"Unknown job {parts[1]}"})
+            else:
+                self._send_json(200, job.to_dict())
+        else:
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+    def do_POST(self):
+        daemon = self.server.rulescrape_daemon
+        parts = [p for p in self.path.split('?')[0].split('/') if p]
+        if parts == ['jobs']:
+            try:
+                request = self._read_json()
+                if not isinstance(request, dict):
+                    raise ValueError("Job request must be a JSON object")
+                job = daemon.submit(request)
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(202, job.to_dict())
+        elif parts == ['bandwidth']:
+            try:
+                request = self._read_json()
+                if not isinstance(request, dict) or 'max_bandwidth' not in request:
+                    raise ValueError("Expected {\"max_bandwidth\": <bytes per second or e.g. \"2MB\">}")
+                rate = daemon.set_bandwidth(request['max_bandwidth'])
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(200, {'max_bandwidth': rate})
+        elif len(parts) == 3 and parts[0] == 'jobs' and parts[2] == 'cancel':
+            job = daemon.cancel(parts[1])
+            if job is None:
+                self._send_json(404, {'error': f"Unknown job {parts[1]}"})
+            else:
+                self._send_json(200, job.to_dict())
+        else:
+            self._send_json(404, {'error': f"Unknown path {self.path}"})
+
+
+if hasattr(socketserver, 'UnixStreamServer'):
+    class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+
+def serve(host=DEFAULT_HOST, port=DEFAULT_PORT, socket_path=None, max_jobs=1, max_bandwidth=0):
+    daemon = RulescrapeDaemon(max_jobs=max_jobs)
+    daemon.set_bandwidth(max_bandwidth)
+    if socket_path:
+        if not hasattr(socketserver, 'UnixStreamServer'):
+            raise RuntimeError("Unix sockets are not supported on this platform")
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = _UnixHTTPServer(socket_path, _DaemonRequestHandler)
+        where = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port), _DaemonRequestHandler)
+        where = f"http://{host}:{port}"
+    server.rulescrape_daemon = daemon
+    logging.getLogger("daemon").info(f"[daemon.serve] Listening on {where}")
+    print(f"[rulescrape] Daemon listening on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path and os.path.exists(socket_path):
+            os.remove(socket_path)
+        logging.getLogger("daemon").info("[daemon.serve] Daemon stopped.")
+
+
+class DaemonClient:
+    # Minimal HTTP client used by the GUI to hand jobs to a running daemon
+    def __init__(self, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout=5):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def _request(self, method, path, payload=None):
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers={'Content-Type': 'application/json'})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read().decode('utf-8'))
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read().decode('utf-8')).get('error', str(e))
+            except ValueError:
+                message = str(e)
+            raise RuntimeError(f"Daemon request {method} {path} failed: {message}")
+
+    def submit(self, **params):
+        return self._request('POST', '/jobs', params)
+
+    def status(self, job_id):
+        return self._request('GET', f'/jobs/{job_id}')
+
+    def cancel(self, job_id):
+        return self._request('POST', f'/jobs/{job_id}/cancel', {})
+
+    def metrics(self):
+        return self._request('GET', '/metrics')
+
+    def set_bandwidth(self, max_bandwidth):
+        return self._request('POST', '/bandwidth', {'max_bandwidth': max_bandwidth})
@@ -0,0 +1,268 @@
+import os
+import mmap
+import array
+import heapq
+import struct
+import threading
+
+import metrics
+
+# Digests are stored as raw 16-byte values (md5, or blake2b with digest_size=16)
+DIGEST_SIZE = 16
+
+# Bloom filter sizing: ~1% false positives at 10 bits and 7 probes per entry
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_PROBES = 7
+
+# The sorted array is indexed by the first two digest bytes, so a lookup only searches
+# the few entries of one bucket (digests are uniformly distributed)
+_NUM_BUCKETS = 1 << 16
+
+# Additions go to a small set that is merged into the sorted array once it grows past
+# max(MERGE_MIN, len / MERGE_RATIO) entries, so the set never dominates memory use
+MERGE_MIN = 65536
+MERGE_RATIO = 8
+
+# File layout: header, bucket offsets, Bloom filter bits, then the sorted digests
+_FILE_MAGIC = b"RSDIGST1"
+_HEADER = struct.Struct("<8sQQ")
+
+
+def to_digest(value):
+    if isinstance(value, str):
+        value = bytes.fromhex(value)
+    if len(value) != DIGEST_SIZE:
+        raise ValueError(f"Expected a {DIGEST_SIZE}-byte digest, got {len(value)} bytes")
+    return bytes(value)
+
+
+class BloomFilter:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        # A power-of-two size lets positions be masked instead of divided
+        self.num_bits = 1 << max(13, (capacity * BLOOM_BITS_PER_ENTRY - 1).bit_length())
+        self._mask = self.num_bits - 1
+        self.bits = bytearray(self.num_bits // 8)
+
+    def add(self, digest):
+        # The digest is already uniformly random, so two of its words drive double hashing
+        h1, h2 = struct.unpack_from("<QQ", digest)
+        h2 |= 1
+        bits, mask = self.bits, self._mask
+        for i in range(BLOOM_PROBES):
+            pos = (h1 + i * h2) & mask
+            bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, digest):
+        h1, h2 = struct.unpack_from("<QQ", digest)
+        h2 |= 1
+        bits, mask = self.bits, self._mask
+        for i in range(BLOOM_PROBES):
+            pos = (h1 + i * h2) & mask
+            if not bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+
+class DigestStore:
+    # Thread-safe set of 16-byte digests (about 17 bytes per entry): a sorted array, optionally
+    # memory-mapped from a file, plus a small set of recent additions. A Bloom filter in front
+    # answers the common "not seen before" lookup without touching either.
+    # Accepts raw digests or hex strings; iterates as hex strings.
+    def __init__(self, digests=()):
+        self._lock = threading.RLock()
+        self._base = b""
+        self._start = 0
+        self._count = 0
+        self._offsets = array.array('I', bytes(4 * (_NUM_BUCKETS + 1)))
+        self._mmap = None
+        self._file = None
+        self._added = set()
+        self._removed = set()
+        self._bloom = BloomFilter(MERGE_MIN)
+        self.update(digests)
+
+    def _digest_at(self, i):
+        start = self._start + i * DIGEST_SIZE
+        return self._base[start:start + DIGEST_SIZE]
+
+    def _in_base(self, digest):
+        bucket = digest[0] << 8 | digest[1]
+        lo, hi = self._offsets[bucket], self._offsets[bucket + 1]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            candidate = self._digest_at(mid)
+            if candidate < digest:
+                lo = mid + 1
+            elif candidate > digest:
+                hi = mid
+            else:
+                return True
+        return False
+
+    def _contains(self, digest):
+        if digest not in self._bloom:
+            return False
+        if digest in self._added:
+            return True
+        return digest not in self._removed and self._in_base(digest)
+
+    def __contains__(self, value):
+        digest = to_digest(value)
+        with self._lock:
+            return self._contains(digest)
+
+    def __len__(self):
+        with self._lock:
+            return self._count - len(self._removed) + len(self._added)
+
+    def __iter__(self):
+        with self._lock:
+            digests = [self._digest_at(i) for i in range(self._count)]
+            removed, added = set(self._removed), list(self._added)
+        for digest in digests:
+            if digest not in removed:
+                yield digest.hex()
+        for digest in added:
+            yield digest.hex()
+
+    def add(self, value):
+        # Returns True when the digest was new, so check-and-insert is one atomic step
+        digest = to_digest(value)
+        with self._lock:
+            if self._contains(digest):
+                return False
+            self._insert(digest)
+            self._maybe_merge()
+            return True
+
+    def _insert(self, digest):
+        if digest in self._removed:
+            self._removed.discard(digest)
+        else:
+            self._added.add(digest)
+        self._bloom.add(digest)
+
+    def update(self, values):
+        # Bulk insert: merges at most once, and a merge rebuilds the Bloom filter in one pass
+        with self._lock:
+            pending = set()
+            for value in values:
+                digest = to_digest(value)
+                if digest not in pending and not self._contains(digest):
+                    pending.add(digest)
+            # Digests removed from the sorted array only need their removal undone
+            restored = pending & self._removed
+            self._removed -= restored
+            pending -= restored
+            self._added |= pending
+            if len(self._added) >= max(MERGE_MIN, self._count // MERGE_RATIO):
+                self._merge(rebuild_bloom=True)
+            else:
+                for digest in pending:
+                    self._bloom.add(digest)
+
+    def discard(self, value):
+        digest = to_digest(value)
+        with self._lock:
+            if digest in self._added:
+                self._added.discard(digest)
+            elif self._in_base(digest):
+                self._removed.add(digest)
+
+    def _maybe_merge(self):
+        if len(self._added) >= max(MERGE_MIN, self._count // MERGE_RATIO):
+            self._merge()
+
+    def _merge(self, rebuild_bloom=False):
+        # Linear merge of the sorted array with the sorted pending additions into a new array
+        existing = (d for d in map(self._digest_at, range(self._count)) if d not in self._removed)
+        merged = bytearray()
+        for digest in heapq.merge(existing, sorted(self._added)):
+            merged += digest
+        count = len(merged) // DIGEST_SIZE
+        bloom = self._bloom
+        if rebuild_bloom or count > bloom.capacity:
+            bloom = BloomFilter(count * 2)
+            for i in range(count):
+                bloom.add(merged[i * DIGEST_SIZE:(i + 1) * DIGEST_SIZE])
+        self._close_mmap()
+        self._base, self._start, self._count = bytes(merged), 0, count
+        self._offsets = self._bucket_offsets()
+        self._bloom = bloom
+        self._added = set()
+        self._removed = set()
+        metrics.increment('digest_store_merges')
+
+    def _bucket_offsets(self):
+        # offsets[b] is the index of the first digest whose first two bytes are >= b
+        offsets = array.array('I', bytes(4 * (_NUM_BUCKETS + 1)))
+        lo = 0
+        for bucket in range(_NUM_BUCKETS):
+            prefix = bucket.to_bytes(2, 'big')
+            hi = self._count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._digest_at(mid)[:2] < prefix:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            offsets[bucket] = lo
+        offsets[_NUM_BUCKETS] = self._count
+        return offsets
+
+    def _close_mmap(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._file.close()
+            self._mmap = self._file = None
+
+    def save(self, path):
+        with self._lock:
+            if self._added or self._removed:
+                self._merge()
+            temp_path = path + ".tmp"
+            with open(temp_path, 'wb') as f:
+                f.write(_HEADER.pack(_FILE_MAGIC, self._count, self._bloom.capacity))
+                f.write(self._offsets.tobytes())
+                f.write(self._bloom.bits)
+                f.write(self._base[self._start:self._start + self._count * DIGEST_SIZE])
+            os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path, use_mmap=True):
+        # With use_mmap the sorted digests stay on disk and are paged in by the OS as needed
+        store = cls()
+        f = open(path, 'rb')
+        try:
+            magic, count, bloom_capacity = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _FILE_MAGIC:
+                raise ValueError(f"{path} is not a digest store")
+            offsets = array.array('I')
+            offsets.frombytes(f.read(4 * (_NUM_BUCKETS + 1)))
+            bloom = BloomFilter(bloom_capacity)
+            f.readinto(bloom.bits)
+            start = f.tell()
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if use_mmap and count else None
+            base = mapped if mapped is not None else f.read(count * DIGEST_SIZE)
+        except Exception:
+            f.close()
+            raise
+        if mapped is None:
+            f.close()
+            start = 0
+        with store._lock:
+            store._base, store._start, store._count = base, start, count
+            store._offsets, store._bloom = offsets, bloom
+            store._mmap, store._file = mapped, (f if mapped is not None else None)
+        return store
+
+    def close(self):
+        # Releases the memory map (so the file can be removed, also on Windows) and empties the store
+        with self._lock:
+            self._close_mmap()
+            self._base, self._start, self._count = b"", 0, 0
+            self._offsets = array.array('I', bytes(4 * (_NUM_BUCKETS + 1)))
+            self._added = set()
+            self._removed = set()
+            self._bloom = BloomFilter(MERGE_MIN)
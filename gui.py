@@ -4,20 +4,29 @@ import tkinter as tk
 from tkinter import ttk, messagebox
 import logging
 import json
-from booru_api import fetch_booru_posts, download_image
+from collections import deque
+from booru_api import VARIANTS, parse_variant
+import bandwidth
+import ui_events
+from library import ORG_METHODS
+from post_filter import compile_filter, build_search_tags, FilterError
 import configparser
 import sys
 
+# Worker events are drained and drawn in one batch per frame
+UI_FRAME_MS = 100
+# Lines kept in the log window, and the most drawn from one frame's batch
+LOG_MAX_LINES = 2000
+LOG_LINES_PER_FRAME = 200
+
 # These should be imported from rulescrape.py if needed
-from rulescrape import load_user_settings, save_user_settings, skins_dir
+from rulescrape import load_user_settings, save_user_settings, skins_dir, run_script
 
 def main_gui():
     global root, progress_var, progress_bar, progress_label, booru_var, tag_entry, limit_entry, anti_ai_var, start_button
 
     logger = logging.getLogger("gui")
     user_settings = load_user_settings()
-    # Error queue handler for GUI popups (must be after root is defined)
-    import queue
 
     def reload_user_settings():
         nonlocal user_settings, max_workers
@@ -31,21 +40,6 @@ def main_gui():
     win_h = user_settings.get('window_height', 320)
     root.geometry(f"{win_w}x{win_h}")
 
-    error_queue = queue.Queue()
-    def poll_error_queue():
-        try:
-            while True:
-                msg = error_queue.get_nowait()
-                try:
-                    messagebox.showerror("Error", msg)
-                except Exception:
-                    logger.warning(f"[gui.poll_error_queue] Could not show error popup: {msg}")
-        except queue.Empty:
-            pass
-        root.after(500, poll_error_queue)
-    # Start polling for error messages
-    root.after(500, poll_error_queue)
-
     skin = None
     if user_settings.get('skin'):
         skin_path = os.path.join(skins_dir, user_settings['skin'])
@@ -81,11 +75,17 @@ def main_gui():
         "tag_entry": {"row": 1, "column": 1, "padx": 3, "pady": 1, "sticky": "w"},
         "limit_label": {"row": 2, "column": 0, "padx": 3, "pady": 1, "sticky": "e"},
         "limit_entry": {"row": 2, "column": 1, "padx": 3, "pady": 1, "sticky": "w"},
-        "anti_ai_checkbox": {"row": 4, "column": 0, "columnspan": 2, "padx": 3, "pady": (2, 0), "sticky": "n"},
-        "multithread_checkbox": {"row": 5, "column": 0, "columnspan": 2, "padx": 3, "pady": (1, 0), "sticky": "n"},
-        "start_button": {"row": 6, "column": 0, "columnspan": 2, "pady": 3, "sticky": "ew"},
-        "progress_bar": {"row": 7, "column": 0, "columnspan": 2, "padx": 3, "pady": 1, "sticky": "ew"},
-        "progress_label": {"row": 8, "column": 0, "columnspan": 2, "pady": 1}
+        "filter_label": {"row": 4, "column": 0, "padx": 3, "pady": 1, "sticky": "e"},
+        "filter_entry": {"row": 4, "column": 1, "padx": 3, "pady": 1, "sticky": "w"},
+        "variant_label": {"row": 5, "column": 0, "padx": 3, "pady": 1, "sticky": "e"},
+        "variant_dropdown": {"row": 5, "column": 1, "padx": 3, "pady": 1, "sticky": "w"},
+        "anti_ai_checkbox": {"row": 6, "column": 0, "columnspan": 2, "padx": 3, "pady": (2, 0), "sticky": "n"},
+        "multithread_checkbox": {"row": 7, "column": 0, "columnspan": 2, "padx": 3, "pady": (1, 0), "sticky": "n"},
+        "profile_checkbox": {"row": 8, "column": 0, "columnspan": 2, "padx": 3, "pady": (1, 0), "sticky": "n"},
+        "start_button": {"row": 9, "column": 0, "columnspan": 2, "pady": 3, "sticky": "ew"},
+        "progress_bar": {"row": 10, "column": 0, "columnspan": 2, "padx": 3, "pady": 1, "sticky": "ew"},
+        "progress_label": {"row": 11, "column": 0, "columnspan": 2, "pady": 1},
+        "event_summary": {"row": 12, "column": 0, "columnspan": 2, "pady": 1}
     }
     if skin:
         bg_color = skin.get("bg_color", bg_color)
@@ -164,29 +164,54 @@ def main_gui():
         font=(font_family, font_size),
         command=lambda: show_multithread_warning() if multithread_var.get() else None
     )
+    # Not saved with the other settings: profiling slows a run down, so it is opted into per session
+    profile_var = tk.BooleanVar(value=False)
+    profile_checkbox = tk.Checkbutton(
+        root,
+        text="Profile run (report in profiles/)",
+        variable=profile_var,
+        bg=bg_color,
+        fg=fg_color,
+        activebackground=bg_color,
+        activeforeground=fg_color,
+        selectcolor=bg_color,
+        font=(font_family, font_size)
+    )
     limit_label = ttk.Label(root, text="Limit:", font=(font_family, font_size))
     limit_entry = tk.Entry(root, bg=entry_bg, fg=entry_fg, insertbackground=fg_color, font=(font_family, font_size))
-    org_methods = [
-        "By extension and first tag",
-        "By extension only",
-        "Flat (no folders)",
-        "By tag only"
-    ]
+    org_methods = ORG_METHODS
     org_method_var = tk.StringVar(value=user_settings.get('org_method', org_methods[0]))
     org_method_label = ttk.Label(root, text="Organization Method:", font=(font_family, font_size))
     org_method_dropdown = ttk.Combobox(root, values=org_methods, textvariable=org_method_var, state="readonly", font=(font_family, font_size))
     org_method_dropdown.configure(background=entry_bg, foreground=entry_fg)
     limit_entry.insert(0, str(user_settings.get('limit', 10)))
+    filter_label = ttk.Label(root, text="Filter:", font=(font_family, font_size))
+    filter_entry = tk.Entry(root, bg=entry_bg, fg=entry_fg, insertbackground=fg_color, font=(font_family, font_size))
+    filter_entry.insert(0, user_settings.get('post_filter', ''))
+    # Editable so "min:<pixels>" can be typed in
+    variant_var = tk.StringVar(value=user_settings.get('variant', 'original'))
+    variant_label = ttk.Label(root, text="Variant:", font=(font_family, font_size))
+    variant_dropdown = ttk.Combobox(root, values=VARIANTS + ["min:1280"], textvariable=variant_var, font=(font_family, font_size))
+    variant_dropdown.configure(background=entry_bg, foreground=entry_fg)
     progress_label = ttk.Label(root, text="Progress: 0%", font=(font_family, font_size))
+    # Errors, duplicates and skips of the current job; click to open the log
+    event_summary = ttk.Label(root, text="", cursor="hand2", font=(font_family, font_size))
     # Widget grid placement
     org_method_label.grid(row=3, column=0, padx=3, pady=1, sticky="e")
     org_method_dropdown.grid(row=3, column=1, padx=3, pady=1, sticky="w")
-    anti_ai_checkbox.grid(row=4, column=0, columnspan=2, padx=3, pady=(2, 0), sticky="n")
-    multithread_checkbox.grid(row=5, column=0, columnspan=2, padx=3, pady=(1, 0), sticky="n")
+    filter_label.grid(**layout["filter_label"])
+    filter_entry.grid(**layout["filter_entry"])
+    variant_label.grid(**layout["variant_label"])
+    variant_dropdown.grid(**layout["variant_dropdown"])
+    anti_ai_checkbox.grid(**layout["anti_ai_checkbox"])
+    multithread_checkbox.grid(**layout["multithread_checkbox"])
+    profile_checkbox.grid(**layout["profile_checkbox"])
     progress_bar.grid(**layout["progress_bar"])
     progress_label.grid(**layout["progress_label"])
+    event_summary.grid(**layout["event_summary"])
     progress_bar.grid_remove()
     progress_label.grid_remove()
+    event_summary.grid_remove()
     progress_animation_colors = []
     if skin:
         progress_animation_colors = skin.get("progress_bar_animation", [])
@@ -220,86 +245,134 @@ def main_gui():
         else:
             percent = int((processed / total) * 100)
             progress_var.set(percent)
-            progress_label.config(text=f"Progress: {percent}%")
+            cap = f" (cap {bandwidth.format_bandwidth(bandwidth.limiter.rate)})" if bandwidth.limiter.rate else ""
+            progress_label.config(text=f"Progress: {percent}%{cap}")
+    # Non-modal log of worker messages, filled from log_lines when opened
+    log_lines = deque(maxlen=LOG_MAX_LINES)
+    log_window = [None, None]
+    def open_log_window(event=None):
+        if log_window[0] is not None and log_window[0].winfo_exists():
+            log_window[0].lift()
+            return
+        window = tk.Toplevel(root)
+        window.title("Rulescrape Log")
+        window.geometry("640x320")
+        window.configure(bg=bg_color)
+        text = tk.Text(window, bg=entry_bg, fg=entry_fg, font=(font_family, font_size), wrap="none")
+        scrollbar = ttk.Scrollbar(window, command=text.yview)
+        text.configure(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side="right", fill="y")
+        text.pack(side="left", fill="both", expand=True)
+        text.insert("end", "".join(f"{line}\n" for line in log_lines))
+        text.see("end")
+        text.config(state="disabled")
+        log_window[0], log_window[1] = window, text
+    event_summary.bind("<Button-1>", open_log_window)
+    def append_log(lines):
+        log_lines.extend(lines)
+        window, text = log_window
+        if window is None or not window.winfo_exists():
+            return
+        # One insert per frame; the oldest lines are trimmed in one delete
+        text.config(state="normal")
+        text.insert("end", "".join(f"{line}\n" for line in lines))
+        excess = int(text.index("end-1c").split(".")[0]) - 1 - LOG_MAX_LINES
+        if excess > 0:
+            text.delete("1.0", f"{excess + 1}.0")
+        text.see("end")
+        text.config(state="disabled")
+    def drain_ui_events():
+        # Everything posted since the last frame is applied at once: the latest progress value,
+        # the log lines and the per-job totals
+        progress, messages, dropped, counts = ui_events.events.drain()
+        if progress is not None:
+            update_progress(*progress)
+        if messages or dropped:
+            lines = [f"[{kind}] {message}" for kind, message in messages[-LOG_LINES_PER_FRAME:]]
+            hidden = dropped + max(0, len(messages) - LOG_LINES_PER_FRAME)
+            if hidden:
+                lines.insert(0, f"... {hidden} more messages (see the log file)")
+            append_log(lines)
+        summary = ui_events.format_counts(counts)
+        if summary and summary != event_summary.cget("text"):
+            event_summary.config(text=summary)
+            event_summary.grid()
+        return counts
+    def pump_ui_events():
+        try:
+            drain_ui_events()
+        except Exception as e:
+            logger.warning(f"[gui.pump_ui_events] Failed to update the window: {e}")
+        root.after(UI_FRAME_MS, pump_ui_events)
+    ui_events.events.listen()
+    root.after(UI_FRAME_MS, pump_ui_events)
     download_in_progress = [False]
-    def run_script_with_progress(booru_type, tag, limit):
-        import concurrent.futures
-        from threading import Lock
+    def run_script_with_progress(booru_type, tag, limit, post_filter="", variant="original"):
         download_in_progress[0] = True
+        ui_events.events.reset()
+        event_summary.config(text="")
+        event_summary.grid_remove()
+        append_log([f"--- {booru_type}: '{tag}', limit {limit} ---"])
         progress_bar.grid()
         progress_label.grid()
         if progress_animation_colors:
             start_progress_animation()
-        output_dir = os.path.join("images", booru_type)
-        os.makedirs(output_dir, exist_ok=True)
-        org_method = org_method_var.get() if 'org_method_var' in locals() else "By extension and first tag"
-        use_multithread = multithread_var.get() if 'multithread_var' in locals() else False
-        def get_dest_dir(post):
-            image_url = post.get('file_url')
-            ext = os.path.splitext(image_url.split('?')[0])[1].lower().replace('.', '')
-            if ext not in ["jpg", "jpeg", "png", "gif", "webm", "mp4", "bmp", "svg", "other"]:
-                ext = "other"
-            # Use correct tag field for Danbooru
-            if booru_var.get() == "danbooru":
-                tags = post.get('tag_string', '')
-                tag_list = tags.split() if isinstance(tags, str) else []
-            else:
-                tags = post.get('tags', '')
-                tag_list = tags.split() if isinstance(tags, str) else []
-            if org_method == "By extension and first tag":
-                return os.path.join(output_dir, ext, tag_list[0] if tag_list else "untagged")
-            elif org_method == "By extension only":
-                return os.path.join(output_dir, ext)
-            elif org_method == "Flat (no folders)":
-                return output_dir
-            elif org_method == "By tag only":
-                return os.path.join(output_dir, tag_list[0] if tag_list else "untagged")
-            else:
-                return os.path.join(output_dir, ext, tag_list[0] if tag_list else "untagged")
-        progress_lock = Lock()
-        valid_images_processed = [0]  # Use list for mutability in threads
-        def download_one(post, total_arg=None):
-            image_url = post.get('file_url')
-            if not image_url or not image_url.startswith(('http://', 'https://')):
-                logger.warning(f"[gui.download_one] Skipping invalid post: {post}")
-                return False
-            dest_dir = get_dest_dir(post)
-            os.makedirs(dest_dir, exist_ok=True)
-            logger.info(f"[gui.download_one] Downloading {image_url} to {dest_dir}")
-            try:
-                download_image(post, image_url, dest_dir)
-                with progress_lock:
-                    valid_images_processed[0] += 1
-                    root.after(0, lambda vp=valid_images_processed[0]: update_progress(vp, total_arg))
-                return True
-            except Exception as e:
-                logger.error(f"[gui.download_one] Error downloading {image_url}: {e}")
-                return False
+        org_method = org_method_var.get()
+        use_multithread = multithread_var.get()
+        use_profile = profile_var.get()
+        valid_images_processed = [0]
+        def on_progress(processed, total):
+            valid_images_processed[0] = processed
+            ui_events.events.post_progress(processed, total)
+        current_settings = load_user_settings()
+        def run_via_daemon():
+            # Thin-client mode: the daemon does the work, the GUI only polls job status
+            import time
+            from daemon import DaemonClient, FINAL_STATES
+            client = DaemonClient(current_settings.get('daemon_url'))
+            if use_profile:
+                logger.warning("[gui.run_via_daemon] Profiling only covers local runs; the daemon job is not profiled.")
+            job = client.submit(
+                booru_type=booru_type,
+                tag=tag,
+                limit=limit,
+                multithread=use_multithread,
+                max_workers=max_workers,
+                org_method=org_method,
+                post_filter=post_filter,
+                variant=variant
+            )
+            logger.info(f"[gui.run_via_daemon] Submitted job {job['id']} to daemon at {client.url}")
+            while job['state'] not in FINAL_STATES:
+                time.sleep(0.5)
+                job = client.status(job['id'])
+                on_progress(job['processed'], job['total'])
+            if job['state'] == 'failed':
+                raise RuntimeError(job['error'])
         def thread_target():
             import time
             start_time = time.time()
             try:
-                posts = fetch_booru_posts(booru_type, tags=tag, limit=limit)
-                total = min(len(posts), limit)
-                root.after(100, lambda: update_progress(0, total))
+                if current_settings.get('use_daemon'):
+                    run_via_daemon()
+                    return
                 if use_multithread:
                     logger.info(f"[gui.thread_target] Starting multi-threaded download with {max_workers} workers.")
-                    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-                        futures = [executor.submit(download_one, post, total) for post in posts]
-                        for future in concurrent.futures.as_completed(futures):
-                            # Progress is updated in download_one via lock
-                            if valid_images_processed[0] >= limit:
-                                break
-                else:
-                    for post in posts:
-                        if download_one(post, total):
-                            pass  # Progress updated in download_one
-                        if valid_images_processed[0] >= limit:
-                            break
+                run_script(
+                    booru_type, tag, limit,
+                    multithread=use_multithread,
+                    max_workers=max_workers,
+                    org_method=org_method,
+                    post_filter=post_filter,
+                    variant=variant,
+                    progress_callback=on_progress,
+                    max_bandwidth=current_settings.get('max_bandwidth'),
+                    profile=use_profile
+                )
             except Exception as e:
                 logger.error(f"[gui.thread_target] Error during download: {e}")
+                ui_events.events.post('error', f"Error during download: {e}")
                 root.after(100, lambda: update_progress(0, 0))
-                root.after(100, lambda: show_completion_message(0))
             finally:
                 elapsed = time.time() - start_time
                 logger.info(f"[gui.thread_target] Download task finished in {elapsed:.2f} seconds.")
@@ -310,7 +383,11 @@ def main_gui():
         t.start()
     def show_completion_message(valid_images_processed):
         try:
-            messagebox.showinfo("Done", f"Downloaded {valid_images_processed} images from {booru_var.get()}.")
+            summary = ui_events.format_counts(drain_ui_events())
+            message = f"Downloaded {valid_images_processed} images from {booru_var.get()}."
+            if summary:
+                message += f"\n\n{summary}\nClick the summary below the progress bar to see the log."
+            messagebox.showinfo("Done", message)
         except tk.TclError:
             logger.warning("[gui.show_completion_message] Tkinter root window destroyed before showing completion message.")
         finally:
@@ -345,15 +422,19 @@ def main_gui():
             org_method_var.get(),
             current_skin,
             w,
-            h
+            h,
+            post_filter=filter_entry.get().strip(),
+            variant=variant_var.get().strip()
         )
-        logger.info(f"[gui.save_config_live] User settings/config file changed: booru={booru_var.get()}, tag='{tag_val}', limit={limit_val}, anti_ai={anti_ai_var.get()}, multithread={multithread_var.get()}, org_method={org_method_var.get()}, skin={current_skin}, window=({w}x{h})")
+        logger.info(f"[gui.save_config_live] User settings/config file changed: booru={booru_var.get()}, tag='{tag_val}', limit={limit_val}, anti_ai={anti_ai_var.get()}, multithread={multithread_var.get()}, org_method={org_method_var.get()}, filter='{filter_entry.get().strip()}', variant={variant_var.get().strip()}, skin={current_skin}, window=({w}x{h})")
     # booru_var.bind("<<ComboboxSelected>>", save_config_live)  # replaced by on_booru_selected
     tag_entry.bind("<KeyRelease>", save_config_live)
     limit_entry.bind("<KeyRelease>", save_config_live)
+    filter_entry.bind("<KeyRelease>", save_config_live)
     anti_ai_var.trace_add("write", lambda *args: save_config_live())
     multithread_var.trace_add("write", lambda *args: save_config_live())
     org_method_var.trace_add("write", lambda *args: save_config_live())
+    variant_var.trace_add("write", lambda *args: save_config_live())
     def start_download():
         try:
             limit = int(limit_entry.get()) if limit_entry.get().isdigit() else 10
@@ -363,10 +444,20 @@ def main_gui():
         tag_text_raw = tag_entry.get()
         if tag_text_raw == "Enter tag...":
             tag_text_raw = ""
-        tag_text_for_download = tag_text_raw
-        if anti_ai_var.get():
-            tag_text_for_download = (tag_text_raw + " -ai -ai_generated -ai_assisted").strip()
-        logger.info(f"[gui.start_download] User started download: booru_type={booru_var.get()}, tag='{tag_text_for_download}', limit={limit}, multithreaded={multithread_var.get()}")
+        tag_text_for_download = build_search_tags(tag_text_raw, anti_ai_var.get())
+        post_filter = filter_entry.get().strip()
+        variant = variant_var.get().strip()
+        try:
+            compile_filter(post_filter)
+        except FilterError as e:
+            messagebox.showerror("Invalid Filter", str(e))
+            return
+        try:
+            parse_variant(variant)
+        except ValueError as e:
+            messagebox.showerror("Invalid Variant", str(e))
+            return
+        logger.info(f"[gui.start_download] User started download: booru_type={booru_var.get()}, tag='{tag_text_for_download}', limit={limit}, multithreaded={multithread_var.get()}, filter='{post_filter}', variant={variant}")
         if download_in_progress[0]:
             messagebox.showinfo("Download in Progress", "Please wait for the current download to finish before starting a new one.")
             return
@@ -374,7 +465,9 @@ def main_gui():
         root.after(100, lambda: run_script_with_progress(
             booru_var.get(),
             tag_text_for_download,
-            limit
+            limit,
+            post_filter,
+            variant
         ))
         start_button.config(state="normal")
     # Only create start_button once, and grid it once
@@ -388,7 +481,7 @@ def main_gui():
         font=(font_family, font_size),
         command=start_download
     )
-    root.grid_rowconfigure((0, 1, 2, 3, 4, 5, 6, 7), weight=1)
+    root.grid_rowconfigure((0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11), weight=1)
     root.grid_columnconfigure((0, 1), weight=1)
     booru_label = ttk.Label(root, text="Booru Type:", font=(font_family, font_size))
     booru_label.grid(**layout["booru_label"])
@@ -415,7 +508,9 @@ def main_gui():
             org_method_var.get(),
             current_skin,
             w,
-            h
+            h,
+            post_filter=filter_entry.get().strip(),
+            variant=variant_var.get().strip()
         )
         try:
             root.quit()
@@ -455,11 +550,14 @@ def main_gui():
             root.configure(bg=bg_color)
             tag_entry.config(bg=entry_bg, fg=entry_fg, insertbackground=fg_color, font=(font_family, font_size))
             limit_entry.config(bg=entry_bg, fg=entry_fg, insertbackground=fg_color, font=(font_family, font_size))
+            filter_entry.config(bg=entry_bg, fg=entry_fg, insertbackground=fg_color, font=(font_family, font_size))
             anti_ai_checkbox.config(bg=bg_color, fg=fg_color, activebackground=bg_color, activeforeground=fg_color, selectcolor=bg_color, font=(font_family, font_size))
             multithread_checkbox.config(bg=bg_color, fg=fg_color, activebackground=bg_color, activeforeground=fg_color, selectcolor=bg_color, font=(font_family, font_size))
+            profile_checkbox.config(bg=bg_color, fg=fg_color, activebackground=bg_color, activeforeground=fg_color, selectcolor=bg_color, font=(font_family, font_size))
             start_button.config(bg=button_bg, fg=button_fg, activebackground=highlight_color, activeforeground=fg_color, font=(font_family, font_size))
             booru_var.config(background=entry_bg, foreground=entry_fg, font=(font_family, font_size))
             org_method_dropdown.config(background=entry_bg, foreground=entry_fg, font=(font_family, font_size))
+            variant_dropdown.config(background=entry_bg, foreground=entry_fg, font=(font_family, font_size))
             booru_label.grid(**layout["booru_label"])
             booru_var.grid(**layout["booru_var"])
             tag_label.grid(**layout["tag_label"])
@@ -468,14 +566,22 @@ def main_gui():
             limit_entry.grid(**layout["limit_entry"])
             org_method_label.grid(**layout.get("org_method_label", {"row":3, "column":0, "padx":3, "pady":1, "sticky":"e"}))
             org_method_dropdown.grid(**layout.get("org_method_dropdown", {"row":3, "column":1, "padx":3, "pady":1, "sticky":"w"}))
+            filter_label.grid(**layout["filter_label"])
+            filter_entry.grid(**layout["filter_entry"])
+            variant_label.grid(**layout["variant_label"])
+            variant_dropdown.grid(**layout["variant_dropdown"])
             anti_ai_checkbox.grid(**layout["anti_ai_checkbox"])
             multithread_checkbox.grid(**layout["multithread_checkbox"])
+            profile_checkbox.grid(**layout["profile_checkbox"])
             progress_bar.grid(**layout["progress_bar"])
             progress_label.grid(**layout["progress_label"])
+            event_summary.grid(**layout["event_summary"])
             start_button.grid(**layout["start_button"])
             if not download_in_progress[0]:
                 progress_bar.grid_remove()
                 progress_label.grid_remove()
+            if not event_summary.cget("text"):
+                event_summary.grid_remove()
         except Exception as e:
             logger.warning(f"[gui.apply_skin_by_index] Failed to apply skin {skin_files[idx]}: {e}")
     def cycle_skin(event=None):
@@ -0,0 +1,127 @@
+import os
+import mmap
+import hashlib
+import logging
+import threading
+
+import metrics
+
+# Every algorithm produces a 16-byte digest so it fits the digest store. md5 is the default
+# and what the booru APIs report; the others are faster identity hashes for large libraries.
+#   blake2b - in the standard library
+#   xxh128  - needs the optional 'xxhash' package
+#   blake3  - needs the optional 'blake3' package
+ALGORITHMS = ['md5', 'blake2b', 'xxh128', 'blake3']
+DEFAULT_ALGORITHM = 'md5'
+
+# Files at least this large are hashed through mmap; smaller ones with readinto into a reused buffer
+MMAP_THRESHOLD = 1024 * 1024
+READ_BUFFER_SIZE = 1024 * 1024
+
+# Libraries smaller than this are scanned in-process; process start-up would cost more than it saves
+PARALLEL_SCAN_MIN_FILES = 256
+
+_buffers = threading.local()
+
+
+class _Blake3Hasher:
+    def __init__(self):
+        import blake3
+        self._hasher = blake3.blake3()
+
+    def update(self, data):
+        self._hasher.update(data)
+
+    def hexdigest(self):
+        return self._hasher.hexdigest(length=16)
+
+
+def new_hasher(algorithm):
+    # Raises ValueError for unknown algorithms and for optional ones whose package is missing
+    if algorithm == 'md5':
+        return hashlib.md5()
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == 'xxh128':
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError("Hash algorithm 'xxh128' needs the 'xxhash' package (pip install xxhash)")
+        return xxhash.xxh3_128()
+    if algorithm == 'blake3':
+        try:
+            return _Blake3Hasher()
+        except ImportError:
+            raise ValueError("Hash algorithm 'blake3' needs the 'blake3' package (pip install blake3)")
+    raise ValueError(f"Unsupported hash algorithm '{algorithm}'. Use one of: {', '.join(ALGORITHMS)}")
+
+
+def check_algorithm(algorithm):
+    new_hasher(algorithm)
+    return algorithm
+
+
+def hash_buffers(chunks, algorithms=(DEFAULT_ALGORITHM,)):
+    # Returns {algorithm: hexdigest} for in-memory data, e.g. a download before it is written
+    hashers = {algorithm: new_hasher(algorithm) for algorithm in algorithms}
+    for chunk in chunks:
+        for hasher in hashers.values():
+            hasher.update(chunk)
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in hashers.items()}
+
+
+def hash_file(path, algorithms=(DEFAULT_ALGORITHM,)):
+    # Returns {algorithm: hexdigest}, or None when the file cannot be read
+    hashers = [new_hasher(algorithm) for algorithm in algorithms]
+    try:
+        with open(path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size >= MMAP_THRESHOLD:
+                # hashlib releases the GIL while hashing large buffers, so mmap keeps all cores busy
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    for hasher in hashers:
+                        hasher.update(mapped)
+            else:
+                buffer = getattr(_buffers, 'buffer', None)
+                if buffer is None:
+                    buffer = _buffers.buffer = bytearray(READ_BUFFER_SIZE)
+                view = memoryview(buffer)
+                while True:
+                    n = f.readinto(buffer)
+                    if not n:
+                        break
+                    for hasher in hashers:
+                        hasher.update(view[:n])
+    except (OSError, ValueError) as e:
+        logging.getLogger("hashing").warning(f"[hashing.hash_file] Could not hash {path}: {e}")
+        return None
+    return {algorithm: hasher.hexdigest() for algorithm, hasher in zip(algorithms, hashers)}
+
+
+def _hash_one(args):
+    path, algorithm = args
+    digests = hash_file(path, (algorithm,))
+    return digests[algorithm] if digests else None
+
+
+def hash_files(paths, algorithm=DEFAULT_ALGORITHM, processes=None):
+    # Yields the hex digest (or None) of every path, in order. Large batches are spread over
+    # a process pool; if one cannot be started (e.g. restricted sandbox) a thread pool is used.
+    import concurrent.futures
+    check_algorithm(algorithm)
+    paths = list(paths)
+    work = [(path, algorithm) for path in paths]
+    if processes == 1 or len(paths) < PARALLEL_SCAN_MIN_FILES:
+        yield from map(_hash_one, work)
+        return
+    workers = processes or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(paths) // (workers * 4)))
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_hash_one, work, chunksize=chunksize))
+        metrics.increment('hash_scan_process_batches')
+    except (OSError, concurrent.futures.process.BrokenProcessPool) as e:
+        logging.getLogger("hashing").warning(f"[hashing.hash_files] Process pool unavailable ({e}); hashing with threads.")
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_hash_one, work))
+    yield from results
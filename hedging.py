@@ -0,0 +1,177 @@
+import time
+import queue
+import logging
+import threading
+import statistics
+from collections import deque
+from urllib.parse import urlsplit, urlunsplit
+
+import metrics
+import bandwidth
+from booru_api import get_session
+from writer import DownloadBuffer
+
+# Mirrors that serve the same paths as the primary image host
+ALTERNATE_HOSTS = {
+    'wimg.rule34.xxx': 'us.rule34.xxx',
+    'us.rule34.xxx': 'wimg.rule34.xxx'
+}
+
+# A transfer is hedged once it has run for at least HEDGE_MIN_ELAPSED seconds
+# and its rate is below HEDGE_RATIO times the median of recent transfers
+HEDGE_RATIO = 0.2
+HEDGE_MIN_ELAPSED = 2.0
+HEDGE_MIN_SAMPLES = 5
+POLL_INTERVAL = 0.1
+CHUNK_SIZE = 8 * 1024
+
+
+class TransferRateTracker:
+    def __init__(self, window=200):
+        self._rates = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, num_bytes, elapsed):
+        if num_bytes > 0 and elapsed > 0:
+            with self._lock:
+                self._rates.append(num_bytes / elapsed)
+
+    def median(self):
+        with self._lock:
+            if len(self._rates) < HEDGE_MIN_SAMPLES:
+                return None
+            return statistics.median(self._rates)
+
+
+rate_tracker = TransferRateTracker()
+
+
+def get_alternate_url(image_url):
+    parts = urlsplit(image_url)
+    alternate_host = ALTERNATE_HOSTS.get(parts.hostname or '')
+    if not alternate_host:
+        return image_url
+    return urlunsplit(parts._replace(netloc=alternate_host))
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _Transfer(threading.Thread):
+    def __init__(self, url, done_queue, job=None, spill_dir=None):
+        super().__init__(daemon=True)
+        self.url = url
+        self.job = job
+        self.host = urlsplit(url).netloc
+        self.body = DownloadBuffer(spill_dir)
+        self.done_queue = done_queue
+        self.cancel_event = threading.Event()
+        self.response = None
+        self.content_type = ''
+        self.total_size = 0
+        self.bytes_received = 0
+        self.error = None
+        self.started_at = time.monotonic()
+        self.finished_at = None
+
+    def run(self):
+        try:
+            self.response = get_session().get(self.url, stream=True, timeout=10)
+            self.response.raise_for_status()
+            self.content_type = self.response.headers.get('Content-Type', '')
+            self.total_size = int(self.response.headers.get('content-length', 0))
+            for chunk in self.response.iter_content(chunk_size=CHUNK_SIZE):
+                if self.cancel_event.is_set():
+                    raise _Cancelled()
+                if chunk:
+                    self.body.append(chunk)
+                    self.bytes_received += len(chunk)
+                    bandwidth.limiter.acquire(len(chunk), job=self.job, host=self.host)
+        except Exception as e:
+            self.error = e
+            self.body.discard()
+        finally:
+            if self.cancel_event.is_set():
+                # Lost the race; its spill file (if any) is not needed
+                self.body.discard()
+            self.body.finish()
+            self.finished_at = time.monotonic()
+            self.done_queue.put(self)
+
+    def elapsed(self):
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    def rate(self):
+        elapsed = self.elapsed()
+        return self.bytes_received / elapsed if elapsed > 0 else 0.0
+
+    def abort(self):
+        # The transfer thread stops at its next chunk (or read timeout) and drops what it received
+        self.cancel_event.set()
+
+
+def _should_hedge(transfer):
+    if transfer.elapsed() < HEDGE_MIN_ELAPSED:
+        return False
+    median = rate_tracker.median()
+    if median is None:
+        return False
+    return transfer.rate() < median * HEDGE_RATIO
+
+
+def hedged_fetch(image_url, pbar=None, job=None, spill_dir=None):
+    # Downloads image_url, racing a second request against it when it falls far behind the
+    # running median rate. Returns (body, content_type) of the winner; see writer.DownloadBuffer.
+    done_queue = queue.Queue()
+    primary = _Transfer(image_url, done_queue, job=job, spill_dir=spill_dir)
+    primary.start()
+    transfers = [primary]
+    running = 1
+    winner = None
+    last_error = None
+    reported = 0
+    while running:
+        try:
+            finished = done_queue.get(timeout=POLL_INTERVAL)
+        except queue.Empty:
+            finished = None
+        if pbar is not None:
+            progress = max(t.bytes_received for t in transfers)
+            if progress > reported:
+                pbar.update(progress - reported)
+                reported = progress
+        if finished is None:
+            if len(transfers) == 1 and _should_hedge(primary):
+                hedge_url = get_alternate_url(image_url)
+                logging.getLogger("hedging").info(f"[hedging.hedged_fetch] Hedging slow transfer ({primary.rate():.0f} B/s after {primary.elapsed():.1f}s): {image_url} -> {hedge_url}")
+                metrics.increment('hedges_issued')
+                transfers.append(_Transfer(hedge_url, done_queue, job=job, spill_dir=spill_dir))
+                transfers[-1].start()
+                running += 1
+            continue
+        running -= 1
+        if finished.error is None:
+            winner = finished
+            break
+        last_error = finished.error
+
+    if len(transfers) > 1:
+        hedge = transfers[1]
+        if winner is hedge:
+            metrics.increment('hedges_won')
+        elif winner is primary:
+            metrics.increment('hedges_lost')
+    for transfer in transfers:
+        if transfer is not winner:
+            if transfer.finished_at is None:
+                # The transfer thread drops its own buffer once it sees the cancel
+                transfer.abort()
+                metrics.increment('hedges_cancelled')
+            else:
+                transfer.body.discard()
+
+    if winner is None:
+        raise last_error
+    rate_tracker.record(winner.bytes_received, winner.elapsed())
+    return winner.body, winner.content_type
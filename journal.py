@@ -0,0 +1,152 @@
+import os
+import json
+import hashlib
+import logging
+import threading
+
+# Job journals live next to the library they fill: images/<booru>/.jobs/<job_id>.journal
+JOBS_DIRNAME = ".jobs"
+
+# Posts in these states are never retried on resume; "failed" and "queued" posts are
+TERMINAL_STATES = {'done', 'duplicate', 'skipped', 'present'}
+
+
+def get_job_id(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+class JobJournal:
+    # Append-only JSON-lines record of one download job: its parameters, every fetched page
+    # (so a resume does not query the API again), per-post state and completed pages.
+    # Replaying the file rebuilds the job state; a torn last line from a crash is ignored.
+    def __init__(self, output_dir, params):
+        self.params = params
+        self.job_id = get_job_id(params)
+        self.jobs_dir = os.path.join(output_dir, JOBS_DIRNAME)
+        self.path = os.path.join(self.jobs_dir, f"{self.job_id}.journal")
+        self.hashes_path = os.path.join(self.jobs_dir, f"{self.job_id}.digests")
+        self.pages = {}
+        self.completed_pages = set()
+        self.post_states = {}
+        self.retry_posts = {}
+        self.done_hashes = set()
+        self.finished = False
+        self._file = None
+        self._lock = threading.Lock()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _replay(self):
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logging.getLogger("journal").warning(f"[journal.JobJournal] Ignoring unreadable line in {self.path}")
+                    continue
+                kind = record.get('t')
+                if kind == 'page':
+                    self.pages[record['page']] = record['posts']
+                elif kind == 'page_done':
+                    self.completed_pages.add(record['page'])
+                elif kind == 'post':
+                    post_id = str(record['id'])
+                    self.post_states[post_id] = record['state']
+                    if record.get('md5'):
+                        self.done_hashes.add(record['md5'])
+                    if record.get('post') is not None:
+                        self.retry_posts[post_id] = record['post']
+                elif kind == 'finished':
+                    self.finished = True
+        # Only posts that still need work are kept for retrying
+        self.retry_posts = {post_id: post for post_id, post in self.retry_posts.items() if self.post_states.get(post_id) not in TERMINAL_STATES}
+
+    def start(self, resume=False):
+        # Returns True when an existing journal was replayed
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        resumed = False
+        if resume and self.exists():
+            self._replay()
+            resumed = True
+            self._file = open(self.path, 'a', encoding='utf-8')
+            self._append({'t': 'resumed'})
+        else:
+            if resume:
+                logging.getLogger("journal").warning(f"[journal.JobJournal.start] No journal found for job {self.job_id}; starting a new job.")
+            if os.path.exists(self.hashes_path):
+                os.remove(self.hashes_path)
+            self._file = open(self.path, 'w', encoding='utf-8')
+            self._append({'t': 'job', 'job_id': self.job_id, 'params': self.params})
+        return resumed
+
+    def _append(self, record):
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.write(json.dumps(record, separators=(',', ':')) + "\n")
+            self._file.flush()
+
+    def record_page(self, page, posts):
+        self.pages[page] = posts
+        self._append({'t': 'page', 'page': page, 'posts': posts})
+
+    def record_page_done(self, page):
+        self.completed_pages.add(page)
+        self._append({'t': 'page_done', 'page': page})
+
+    def record_post(self, post, state, reason=None, md5=None):
+        post_id = str(post['id'])
+        self.post_states[post_id] = state
+        record = {'t': 'post', 'id': post['id'], 'state': state}
+        if reason:
+            record['reason'] = reason
+        if md5:
+            record['md5'] = md5
+            self.done_hashes.add(md5)
+        self._append(record)
+
+    def is_settled(self, post):
+        return self.post_states.get(str(post['id'])) in TERMINAL_STATES
+
+    def save_hashes(self, hashes):
+        # hashes is a digests.DigestStore
+        hashes.save(self.hashes_path)
+
+    def load_hashes(self):
+        # Snapshot of the library hashes taken when the job started (memory-mapped), or None
+        from digests import DigestStore
+        if not os.path.exists(self.hashes_path):
+            return None
+        try:
+            return DigestStore.load(self.hashes_path)
+        except (OSError, ValueError) as e:
+            logging.getLogger("journal").warning(f"[journal.JobJournal.load_hashes] Ignoring unreadable hash snapshot {self.hashes_path}: {e}")
+            return None
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def finish(self):
+        # Compact to one line per post; failed posts keep their metadata so a later --resume can retry them
+        self.close()
+        posts_by_id = {str(post['id']): post for posts in self.pages.values() for post in posts}
+        posts_by_id.update(self.retry_posts)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'t': 'job', 'job_id': self.job_id, 'params': self.params}, separators=(',', ':')) + "\n")
+            for post_id, state in self.post_states.items():
+                if state == 'queued':
+                    state = 'failed'
+                record = {'t': 'post', 'id': post_id, 'state': state}
+                if state not in TERMINAL_STATES and post_id in posts_by_id:
+                    record['post'] = posts_by_id[post_id]
+                f.write(json.dumps(record, separators=(',', ':')) + "\n")
+            f.write(json.dumps({'t': 'finished'}, separators=(',', ':')) + "\n")
+        os.replace(temp_path, self.path)
+        if os.path.exists(self.hashes_path):
+            os.remove(self.hashes_path)
+        self.finished = True
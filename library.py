@@ -0,0 +1,253 @@
+import os
+import re
+import json
+import logging
+
+# Folder layouts supported for images/<booru>/
+ORG_METHODS = [
+    "By extension and first tag",
+    "By extension only",
+    "Flat (no folders)",
+    "By tag only"
+]
+
+KNOWN_EXTENSIONS = ["jpg", "jpeg", "png", "gif", "webm", "mp4", "bmp", "svg", "other"]
+
+# Post metadata is kept next to the library so it can be re-laid out offline
+METADATA_DIRNAME = ".metadata"
+
+POST_FILENAME_RE = re.compile(r"^post_(\d+)(?:_(?:sample|preview))?(\.[^.]+)$")
+
+
+def get_post_tags(post):
+    # Danbooru uses tag_string, the gelbooru-style APIs use tags
+    tags = post.get('tag_string') if 'tag_string' in post else post.get('tags', '')
+    return tags.split() if isinstance(tags, str) else []
+
+
+def get_dest_dir(post, output_dir, org_method, ext=None):
+    if ext is None:
+        image_url = post.get('file_url') or ''
+        ext = os.path.splitext(image_url.split('?')[0])[1]
+    ext = ext.lower().replace('.', '')
+    if ext not in KNOWN_EXTENSIONS:
+        ext = "other"
+    tag_list = get_post_tags(post)
+    first_tag = tag_list[0] if tag_list else "untagged"
+    if org_method == "By extension and first tag":
+        return os.path.join(output_dir, ext, first_tag)
+    elif org_method == "By extension only":
+        return os.path.join(output_dir, ext)
+    elif org_method == "Flat (no folders)":
+        return output_dir
+    elif org_method == "By tag only":
+        return os.path.join(output_dir, first_tag)
+    else:
+        return os.path.join(output_dir, ext, first_tag)
+
+
+def get_metadata_dir(output_dir):
+    return os.path.join(output_dir, METADATA_DIRNAME)
+
+
+def save_post_metadata(output_dir, post, writer=None):
+    metadata_dir = get_metadata_dir(output_dir)
+    path = os.path.join(metadata_dir, f"post_{post['id']}.json")
+    if writer is not None:
+        writer.write(path, [json.dumps(post, separators=(',', ':')).encode('utf-8')])
+        return
+    os.makedirs(metadata_dir, exist_ok=True)
+    temp_path = path + ".tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(post, f, separators=(',', ':'))
+        os.replace(temp_path, path)
+    except Exception as e:
+        logging.getLogger("library").warning(f"[library.save_post_metadata] Failed to save metadata for post ID {post.get('id')}: {e}")
+
+
+def load_post_metadata(output_dir):
+    metadata = {}
+    metadata_dir = get_metadata_dir(output_dir)
+    if not os.path.isdir(metadata_dir):
+        return metadata
+    for fname in os.listdir(metadata_dir):
+        if not fname.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(metadata_dir, fname), 'r', encoding='utf-8') as f:
+                post = json.load(f)
+            metadata[str(post['id'])] = post
+        except Exception as e:
+            logging.getLogger("library").warning(f"[library.load_post_metadata] Failed to read {fname}: {e}")
+    return metadata
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif", ".webm", ".mp4")
+
+
+def scan_library_hashes(output_dir, algorithm='md5', processes=None):
+    # Build a compact digest store of the existing image hashes in output_dir; the files are
+    # hashed in parallel across processes
+    from digests import DigestStore
+    from hashing import hash_files
+    paths = []
+    for root, dirs, files in os.walk(output_dir):
+        for file in files:
+            if file.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(os.path.join(root, file))
+    return DigestStore(bytes.fromhex(h) for h in hash_files(paths, algorithm=algorithm, processes=processes) if h)
+
+
+def iter_library_files(output_dir):
+    for root, dirs, files in os.walk(output_dir):
+        # Never descend into metadata or other bookkeeping folders
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for file in files:
+            match = POST_FILENAME_RE.match(file)
+            if match:
+                yield os.path.join(root, file), match.group(1), match.group(2)
+
+
+def plan_reorganize(output_dir, org_method, metadata=None):
+    # Returns (moves, missing_metadata, conflicts); a conflict is a move onto a destination that
+    # another file of the library already has or is planned to take, e.g. one post in two folders
+    if metadata is None:
+        metadata = load_post_metadata(output_dir)
+    planned = []
+    missing_metadata = []
+    for path, post_id, ext in iter_library_files(output_dir):
+        post = metadata.get(post_id)
+        if post is None:
+            missing_metadata.append(path)
+            continue
+        dest = os.path.join(get_dest_dir(post, output_dir, org_method, ext=ext), os.path.basename(path))
+        planned.append((path, dest))
+    # Files already in place keep their spot, so they are claimed before any move
+    taken = {os.path.normcase(os.path.abspath(dest)) for path, dest in planned if os.path.abspath(dest) == os.path.abspath(path)}
+    moves = []
+    conflicts = []
+    for path, dest in planned:
+        key = os.path.normcase(os.path.abspath(dest))
+        if os.path.abspath(dest) == os.path.abspath(path):
+            continue
+        if key in taken:
+            conflicts.append((path, dest))
+            continue
+        taken.add(key)
+        moves.append((path, dest))
+    return moves, missing_metadata, conflicts
+
+
+def fetch_missing_metadata(booru_type, output_dir, paths, max_workers=None, save=True):
+    # Sidecars only exist for posts downloaded since they were introduced; for older files the
+    # post is looked up on the site by id and, unless save is False, its sidecar written.
+    # Returns the posts that were found, by id.
+    import concurrent.futures
+    import requests
+    from booru_api import fetch_booru_posts
+    post_ids = sorted({POST_FILENAME_RE.match(os.path.basename(path)).group(1) for path in paths}, key=int)
+    workers = max_workers if max_workers is not None else os.cpu_count() // 2 or 1
+
+    def fetch(post_id):
+        try:
+            posts = fetch_booru_posts(booru_type, tags=f"id:{post_id}", limit=1)
+        except (requests.RequestException, ValueError) as e:
+            logging.getLogger("library").warning(f"[library.fetch_missing_metadata] Could not look up post ID {post_id} on {booru_type}: {e}")
+            return None
+        post = next((p for p in posts if str(p.get('id')) == post_id), None)
+        if post is None:
+            logging.getLogger("library").warning(f"[library.fetch_missing_metadata] Post ID {post_id} was not found on {booru_type}.")
+            return None
+        if save:
+            save_post_metadata(output_dir, post)
+        return post
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        return {post_id: post for post_id, post in zip(post_ids, executor.map(fetch, post_ids)) if post is not None}
+
+
+def apply_move(src, dest, link=False):
+    # Returns "moved", "linked", "skipped" or "conflict"; safe to re-run after an interruption
+    if os.path.exists(dest):
+        try:
+            if os.path.samefile(src, dest):
+                return "skipped"
+        except OSError:
+            pass
+        return "conflict"
+    os.makedirs(os.path.dirname(dest), exist_ok=True)
+    if link:
+        os.link(src, dest)
+        return "linked"
+    os.rename(src, dest)
+    return "moved"
+
+
+def remove_empty_dirs(output_dir):
+    for root, dirs, files in os.walk(output_dir, topdown=False):
+        if root == output_dir or os.path.basename(root).startswith('.'):
+            continue
+        try:
+            if not os.listdir(root):
+                os.rmdir(root)
+        except OSError:
+            pass
+
+
+def reorganize(booru_type, org_method, link=False, dry_run=False, max_workers=None, fetch_missing=True):
+    # Returns (results, moves): outcome counts and the planned (src, dest) moves
+    logger = logging.getLogger("library")
+    if org_method not in ORG_METHODS:
+        raise ValueError(f"Unsupported organization method: {org_method}")
+    output_dir = os.path.join("images", booru_type)
+    if not os.path.isdir(output_dir):
+        logger.warning(f"[library.reorganize] No library found at {output_dir}")
+        return {}, []
+    metadata = load_post_metadata(output_dir)
+    moves, missing_metadata, conflicts = plan_reorganize(output_dir, org_method, metadata)
+    fetched = {}
+    if missing_metadata and fetch_missing:
+        logger.info(f"[library.reorganize] {len(missing_metadata)} files have no stored metadata; fetching their posts from {booru_type}.")
+        # A dry run plans from the fetched posts in memory and writes no sidecars
+        fetched = fetch_missing_metadata(booru_type, output_dir, missing_metadata, max_workers=max_workers, save=not dry_run)
+        metadata.update(fetched)
+        moves, missing_metadata, conflicts = plan_reorganize(output_dir, org_method, metadata)
+    for path in missing_metadata:
+        logger.warning(f"[library.reorganize] No stored metadata for {path}, leaving it in place.")
+    for src, dest in conflicts:
+        logger.warning(f"[library.reorganize] {dest} is taken by another file of the library, leaving {src} in place.")
+    results = {"planned": len(moves), "missing_metadata": len(missing_metadata)}
+    if fetch_missing:
+        results["fetched_metadata"] = len(fetched)
+    if conflicts:
+        results["conflict"] = len(conflicts)
+    if dry_run:
+        logger.info(f"[library.reorganize] Dry run: {len(moves)} files would be {'linked' if link else 'moved'} into '{org_method}'.")
+        return results, moves
+
+    import concurrent.futures
+    workers = max_workers if max_workers is not None else os.cpu_count() // 2 or 1
+
+    def run_move(move):
+        src, dest = move
+        try:
+            return apply_move(src, dest, link=link)
+        except OSError as e:
+            logger.error(f"[library.reorganize] Failed to {'link' if link else 'move'} {src} -> {dest}: {e}")
+            return "failed"
+
+    moved = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for move, outcome in zip(moves, executor.map(run_move, moves)):
+            results[outcome] = results.get(outcome, 0) + 1
+            if outcome == "moved":
+                moved.append(move)
+    if not link:
+        remove_empty_dirs(output_dir)
+    # Keep catalog paths pointing at the files' new locations
+    from catalog import Catalog, get_catalog_path
+    if moved and os.path.exists(get_catalog_path(output_dir)):
+        Catalog(output_dir).update_paths(moved)
+    logger.info(f"[library.reorganize] Reorganized {booru_type} library into '{org_method}': {results}")
+    return results, moves
@@ -0,0 +1,35 @@
+import threading
+
+# Process-wide counters shared by the download pipeline (e.g. hedged requests)
+_lock = threading.Lock()
+_counters = {}
+
+
+def increment(name, amount=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_value(name, value):
+    with _lock:
+        _counters[name] = value
+
+
+def get(name, default=0):
+    with _lock:
+        return _counters.get(name, default)
+
+
+def snapshot():
+    with _lock:
+        return dict(_counters)
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+
+
+def format_metrics(values=None):
+    values = snapshot() if values is None else values
+    return ", ".join(f"{name}={values[name]}" for name in sorted(values))
@@ -0,0 +1,116 @@
+import re
+import logging
+from booru_api import normalize_post, RATING_ALIASES
+
+# Appended to the search query when Anti-AI is enabled
+ANTI_AI_TAGS = ["-ai", "-ai_generated", "-ai_assisted"]
+
+NUMERIC_FIELDS = {'score': 'score', 'width': 'width', 'height': 'height', 'size': 'file_size'}
+SIZE_UNITS = {'': 1, 'b': 1, 'kb': 1024, 'mb': 1024 ** 2, 'gb': 1024 ** 3}
+
+_COMPARISON_RE = re.compile(r"^(score|width|height|size)(>=|<=|>|<|=)(\d+(?:\.\d+)?)([a-zA-Z]*)$")
+_OPERATORS = {
+    '>=': lambda a, b: a >= b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '<': lambda a, b: a < b,
+    '=': lambda a, b: a == b
+}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def build_search_tags(tag, anti_ai):
+    if anti_ai:
+        return " ".join([tag or ""] + ANTI_AI_TAGS).strip()
+    return tag
+
+
+class PostFilter:
+    # Compiled form of a filter expression such as:
+    #   cat_girl -ai_generated ~cat ~dog rating:s,q score>=10 width>=1000 size<=5MB ext:jpg,png
+    # "~tag" terms form one group of which at least one tag must be present
+    def __init__(self, expression=""):
+        self.expression = (expression or "").strip()
+        self.include_tags = set()
+        self.exclude_tags = set()
+        self.any_tags = set()
+        self.ratings = None
+        self.extensions = None
+        self.comparisons = []
+        for term in self.expression.split():
+            self._compile_term(term)
+
+    def _compile_term(self, term):
+        lowered = term.lower()
+        if lowered.startswith('rating:'):
+            ratings = set()
+            for value in lowered[len('rating:'):].split(','):
+                if value not in RATING_ALIASES:
+                    raise FilterError(f"Unknown rating '{value}' in filter term '{term}'")
+                ratings.update(RATING_ALIASES[value])
+            self.ratings = ratings
+        elif lowered.startswith('ext:'):
+            self.extensions = {e.lstrip('.') for e in lowered[len('ext:'):].split(',') if e}
+        elif _COMPARISON_RE.match(lowered):
+            field, op, number, unit = _COMPARISON_RE.match(lowered).groups()
+            if unit and (field != 'size' or unit not in SIZE_UNITS):
+                raise FilterError(f"Invalid unit '{unit}' in filter term '{term}'")
+            self.comparisons.append((NUMERIC_FIELDS[field], op, float(number) * SIZE_UNITS[unit]))
+        elif term.startswith('-') and len(term) > 1:
+            self.exclude_tags.add(term[1:])
+        elif term.startswith('~') and len(term) > 1:
+            self.any_tags.add(term[1:])
+        elif term.startswith('+') and len(term) > 1:
+            self.include_tags.add(term[1:])
+        elif re.match(r"^(score|width|height|size)[<>=]", lowered):
+            raise FilterError(f"Invalid filter term '{term}'")
+        else:
+            self.include_tags.add(term)
+
+    def __bool__(self):
+        return bool(self.expression)
+
+    def check(self, post):
+        # Returns None when the post passes, otherwise a short reason. Unknown metadata never rejects a post.
+        meta = normalize_post(post)
+        tags = set(meta['tags'])
+        missing = self.include_tags - tags
+        if missing:
+            return f"missing tags {sorted(missing)}"
+        excluded = self.exclude_tags & tags
+        if excluded:
+            return f"excluded tags {sorted(excluded)}"
+        if self.any_tags and not self.any_tags & tags:
+            return f"none of tags {sorted(self.any_tags)}"
+        if self.ratings is not None and meta['rating'] is not None and meta['rating'] not in self.ratings:
+            return f"rating {meta['rating']}"
+        if self.extensions is not None and meta['ext'] is not None and meta['ext'] not in self.extensions:
+            return f"extension {meta['ext']}"
+        for field, op, value in self.comparisons:
+            actual = meta[field]
+            if actual is not None and not _OPERATORS[op](actual, value):
+                return f"{field} {actual}"
+        return None
+
+    def __call__(self, post):
+        return self.check(post) is None
+
+
+def compile_filter(expression):
+    return PostFilter(expression)
+
+
+def apply_filter(posts, post_filter):
+    if not post_filter:
+        return list(posts)
+    kept = []
+    for post in posts:
+        reason = post_filter.check(post)
+        if reason is None:
+            kept.append(post)
+        else:
+            logging.getLogger("post_filter").info(f"[post_filter.apply_filter] Filtered out post ID {post.get('id')}: {reason}")
+    return kept
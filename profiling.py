@@ -0,0 +1,222 @@
+import os
+import io
+import sys
+import json
+import time
+import pstats
+import cProfile
+import logging
+import threading
+import contextlib
+import tracemalloc
+from collections import Counter
+
+import metrics
+
+# Reports go to profiles/<timestamp>_<label>/ unless a directory is given
+PROFILES_DIRNAME = "profiles"
+
+# Stack sampler: every thread's stack is recorded this often, tagged with the current phase
+SAMPLE_INTERVAL = 0.01
+SAMPLE_MAX_DEPTH = 40
+
+# Samples whose innermost frame is one of these are threads waiting for work, not doing it
+IDLE_FRAMES = {
+    'threading:wait', 'threading:_wait_for_tstate_lock', 'queue:get',
+    'selectors:select', 'concurrent.futures.thread:_worker'
+}
+
+TOP_FUNCTIONS = 40
+TOP_ALLOCATORS = 25
+TOP_SAMPLED_PACKAGES = 15
+
+
+_OWN_FILES = {__file__, tracemalloc.__file__}
+
+
+class _NullProfiler:
+    # Stand-in used when profiling is off, so the pipeline can always wrap its phases
+    enabled = False
+    report_dir = None
+
+    def phase(self, name):
+        return contextlib.nullcontext()
+
+    def start(self):
+        pass
+
+    def stop(self):
+        return None
+
+
+NULL_PROFILER = _NullProfiler()
+
+
+class _PhaseStats:
+    def __init__(self):
+        self.calls = 0
+        self.wall_seconds = 0.0
+        self.peak_memory = 0
+        self.memory_growth = 0
+        self.allocators = Counter()
+        self.allocation_counts = Counter()
+        self.samples = Counter()
+        self.idle_samples = 0
+        self.profile = cProfile.Profile()
+
+
+class RunProfiler:
+    # Profiles one pipeline run phase by phase:
+    #   cProfile      - the thread that runs the phase (deterministic, per phase .pstats file)
+    #   stack sampler - every thread, including download and writer threads, tagged by phase
+    #   tracemalloc   - peak traced memory and the top allocating lines of each phase
+    enabled = True
+
+    def __init__(self, report_dir=None, label="run", use_cprofile=True, use_tracemalloc=True, use_sampler=True):
+        if report_dir is None:
+            stamp = time.strftime("%Y%m%d-%H%M%S")
+            report_dir = os.path.join(PROFILES_DIRNAME, f"{stamp}_{label}")
+        self.report_dir = report_dir
+        self.use_cprofile = use_cprofile
+        self.use_tracemalloc = use_tracemalloc
+        self.use_sampler = use_sampler
+        self.phases = {}
+        self._current = []
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stop_sampling = threading.Event()
+        self._started_tracemalloc = False
+        self._started_at = None
+
+    def start(self):
+        self._started_at = time.monotonic()
+        if self.use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracemalloc = True
+        if self.use_sampler:
+            self._sampler = threading.Thread(target=self._sample, name="rulescrape-profiler", daemon=True)
+            self._sampler.start()
+        logging.getLogger("profiling").info(f"[profiling.RunProfiler.start] Profiling run; report will be written to {self.report_dir}")
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        with self._lock:
+            stats = self.phases.setdefault(name, _PhaseStats())
+        tracing = self.use_tracemalloc and tracemalloc.is_tracing()
+        # Snapshots are taken outside the measured part, so their cost is not charged to the phase
+        if tracing:
+            before = tracemalloc.take_snapshot()
+            tracemalloc.reset_peak()
+            start_memory = tracemalloc.get_traced_memory()[0]
+        with self._lock:
+            self._current.append(name)
+            # cProfile only follows the calling thread; a nested phase keeps profiling into the outer one
+            profile_this = self.use_cprofile and len(self._current) == 1
+        if profile_this:
+            stats.profile.enable()
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            if profile_this:
+                stats.profile.disable()
+            with self._lock:
+                stats.calls += 1
+                stats.wall_seconds += elapsed
+                self._current.remove(name)
+            if tracing:
+                current, peak = tracemalloc.get_traced_memory()
+                stats.peak_memory = max(stats.peak_memory, peak)
+                stats.memory_growth += current - start_memory
+                for diff in tracemalloc.take_snapshot().compare_to(before, 'lineno'):
+                    # The profiler's own bookkeeping is left out of the allocation report
+                    if diff.size_diff > 0 and diff.traceback[0].filename not in _OWN_FILES:
+                        stats.allocators[str(diff.traceback)] += diff.size_diff
+                        stats.allocation_counts[str(diff.traceback)] += diff.count_diff
+
+    def _sample(self):
+        own_id = threading.get_ident()
+        while not self._stop_sampling.wait(SAMPLE_INTERVAL):
+            with self._lock:
+                if not self._current:
+                    continue
+                stats = self.phases[self._current[-1]]
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < SAMPLE_MAX_DEPTH:
+                    code = frame.f_code
+                    stack.append(f"{frame.f_globals.get('__name__', os.path.basename(code.co_filename))}:{code.co_name}")
+                    frame = frame.f_back
+                if stack[0] in IDLE_FRAMES:
+                    stats.idle_samples += 1
+                else:
+                    stats.samples[";".join(reversed(stack))] += 1
+
+    @staticmethod
+    def _sampled_packages(samples):
+        # Share of samples with a frame in each top-level package, e.g. how often tqdm or logging was on a stack
+        total = sum(samples.values())
+        packages = Counter()
+        for stack, count in samples.items():
+            for package in {frame.split(':', 1)[0].split('.', 1)[0] for frame in stack.split(';')}:
+                packages[package] += count
+        return {package: round(count / total, 3) for package, count in packages.most_common(TOP_SAMPLED_PACKAGES)}
+
+    def stop(self):
+        # Stops all collectors and writes the report; returns the report directory
+        self._stop_sampling.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._started_tracemalloc:
+            tracemalloc.stop()
+        self._write_report()
+        logging.getLogger("profiling").info(f"[profiling.RunProfiler.stop] Profile report written to {self.report_dir}")
+        return self.report_dir
+
+    def _write_report(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        summary = {
+            'python': sys.version,
+            'total_seconds': time.monotonic() - self._started_at if self._started_at else None,
+            'metrics': metrics.snapshot(),
+            'phases': {}
+        }
+        memory_lines = []
+        for name, stats in self.phases.items():
+            summary['phases'][name] = {
+                'calls': stats.calls,
+                'wall_seconds': round(stats.wall_seconds, 4),
+                'peak_memory_bytes': stats.peak_memory,
+                'memory_growth_bytes': stats.memory_growth,
+                'samples': sum(stats.samples.values()),
+                'idle_samples': stats.idle_samples,
+                'sampled_packages': self._sampled_packages(stats.samples)
+            }
+            if self.use_cprofile and stats.calls:
+                try:
+                    stats.profile.dump_stats(os.path.join(self.report_dir, f"{name}.pstats"))
+                    text = io.StringIO()
+                    pstats.Stats(stats.profile, stream=text).sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+                    with open(os.path.join(self.report_dir, f"{name}.txt"), 'w', encoding='utf-8') as f:
+                        f.write(text.getvalue())
+                except TypeError:
+                    # Raised by pstats when the phase ran no profiled Python code
+                    pass
+            if stats.samples:
+                # Collapsed stacks, usable with flamegraph.pl or speedscope
+                with open(os.path.join(self.report_dir, f"{name}.stacks"), 'w', encoding='utf-8') as f:
+                    for stack, count in stats.samples.most_common():
+                        f.write(f"{stack} {count}\n")
+            if self.use_tracemalloc:
+                memory_lines.append(f"== {name}: peak {stats.peak_memory / 1024 / 1024:.1f} MB, growth {stats.memory_growth / 1024 / 1024:.1f} MB")
+                for location, size in stats.allocators.most_common(TOP_ALLOCATORS):
+                    memory_lines.append(f"  {size / 1024:10.1f} KB  {stats.allocation_counts[location]:8d} blocks  {location}")
+                memory_lines.append("")
+        if memory_lines:
+            with open(os.path.join(self.report_dir, "memory.txt"), 'w', encoding='utf-8') as f:
+                f.write("\n".join(memory_lines))
+        with open(os.path.join(self.report_dir, "summary.json"), 'w', encoding='utf-8') as f:
+            json.dump(summary, f, indent=2)
@@ -1,13 +1,25 @@
 import os
+import re
 import logging
+import contextlib
 from logging.handlers import TimedRotatingFileHandler
 import gzip
 import shutil
-from booru_api import fetch_booru_posts, download_image
+from booru_api import fetch_booru_posts, fetch_image, normalize_post, get_max_page_size, get_image_extension, select_variant, parse_variant, get_variant_basename
+from writer import WriteBehindWriter, FSYNC_POLICIES, SPILL_DIRNAME, check_fsync_policy, remove_stale_spills
+from journal import JobJournal
+from catalog import Catalog
+from profiling import RunProfiler, NULL_PROFILER
+from hashing import ALGORITHMS as HASH_ALGORITHMS, check_algorithm, hash_buffers
+from library import get_dest_dir, save_post_metadata, scan_library_hashes
+from post_filter import compile_filter, apply_filter, build_search_tags
 import configparser
 import sys
 
 import booru_api
+import bandwidth
+import metrics
+import ui_events
 
 def get_base_path():
     if getattr(sys, 'frozen', False):
@@ -71,159 +83,343 @@ for h in logger.handlers[:]:
     logger.removeHandler(h)
 logger.addHandler(handler)
 
-def run_script(booru_type, tag, limit, multithread=False, max_workers=None):
-    # Error feedback for GUI
-    import queue
-    error_queue = None
-    try:
-        from gui import error_queue as gui_error_queue
-        error_queue = gui_error_queue
-    except Exception:
-        error_queue = None
+def run_script(booru_type, tag, limit, multithread=False, max_workers=None, org_method=None, post_filter=None, variant='original', hedge=None, fsync_policy=None, resume=False, progress_callback=None, hash_index=None, cancel_event=None, first_page=0, page_size=None, claims=None, max_bandwidth=None, hash_algorithm=None, profile=None):
     # Load user settings
     user_settings = load_user_settings()
+    if hedge is None:
+        hedge = user_settings.get('hedge', False)
     output_dir = os.path.join("images", booru_type)
     os.makedirs(output_dir, exist_ok=True)
+    # Compile up front so an invalid filter fails before any request is made
+    compiled_filter = compile_filter(post_filter)
+    parse_variant(variant)
+    hash_algorithm = check_algorithm(hash_algorithm or user_settings.get('hash_algorithm', 'md5'))
+    # The cap is process-wide; the daemon sets it once for all of its jobs instead
+    if max_bandwidth is not None:
+        bandwidth.limiter.set_rate(bandwidth.parse_bandwidth(max_bandwidth))
+    if bandwidth.limiter.rate:
+        logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Bandwidth cap: {bandwidth.format_bandwidth(bandwidth.limiter.rate)}")
+
+    # Every job is journaled so an interrupted run can continue with resume=True
+    job_params = {
+        'booru_type': booru_type, 'tag': tag, 'limit': limit, 'org_method': org_method,
+        'post_filter': compiled_filter.expression, 'variant': variant
+    }
+    if first_page or page_size:
+        # A shard of a larger job covers its own slice of pages
+        job_params['first_page'] = first_page
+        job_params['page_size'] = page_size
+    if hash_algorithm != 'md5':
+        # Journaled digests and the hash snapshot are only valid for the algorithm that made them
+        job_params['hash_algorithm'] = hash_algorithm
+    # profile=True writes a report to profiles/<timestamp>_<booru>/, a string picks the report directory
+    profiler = RunProfiler(profile if isinstance(profile, str) else None, label=booru_type) if profile else NULL_PROFILER
+    import concurrent.futures
+    profiler.start()
+    # Everything the job opens is registered here and closed in reverse order, also when setup fails
+    resources = contextlib.ExitStack()
+    completed = False
+    existing_hashes = None
+    executor = None
+
+    def close_job():
+        try:
+            with profiler.phase('finish'):
+                resources.close()
+        finally:
+            profiler.stop()
+
+    def close_job_hashes():
+        # Unmap the job's hash snapshot before the journal deletes it; a shared index stays open
+        if existing_hashes is not None and hash_index is None:
+            existing_hashes.close()
+
+    try:
+        with profiler.phase('setup'):
+            journal = JobJournal(output_dir, job_params)
+            resources.callback(lambda: journal.finish() if completed else journal.close())
+            resources.callback(close_job_hashes)
+            resources.callback(bandwidth.limiter.forget, journal.job_id)
+            resumed = journal.start(resume=resume)
+            # Normalized metadata of every file that reaches the disk is batched into the library catalog;
+            # it is closed after the writer, whose last completed writes still add to it
+            catalog = Catalog(output_dir)
+            resources.callback(catalog.close)
+            # Disk writes, renames and directory creation happen on a separate write-behind stage
+            writer = WriteBehindWriter(
+                num_threads=user_settings.get('writer_threads', 2),
+                max_pending_bytes=user_settings.get('write_queue_mb', 256) * 1024 * 1024,
+                fsync_policy=fsync_policy or user_settings.get('fsync_policy', 'batch')
+            )
+            # Wait for queued writes and make the last fsync batch durable
+            resources.callback(writer.close)
+            # Large downloads are spilled here; files left by a crashed run are cleaned up
+            spill_dir = os.path.join(output_dir, SPILL_DIRNAME)
+            remove_stale_spills(spill_dir)
+            if multithread:
+                workers = max_workers if max_workers is not None else os.cpu_count() // 2 or 1
+                logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Using multithreaded download with {workers} workers.")
+                executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+                resources.callback(executor.shutdown, wait=True)
+    except BaseException:
+        close_job()
+        raise
+    if resumed:
+        logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Resuming job {journal.job_id}: {len(journal.pages)} pages fetched, {len(journal.post_states)} posts recorded.")
 
     import time
     max_retries = 5
     backoff = 2
-    attempt = 0
-    posts = None
-    while attempt < max_retries:
-        try:
-            posts = fetch_booru_posts(booru_type, tags=tag, limit=limit)
-            break
-        except Exception as e:
-            err_str = str(e).lower()
-            if ("429" in err_str or "rate limit" in err_str or "422" in err_str) and booru_type == "danbooru":
-                wait_time = backoff ** attempt
-                msg = f"Rate limit encountered ({e}). Retrying in {wait_time} seconds. Attempt {attempt+1}/{max_retries}."
-                logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] {msg}")
-                logging.getLogger("gui").warning(f"[gui.rate_limit] {msg}")
-                if error_queue:
-                    error_queue.put(msg)
-                time.sleep(wait_time)
-                attempt += 1
-                continue
-            else:
-                msg = f"Error fetching posts from {booru_type}: {e}"
-                logging.getLogger("rulescrape").error(f"[rulescrape.run_script] {msg}")
-                if error_queue:
-                    error_queue.put(msg)
-                return
-    if posts is None:
-        msg = f"Failed to fetch posts from {booru_type} after {max_retries} retries due to rate limiting or errors."
-        logging.getLogger("rulescrape").error(f"[rulescrape.run_script] {msg}")
-        logging.getLogger("gui").error(f"[gui.rate_limit] {msg}")
-        if error_queue:
-            error_queue.put(msg)
-        return
-
-    if not posts:
-        msg = f"No posts returned from {booru_type} for tag '{tag}' and limit {limit}. Possible reasons: no results, API error, or invalid query."
-        logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] {msg}")
-        if error_queue:
-            error_queue.put(msg)
-        return
-
-    valid_images_processed = 0
-
-    import hashlib
-    def md5sum(filepath):
-        hash_md5 = hashlib.md5()
-        try:
-            with open(filepath, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
-                    hash_md5.update(chunk)
-            return hash_md5.hexdigest()
-        except Exception:
-            return None
-
-    # Build a set of existing image hashes in output_dir
-    existing_hashes = set()
-    for root, dirs, files in os.walk(output_dir):
-        for file in files:
-            if file.lower().endswith((".jpg", ".jpeg", ".png", ".gif", ".webm", ".mp4")):
-                path = os.path.join(root, file)
-                h = md5sum(path)
-                if h:
-                    existing_hashes.add(h)
 
+    def fetch_page(page, page_size):
+        # Raises once the page cannot be fetched, so it is neither journaled nor taken for the last page
+        attempt = 0
+        while True:
+            try:
+                with profiler.phase('fetch_posts'):
+                    return fetch_booru_posts(booru_type, tags=tag, limit=page_size, page=page)
+            except Exception as e:
+                err_str = str(e).lower()
+                if ("429" in err_str or "rate limit" in err_str or "422" in err_str) and booru_type == "danbooru" and attempt + 1 < max_retries:
+                    wait_time = backoff ** attempt
+                    msg = f"Rate limit encountered ({e}). Retrying in {wait_time} seconds. Attempt {attempt+1}/{max_retries}."
+                    logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] {msg}")
+                    logging.getLogger("gui").warning(f"[gui.rate_limit] {msg}")
+                    ui_events.events.post('warning', msg)
+                    time.sleep(wait_time)
+                    attempt += 1
+                    continue
+                if attempt:
+                    msg = f"Failed to fetch posts from {booru_type} after {max_retries} retries due to rate limiting: {e}"
+                    logging.getLogger("gui").error(f"[gui.rate_limit] {msg}")
+                else:
+                    msg = f"Error fetching posts from {booru_type}: {e}"
+                logging.getLogger("rulescrape").error(f"[rulescrape.run_script] {msg}")
+                ui_events.events.post('error', msg)
+                raise
+
+    def build_existing_hashes():
+        with profiler.phase('hash_scan'):
+            return load_existing_hashes()
+
+    def load_existing_hashes():
+        # A daemon passes in its resident index, which is shared and kept up to date across jobs
+        if hash_index is not None:
+            hash_index.update(journal.done_hashes)
+            return hash_index
+        # A resumed job reuses the snapshot taken when it started instead of re-hashing the library
+        if resumed:
+            snapshot = journal.load_hashes()
+            if snapshot is not None:
+                logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Loaded {len(snapshot)} library hashes from the job journal.")
+                snapshot.update(journal.done_hashes)
+                return snapshot
+        started = time.monotonic()
+        hashes = scan_library_hashes(output_dir, algorithm=hash_algorithm, processes=user_settings.get('hash_processes') or None)
+        logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Hashed {len(hashes)} library files with {hash_algorithm} in {time.monotonic() - started:.2f}s.")
+        journal.save_hashes(hashes)
+        hashes.update(journal.done_hashes)
+        return hashes
 
     downloaded_files = set()
 
     def process_post(post):
-        image_url = post.get('file_url')
+        if cancel_event is not None and cancel_event.is_set():
+            return False
+        variant_name, image_url = select_variant(post, variant)
         if not image_url or not image_url.startswith(('http://', 'https://')):
             msg = f"Skipping invalid post: {post}"
             logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] {msg}")
-            if error_queue:
-                error_queue.put(msg)
+            ui_events.events.post('skipped', msg)
+            metrics.increment('posts_skipped')
+            journal.record_post(post, 'skipped', reason="invalid file URL")
+            return False
+        # Shards of one job share claims, so a post that shows up on two pages is fetched once
+        if claims is not None and not claims.claim_post(post):
+            logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Post ID {post['id']} is handled by another shard, skipping.")
+            metrics.increment('posts_claimed_elsewhere')
+            journal.record_post(post, 'skipped', reason="claimed by another shard")
             return False
 
         filename_part = image_url.split('/')[-1].split('?')[0]
         _, ext = os.path.splitext(filename_part)
-        filename = os.path.join(output_dir, f"post_{post['id']}{ext if ext else '.jpg'}")
+        dest_dir = get_dest_dir(post, output_dir, org_method, ext=ext) if org_method else output_dir
+        # Files are keyed by post ID and variant, so an original and its sample can coexist
+        basename = get_variant_basename(post, variant_name)
+        filename = os.path.join(dest_dir, f"{basename}{ext if ext else '.jpg'}")
+        if os.path.exists(filename):
+            logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Already downloaded, skipping: {filename}")
+            ui_events.events.post('present', f"Already downloaded, skipping: {filename}")
+            metrics.increment('posts_already_present')
+            journal.record_post(post, 'present')
+            return False
+
+        # With md5 as the library hash, a post whose API-reported md5 is already known is skipped before any bytes are fetched
+        api_md5 = normalize_post(post)['md5'] if variant_name == 'original' else None
+        if api_md5 and not re.fullmatch(r"[0-9a-fA-F]{32}", api_md5):
+            api_md5 = None
+        if api_md5 and hash_algorithm == 'md5' and api_md5.lower() in existing_hashes:
+            logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Post ID {post['id']} has a known md5, skipping: {filename}")
+            ui_events.events.post('duplicate', f"Post ID {post['id']} has a known md5, skipping: {filename}")
+            metrics.increment('posts_duplicate')
+            metrics.increment('posts_duplicate_before_fetch')
+            journal.record_post(post, 'duplicate')
+            return False
 
-        temp_filename = filename + ".tmp"
         success = False
+        body = None
         try:
-            download_image(post, image_url, output_dir)
-            if os.path.exists(filename) and os.path.getsize(filename) > 0:
-                os.rename(filename, temp_filename)
-                file_hash = md5sum(temp_filename)
-                if file_hash in existing_hashes:
+            body, content_type = fetch_image(image_url, hedge=hedge, desc=basename, job=journal.job_id, spill_dir=spill_dir)
+            if body:
+                filename = os.path.join(dest_dir, f"{basename}{get_image_extension(image_url, content_type)}")
+                # Hash the buffers before anything touches the disk, so duplicates are never written.
+                # md5 is also computed when the API reported one, to catch corrupted transfers.
+                algorithms = [hash_algorithm] + (['md5'] if api_md5 and hash_algorithm != 'md5' else [])
+                digests = hash_buffers(body, algorithms)
+                file_hash = digests[hash_algorithm]
+                file_md5 = digests.get('md5')
+                if api_md5 and file_md5 and file_md5 != api_md5.lower():
+                    logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] md5 of post ID {post['id']} is {file_md5}, but the API reported {api_md5}.")
+                    metrics.increment('md5_mismatches')
+                # add() checks and inserts atomically, so two workers fetching the same image cannot both keep it
+                if not existing_hashes.add(file_hash) or (claims is not None and not claims.claim_hash(file_hash, post)):
                     msg = f"Duplicate image hash detected, skipping: {filename}"
                     logging.getLogger("rulescrape").info(f"[rulescrape.run_script] {msg}")
-                    if error_queue:
-                        error_queue.put(msg)
-                    os.remove(temp_filename)
+                    ui_events.events.post('duplicate', msg)
+                    metrics.increment('posts_duplicate')
+                    journal.record_post(post, 'duplicate')
+                    body.discard()
                     return False
-                else:
-                    os.rename(temp_filename, filename)
-                    existing_hashes.add(file_hash)
-                    success = True
+                journal.record_post(post, 'queued')
+                # The post only counts as done in the journal once its file is on disk
+                writer.write(
+                    filename, body,
+                    on_error=lambda path, e: (existing_hashes.discard(file_hash), claims is not None and claims.release_hash(file_hash, post), journal.record_post(post, 'failed', reason=f"write failed: {e}")),
+                    on_done=lambda path: (journal.record_post(post, 'done', md5=file_hash), catalog.add(post, path=path, variant=variant_name, file_md5=file_md5))
+                )
+                success = True
         except Exception as e:
+            if body is not None:
+                body.discard()
             msg = f"Error downloading image from {image_url}: {e}"
             logging.getLogger("rulescrape").error(f"[rulescrape.run_script] {msg}")
-            if error_queue:
-                error_queue.put(msg)
-            if os.path.exists(temp_filename):
-                os.remove(temp_filename)
+            ui_events.events.post('error', msg)
+            metrics.increment('posts_failed')
+            journal.record_post(post, 'failed', reason=str(e))
             return False
 
         if success:
             downloaded_files.add(filename)
+            save_post_metadata(output_dir, post, writer=writer)
+            metrics.increment('posts_downloaded')
             return True
+        metrics.increment('posts_failed')
+        journal.record_post(post, 'failed', reason="empty response")
         return False
 
-    if multithread:
-        import concurrent.futures
-        workers = max_workers if max_workers is not None else os.cpu_count() // 2 or 1
-        logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Using multithreaded download with {workers} workers.")
-        valid_images_processed = 0
-        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
-            futures = []
+    # A resumed job counts the posts it already finished towards the limit
+    valid_images_processed = sum(1 for state in journal.post_states.values() if state == 'done')
+    total = limit
+
+    def process_posts(posts, executor):
+        nonlocal valid_images_processed
+        if executor is not None:
+            # Only as many posts are in flight as images are still needed; a failed or skipped
+            # post makes room for the next one, so nothing past the limit is downloaded
+            remaining = iter(posts)
+            in_flight = set()
+            while True:
+                while valid_images_processed + len(in_flight) < limit:
+                    post = next(remaining, None)
+                    if post is None:
+                        break
+                    in_flight.add(executor.submit(process_post, post))
+                if not in_flight:
+                    break
+                done, in_flight = concurrent.futures.wait(in_flight, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.result():
+                        valid_images_processed += 1
+                        if progress_callback:
+                            progress_callback(valid_images_processed, total)
+        else:
             for post in posts:
                 if valid_images_processed >= limit:
+                    logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Reached limit of {limit} valid images. Stopping.")
                     break
-                future = executor.submit(process_post, post)
-                futures.append(future)
-            for future in concurrent.futures.as_completed(futures):
-                if future.result():
+                if process_post(post):
                     valid_images_processed += 1
-                if valid_images_processed >= limit:
-                    break
-    else:
-        for post in posts:
+                    if progress_callback:
+                        progress_callback(valid_images_processed, total)
+
+    # Large jobs are fetched page by page; the journal records each page as the cursor.
+    # A page is never larger than the site returns, so a short page really is the last one.
+    page_size = min(page_size or limit, get_max_page_size(booru_type))
+    num_pages = -(-limit // page_size) if page_size > 0 else 0
+    last_page = first_page + num_pages
+    fetched_count = 0
+    kept_count = 0
+    try:
+        if journal.retry_posts:
+            logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Retrying {len(journal.retry_posts)} failed posts from the job journal.")
+            existing_hashes = build_existing_hashes()
+            with profiler.phase('download'):
+                process_posts(list(journal.retry_posts.values()), executor)
+        # A finished job being resumed only retries its failed posts
+        for page in range(last_page if journal.finished else first_page, last_page):
             if valid_images_processed >= limit:
-                logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Reached limit of {limit} valid images. Stopping.")
                 break
-            if process_post(post):
-                valid_images_processed += 1
+            if cancel_event is not None and cancel_event.is_set():
+                # Left unfinished in the journal so the job can be resumed later
+                logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Job {journal.job_id} cancelled.")
+                return valid_images_processed
+            if page in journal.pages:
+                page_posts = journal.pages[page]
+            else:
+                page_posts = fetch_page(page, page_size)
+                journal.record_page(page, page_posts)
+
+            if page == 0 and not page_posts:
+                msg = f"No posts returned from {booru_type} for tag '{tag}' and limit {limit}. Possible reasons: no results, API error, or invalid query."
+                logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] {msg}")
+                ui_events.events.post('warning', msg)
+                completed = True
+                return 0
+            fetched_count += len(page_posts)
+
+            # Drop posts rejected by the client-side filter before any bytes are fetched
+            posts = page_posts
+            if compiled_filter:
+                with profiler.phase('filter'):
+                    posts = apply_filter(page_posts, compiled_filter)
+                logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Filter '{compiled_filter.expression}' kept {len(posts)} of {len(page_posts)} posts.")
+            kept_count += len(posts)
+            # Posts finished by an earlier run of this job are not tried again
+            pending = [post for post in posts if not journal.is_settled(post)]
+            total = min(limit, valid_images_processed + len(pending) + (last_page - page - 1) * page_size)
+            if progress_callback:
+                progress_callback(valid_images_processed, total)
+            if pending and existing_hashes is None:
+                existing_hashes = build_existing_hashes()
+            with profiler.phase('download'):
+                process_posts(pending, executor)
+            if cancel_event is not None and cancel_event.is_set():
+                logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Job {journal.job_id} cancelled.")
+                return valid_images_processed
+            journal.record_page_done(page)
+            if len(page_posts) < page_size:
+                break
+        if compiled_filter and fetched_count and not kept_count:
+            msg = f"All {fetched_count} posts from {booru_type} were rejected by the filter '{compiled_filter.expression}'."
+            logging.getLogger("rulescrape").warning(f"[rulescrape.run_script] {msg}")
+            ui_events.events.post('warning', msg)
+        completed = True
+    finally:
+        close_job()
 
     logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Downloaded {valid_images_processed} images from {booru_type}.")
+    logging.getLogger("rulescrape").info(f"[rulescrape.run_script] Metrics: {metrics.format_metrics()}")
+    return valid_images_processed
 
 def load_user_settings():
     import multiprocessing
@@ -238,6 +434,17 @@ def load_user_settings():
         'multithread': False,
         'org_method': 'By extension and first tag',
         'max_workers': default_workers,
+        'post_filter': '',
+        'variant': 'original',
+        'hedge': False,
+        'writer_threads': 2,
+        'write_queue_mb': 256,
+        'fsync_policy': 'batch',
+        'hash_algorithm': 'md5',
+        'hash_processes': 0,
+        'use_daemon': False,
+        'daemon_url': 'http://127.0.0.1:8675',
+        'max_bandwidth': '0',
         'skin': None,
         'window_width': 400,
         'window_height': 320
@@ -253,6 +460,21 @@ def load_user_settings():
             settings['multithread'] = config['Settings'].getboolean('multithread', settings['multithread'])
             settings['org_method'] = config['Settings'].get('org_method', settings['org_method'])
             settings['max_workers'] = config['Settings'].getint('max_workers', settings['max_workers'])
+            settings['variant'] = config['Settings'].get('variant', settings['variant'])
+            settings['hedge'] = config['Settings'].getboolean('hedge', settings['hedge'])
+        if 'Filter' in config:
+            settings['post_filter'] = config['Filter'].get('expression', settings['post_filter'])
+        if 'Disk' in config:
+            settings['writer_threads'] = config['Disk'].getint('writer_threads', settings['writer_threads'])
+            settings['write_queue_mb'] = config['Disk'].getint('write_queue_mb', settings['write_queue_mb'])
+            settings['fsync_policy'] = config['Disk'].get('fsync_policy', settings['fsync_policy'])
+            settings['hash_algorithm'] = config['Disk'].get('hash_algorithm', settings['hash_algorithm'])
+            settings['hash_processes'] = config['Disk'].getint('hash_processes', settings['hash_processes'])
+        if 'Daemon' in config:
+            settings['use_daemon'] = config['Daemon'].getboolean('use_daemon', settings['use_daemon'])
+            settings['daemon_url'] = config['Daemon'].get('url', settings['daemon_url'])
+        if 'Network' in config:
+            settings['max_bandwidth'] = config['Network'].get('max_bandwidth', settings['max_bandwidth'])
         if 'UI' in config:
             settings['skin'] = config['UI'].get('skin', settings['skin'])
             settings['window_width'] = config['UI'].getint('window_width', settings['window_width'])
@@ -261,7 +483,7 @@ def load_user_settings():
     return default_settings
 
 
-def save_user_settings(booru_type, tag, limit, anti_ai, multithread, org_method, skin=None, window_width=400, window_height=320):
+def save_user_settings(booru_type, tag, limit, anti_ai, multithread, org_method, skin=None, window_width=400, window_height=320, post_filter=None, variant=None, hedge=None, fsync_policy=None, max_bandwidth=None, hash_algorithm=None):
     # Always update config file with latest settings
     import configparser
     config = configparser.ConfigParser()
@@ -270,11 +492,42 @@ def save_user_settings(booru_type, tag, limit, anti_ai, multithread, org_method,
     cpu_threads = multiprocessing.cpu_count()
     default_workers = max(1, cpu_threads // 2)
     prev_max_workers = default_workers
+    prev_post_filter = ''
+    prev_variant = 'original'
+    prev_hedge = False
+    prev_disk = {'writer_threads': '2', 'write_queue_mb': '256', 'fsync_policy': 'batch', 'hash_algorithm': 'md5', 'hash_processes': '0'}
+    prev_daemon = {'use_daemon': 'False', 'url': 'http://127.0.0.1:8675'}
+    prev_max_bandwidth = '0'
     if os.path.exists(CONFIG_FILE):
         prev_config = configparser.ConfigParser()
         prev_config.read(CONFIG_FILE)
         if 'Settings' in prev_config:
             prev_max_workers = prev_config['Settings'].get('max_workers', str(default_workers))
+            prev_variant = prev_config['Settings'].get('variant', prev_variant)
+            prev_hedge = prev_config['Settings'].getboolean('hedge', prev_hedge)
+        if 'Filter' in prev_config:
+            prev_post_filter = prev_config['Filter'].get('expression', '')
+        if 'Disk' in prev_config:
+            for key in prev_disk:
+                prev_disk[key] = prev_config['Disk'].get(key, prev_disk[key])
+        if 'Daemon' in prev_config:
+            for key in prev_daemon:
+                prev_daemon[key] = prev_config['Daemon'].get(key, prev_daemon[key])
+        if 'Network' in prev_config:
+            prev_max_bandwidth = prev_config['Network'].get('max_bandwidth', prev_max_bandwidth)
+    # Keep the stored filter, variant and hedge settings unless new ones are given
+    if post_filter is None:
+        post_filter = prev_post_filter
+    if variant is None:
+        variant = prev_variant
+    if hedge is None:
+        hedge = prev_hedge
+    if fsync_policy is None:
+        fsync_policy = prev_disk['fsync_policy']
+    if hash_algorithm is None:
+        hash_algorithm = prev_disk['hash_algorithm']
+    if max_bandwidth is None:
+        max_bandwidth = prev_max_bandwidth
 
     # Write config with comments above each setting
     # Prevent placeholder tag from being saved
@@ -295,6 +548,37 @@ def save_user_settings(booru_type, tag, limit, anti_ai, multithread, org_method,
         f"org_method = {org_method}",
         "# Number of threads for multithreaded downloads",
         f"max_workers = {prev_max_workers}",
+        "# Image variant to download: original, sample, preview, or min:<pixels> for the smallest variant at least that large",
+        f"variant = {variant}",
+        "# Race a second request against transfers that fall far behind the median rate (True/False)",
+        f"hedge = {hedge}",
+        "",
+        "[Filter]",
+        "# Client-side filter applied to post metadata before downloading",
+        "# e.g. cat_girl -ai_generated rating:s,q score>=10 width>=1000 size<=5MB ext:jpg,png",
+        f"expression = {post_filter}",
+        "",
+        "[Disk]",
+        "# Number of write-behind threads that write downloaded files to disk",
+        f"writer_threads = {prev_disk['writer_threads']}",
+        "# Downloaded data (MB) allowed to wait for the disk before downloads pause",
+        f"write_queue_mb = {prev_disk['write_queue_mb']}",
+        "# When to fsync written files: none, file (every file) or batch (groups of files)",
+        f"fsync_policy = {fsync_policy}",
+        "# Hash used to recognise duplicate files: md5, blake2b, xxh128 (needs xxhash) or blake3 (needs blake3)",
+        f"hash_algorithm = {hash_algorithm}",
+        "# Processes used to hash the library when a job starts (0 = one per CPU)",
+        f"hash_processes = {prev_disk['hash_processes']}",
+        "",
+        "[Daemon]",
+        "# Send GUI downloads to a running 'rulescrape.py daemon' instead of downloading in the GUI (True/False)",
+        f"use_daemon = {prev_daemon['use_daemon']}",
+        "# Address of the daemon's JSON API",
+        f"url = {prev_daemon['url']}",
+        "",
+        "[Network]",
+        "# Download bandwidth cap shared by all downloads, e.g. 500KB or 2MB (per second); 0 = unlimited",
+        f"max_bandwidth = {max_bandwidth}",
         "",
         "[UI]",
         "# Skin/theme file for GUI",
@@ -313,6 +597,9 @@ def save_user_settings(booru_type, tag, limit, anti_ai, multithread, org_method,
 
 
 if __name__ == "__main__":
+    # Frozen builds: process-pool children (shard workers, library hashing) re-enter here and must run their task
+    import multiprocessing
+    multiprocessing.freeze_support()
     import argparse
     parser = argparse.ArgumentParser(description="rulescrape: Download images from booru sites via CLI or GUI.")
     parser.add_argument('--booru_type', type=str, help='Booru type (e.g. rule34, danbooru, etc.)')
@@ -322,15 +609,134 @@ if __name__ == "__main__":
     parser.add_argument('--multithread', action='store_true', help='Enable multithreaded downloads')
     parser.add_argument('--max_workers', type=int, help='Number of threads/workers for multithreaded downloads')
     parser.add_argument('--org_method', type=str, help='Organization method for images')
+    parser.add_argument('--variant', type=str, help='Image variant to download: original, sample, preview, or min:<pixels>')
+    parser.add_argument('--hedge', action='store_true', help='Hedge slow transfers with a second request')
+    parser.add_argument('--fsync_policy', type=str, choices=FSYNC_POLICIES, help='When to fsync written files: none, file or batch')
+    parser.add_argument('--hash_algorithm', type=str, choices=HASH_ALGORITHMS, help='Hash used to recognise duplicate files (default: md5)')
+    parser.add_argument('--max_bandwidth', type=str, help='Download bandwidth cap per second, e.g. 500KB or 2MB; 0 = unlimited')
+    parser.add_argument('--resume', action='store_true', help='Resume the interrupted job with the same settings from its journal')
+    parser.add_argument('--record', type=str, metavar='CASSETTE_DIR', help='Record every API and image response (headers, body, timing) into a cassette directory')
+    parser.add_argument('--replay', type=str, metavar='CASSETTE_DIR', help='Serve API and image requests from a recorded cassette instead of the network')
+    parser.add_argument('--latency_scale', type=float, default=1.0, help='Multiplier for recorded latencies during --replay; 0 replays as fast as possible (default: 1.0)')
+    parser.add_argument('--profile', nargs='?', const=True, metavar='REPORT_DIR', help='Profile the run per phase (cProfile, stack samples, tracemalloc); the report goes to REPORT_DIR or profiles/<timestamp>_<booru>/')
+    parser.add_argument('--filter', type=str, dest='post_filter', help="Client-side post filter, e.g. \"-ai_generated rating:s score>=10 ext:jpg,png\"")
     parser.add_argument('--skin', type=str, help='Skin file to use for GUI')
     parser.add_argument('--window_width', type=int, help='Window width for GUI')
     parser.add_argument('--window_height', type=int, help='Window height for GUI')
     parser.add_argument('--cli', action='store_true', help='Force CLI mode (do not launch GUI)')
+    subparsers = parser.add_subparsers(dest='command')
+    reorganize_parser = subparsers.add_parser('reorganize', help='Re-lay out an existing library into another organization method without re-downloading')
+    reorganize_parser.add_argument('--booru_type', type=str, help='Booru library to reorganize (images/<booru_type>/)')
+    reorganize_parser.add_argument('--org_method', type=str, required=True, help='Target organization method')
+    reorganize_parser.add_argument('--link', action='store_true', help='Create hardlinks in the new layout instead of moving files')
+    reorganize_parser.add_argument('--dry_run', action='store_true', help='Print the planned moves without touching any files')
+    reorganize_parser.add_argument('--max_workers', type=int, help='Number of threads used to move files')
+    reorganize_parser.add_argument('--offline', action='store_true', help='Do not look up posts on the site for files without stored metadata; they are left in place')
+    catalog_parser = subparsers.add_parser('catalog', help='Query or export the catalog of downloaded posts')
+    catalog_parser.add_argument('--booru_type', type=str, help='Booru library to query (images/<booru_type>/)')
+    catalog_parser.add_argument('--query', type=str, default='', help="Tag query, e.g. \"cat_girl solo -ai_generated ~blue_eyes ~green_eyes rating:s\"")
+    catalog_parser.add_argument('--export', type=str, help='Write the matching posts to a .csv, .json or .jsonl file instead of printing their paths')
+    catalog_parser.add_argument('--limit', type=int, help='Maximum number of posts to return')
+    catalog_parser.add_argument('--rebuild', action='store_true', help='Rebuild the catalog from the stored post metadata first')
+    shard_parser = subparsers.add_parser('shard', help='Split one large job into page shards run by several processes or machines')
+    shard_parser.add_argument('--booru_type', type=str, help='Booru type (rule34, danbooru, safebooru)')
+    shard_parser.add_argument('--tag', type=str, help='Tag to search for')
+    shard_parser.add_argument('--limit', type=int, help='Total number of posts for the whole job')
+    shard_parser.add_argument('--anti_ai', type=str, choices=['true', 'false'], help='Enable anti-AI tag filtering (true/false)')
+    shard_parser.add_argument('--org_method', type=str, help='Organization method for downloaded files')
+    shard_parser.add_argument('--filter', type=str, dest='post_filter', help='Client-side post filter')
+    shard_parser.add_argument('--variant', type=str, help='Download variant: original, sample, preview or min:<pixels>')
+    shard_parser.add_argument('--processes', type=int, default=2, help='Worker processes to start on this machine (default: 2)')
+    shard_parser.add_argument('--queue', type=str, help='Shared work-queue file; point workers on other machines at the same file')
+    shard_parser.add_argument('--lease_seconds', type=int, default=300, help='Seconds before a page held by a dead worker is handed out again')
+    shard_parser.add_argument('--multithread', action='store_true', help='Use multithreaded downloads inside each worker')
+    shard_parser.add_argument('--max_workers', type=int, help='Download threads per worker process')
+    shard_parser.add_argument('--status', action='store_true', help='Print the progress of the sharded job and exit')
+    daemon_parser = subparsers.add_parser('daemon', help='Run a headless daemon that accepts download jobs over a local JSON API')
+    daemon_parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    daemon_parser.add_argument('--port', type=int, default=8675, help='Port to listen on (default: 8675)')
+    daemon_parser.add_argument('--socket', type=str, help='Listen on this Unix socket instead of a TCP port')
+    daemon_parser.add_argument('--max_jobs', type=int, default=1, help='Number of jobs to run at the same time')
+    daemon_parser.add_argument('--max_bandwidth', type=str, help='Bandwidth cap shared by all jobs, e.g. 2MB; adjustable at runtime via POST /bandwidth')
     args = parser.parse_args()
 
+    if args.command == 'daemon':
+        from daemon import serve
+        max_bandwidth = args.max_bandwidth if args.max_bandwidth is not None else load_user_settings().get('max_bandwidth', '0')
+        try:
+            max_bandwidth = bandwidth.parse_bandwidth(max_bandwidth)
+        except ValueError as e:
+            parser.error(str(e))
+        serve(host=args.host, port=args.port, socket_path=args.socket, max_jobs=args.max_jobs, max_bandwidth=max_bandwidth)
+        sys.exit(0)
+
+    if args.command == 'shard':
+        from shards import ShardQueue, run_sharded_job, get_shard_queue_path
+        settings = load_user_settings()
+        anti_ai = args.anti_ai.lower() == 'true' if args.anti_ai is not None else settings.get('anti_ai', False)
+        job = {
+            'booru_type': args.booru_type or settings.get('booru_type', 'rule34'),
+            'tag': build_search_tags(args.tag if args.tag is not None else settings.get('tag', ''), anti_ai),
+            'limit': args.limit if args.limit is not None else settings.get('limit', 10),
+            'org_method': args.org_method or settings.get('org_method', 'By extension and first tag'),
+            'post_filter': args.post_filter if args.post_filter is not None else settings.get('post_filter', ''),
+            'variant': args.variant or settings.get('variant', 'original')
+        }
+        try:
+            compile_filter(job['post_filter'])
+            parse_variant(job['variant'])
+        except ValueError as e:
+            parser.error(str(e))
+        queue_path = args.queue or get_shard_queue_path(job['booru_type'], job)
+        if args.status:
+            print(f"[rulescrape] Shard status for {queue_path}: {ShardQueue(queue_path).status()}")
+            sys.exit(0)
+        downloaded = run_sharded_job(job, processes=args.processes, queue_path=queue_path, lease_seconds=args.lease_seconds, multithread=args.multithread, max_workers=args.max_workers)
+        print(f"[rulescrape] Sharded job downloaded {downloaded} images on this machine. Queue: {queue_path}")
+        sys.exit(0)
+
+    if args.command == 'catalog':
+        from catalog import Catalog, rebuild_catalog, export_rows
+        settings = load_user_settings()
+        booru_type = args.booru_type or settings.get('booru_type', 'rule34')
+        if args.rebuild:
+            print(f"[rulescrape] Catalog rebuilt with {rebuild_catalog(booru_type)} posts.")
+        try:
+            rows = Catalog(os.path.join("images", booru_type)).query(args.query, limit=args.limit)
+            if args.export:
+                export_rows(rows, args.export)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.export:
+            print(f"[rulescrape] Exported {len(rows)} posts to {args.export}")
+        else:
+            for row in rows:
+                print(os.path.join("images", booru_type, row['path']) if row['path'] else f"post {row['id']} (no file)")
+            print(f"[rulescrape] {len(rows)} posts match '{args.query}'.")
+        sys.exit(0)
+
+    if args.command == 'reorganize':
+        from library import reorganize
+        settings = load_user_settings()
+        booru_type = args.booru_type or settings.get('booru_type', 'rule34')
+        max_workers = args.max_workers if args.max_workers is not None else settings.get('max_workers', None)
+        try:
+            results, moves = reorganize(booru_type, args.org_method, link=args.link, dry_run=args.dry_run, max_workers=max_workers, fetch_missing=not args.offline)
+        except ValueError as e:
+            parser.error(str(e))
+        if args.dry_run:
+            for src, dest in moves:
+                print(f"{src} -> {dest}")
+        print(f"[rulescrape] Reorganize {'plan' if args.dry_run else 'result'} for {booru_type}: {results}")
+        if results.get('conflict'):
+            print(f"[rulescrape] {results['conflict']} files were left in place because another file already has their destination.")
+        if results.get('missing_metadata'):
+            print(f"[rulescrape] {results['missing_metadata']} files have no stored metadata" + (" (run without --offline to look them up on the site)" if args.offline else " and could not be found on the site") + "; they were left in place.")
+        sys.exit(0)
+
     # If any CLI-relevant argument is provided or --cli is set, run in CLI mode
     cli_mode = args.cli or any([
-        args.booru_type, args.tag, args.limit, args.anti_ai is not None, args.multithread, args.org_method, args.max_workers is not None
+        args.booru_type, args.tag, args.limit, args.anti_ai is not None, args.multithread, args.org_method, args.max_workers is not None, args.post_filter is not None, args.variant, args.hedge, args.fsync_policy, args.resume, args.max_bandwidth is not None, args.hash_algorithm, args.profile, args.record, args.replay
     ])
 
     if cli_mode:
@@ -350,11 +756,31 @@ if __name__ == "__main__":
         window_width = args.window_width if args.window_width is not None else settings.get('window_width', 400)
         window_height = args.window_height if args.window_height is not None else settings.get('window_height', 320)
         max_workers = args.max_workers if args.max_workers is not None else settings.get('max_workers', None)
+        post_filter = args.post_filter if args.post_filter is not None else settings.get('post_filter', '')
+        variant = args.variant or settings.get('variant', 'original')
+        hedge = args.hedge if args.hedge else settings.get('hedge', False)
+        fsync_policy = args.fsync_policy or settings.get('fsync_policy', 'batch')
+        max_bandwidth = args.max_bandwidth if args.max_bandwidth is not None else settings.get('max_bandwidth', '0')
+        hash_algorithm = args.hash_algorithm or settings.get('hash_algorithm', 'md5')
+        try:
+            compile_filter(post_filter)
+            parse_variant(variant)
+            # --fsync_policy is checked by argparse, a value from user_settings.config is not
+            check_fsync_policy(fsync_policy)
+            bandwidth.parse_bandwidth(max_bandwidth)
+            check_algorithm(hash_algorithm)
+            if args.record and args.replay:
+                raise ValueError("--record and --replay cannot be used together")
+            if args.record or args.replay:
+                import transport
+                transport.configure('record' if args.record else 'replay', args.record or args.replay, latency_scale=args.latency_scale)
+        except ValueError as e:
+            parser.error(str(e))
 
         # Save settings for future GUI use
         save_user_settings(
             booru_type, tag, limit, anti_ai, multithread, org_method,
-            skin=skin, window_width=window_width, window_height=window_height
+            skin=skin, window_width=window_width, window_height=window_height, post_filter=post_filter, variant=variant, hedge=hedge, fsync_policy=fsync_policy, max_bandwidth=max_bandwidth, hash_algorithm=hash_algorithm
         )
         # If max_workers is specified, update config file directly
         if max_workers is not None:
@@ -368,8 +794,8 @@ if __name__ == "__main__":
                 config.write(configfile)
 
         cli_log = logging.getLogger("rulescrape")
-        cli_log.info(f"[CLI] Starting CLI mode: booru_type={booru_type}, tag={tag}, limit={limit}, anti_ai={anti_ai}, multithread={multithread}, max_workers={max_workers}")
-        print(f"[rulescrape] Running in CLI mode: booru_type={booru_type}, tag={tag}, limit={limit}, anti_ai={anti_ai}, multithread={multithread}, max_workers={max_workers}")
+        cli_log.info(f"[CLI] Starting CLI mode: booru_type={booru_type}, tag={tag}, limit={limit}, anti_ai={anti_ai}, multithread={multithread}, max_workers={max_workers}, filter='{post_filter}', variant={variant}, hedge={hedge}")
+        print(f"[rulescrape] Running in CLI mode: booru_type={booru_type}, tag={tag}, limit={limit}, anti_ai={anti_ai}, multithread={multithread}, max_workers={max_workers}, filter='{post_filter}', variant={variant}, hedge={hedge}")
 
         # Wrap run_script to add CLI log prefix to all log messages
         import functools
@@ -380,13 +806,22 @@ if __name__ == "__main__":
         cli_log.warning = lambda msg, *a, **kw: orig_warning(f"[CLI] {msg}", *a, **kw)
         cli_log.error = lambda msg, *a, **kw: orig_error(f"[CLI] {msg}", *a, **kw)
 
-        run_script(booru_type, tag, limit, multithread=multithread, max_workers=max_workers)
+        import requests
+        try:
+            run_script(booru_type, build_search_tags(tag, anti_ai), limit, multithread=multithread, max_workers=max_workers, org_method=org_method, post_filter=post_filter, variant=variant, hedge=hedge, fsync_policy=fsync_policy, resume=args.resume, max_bandwidth=max_bandwidth, hash_algorithm=hash_algorithm, profile=args.profile)
+        except (requests.RequestException, ValueError) as e:
+            # The job stays unfinished in its journal, so --resume picks it up again
+            cli_log.error = orig_error
+            orig_error(f"[CLI] Run failed: {e}")
+            print(f"[rulescrape] Run failed: {e}. Run again with --resume to continue the job.")
+            sys.exit(1)
 
         # Restore original log methods
         cli_log.info = orig_info
         cli_log.warning = orig_warning
         cli_log.error = orig_error
         cli_log.info(f"[CLI] Finished CLI run.")
+        print(f"[rulescrape] Metrics: {metrics.format_metrics()}")
     else:
         from gui import main_gui
         main_gui()
@@ -0,0 +1,256 @@
+import os
+import time
+import socket
+import contextlib
+import sqlite3
+import logging
+import threading
+
+import metrics
+from booru_api import get_max_page_size
+from journal import JOBS_DIRNAME, get_job_id
+
+# A leased page that is not renewed within this many seconds is handed to another worker
+DEFAULT_LEASE_SECONDS = 300
+
+# Work units are pages of the logical job; claims make sure a post or an image is only
+# downloaded by one shard even when the site's paging shifts between requests.
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS units (
+        page INTEGER PRIMARY KEY,
+        state TEXT NOT NULL DEFAULT 'queued',
+        owner TEXT,
+        lease_expires REAL,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        downloaded INTEGER NOT NULL DEFAULT 0
+    )""",
+    """CREATE TABLE IF NOT EXISTS post_claims (
+        post_id TEXT PRIMARY KEY,
+        page INTEGER NOT NULL
+    )""",
+    """CREATE TABLE IF NOT EXISTS hash_claims (
+        md5 TEXT PRIMARY KEY,
+        post_id TEXT NOT NULL
+    )"""
+]
+
+
+def get_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}:{threading.get_ident()}"
+
+
+def get_shard_queue_path(booru_type, job):
+    return os.path.join("images", booru_type, JOBS_DIRNAME, f"{get_job_id(job)}.shards.sqlite")
+
+
+class ShardQueue:
+    # Lease table and shared claims of one sharded job, kept in a SQLite file. Every process
+    # (or machine, with the file on a shared filesystem with working locks) opens the same file.
+    def __init__(self, path, owner=None):
+        self.path = path
+        self.owner = owner or get_worker_id()
+        self.page = None
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._local = threading.local()
+        self._conns = []
+        self._conns_lock = threading.Lock()
+        with self._transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    def _conn(self):
+        # Download threads claim posts concurrently, so each thread gets its own connection
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            self._local.conn = conn
+            with self._conns_lock:
+                self._conns.append(conn)
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        conn = self._conn()
+        # IMMEDIATE takes the write lock up front, so two workers never lease the same page
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def add_pages(self, num_pages):
+        with self._transaction() as conn:
+            conn.executemany("INSERT OR IGNORE INTO units (page) VALUES (?)", [(page,) for page in range(num_pages)])
+
+    def lease(self, lease_seconds=DEFAULT_LEASE_SECONDS):
+        # Returns the next queued (or abandoned) page, or None when no work is left
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT page FROM units WHERE state = 'queued' OR (state = 'leased' AND lease_expires < ?) ORDER BY page LIMIT 1",
+                (now,)
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE units SET state = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE page = ?",
+                (self.owner, now + lease_seconds, row[0])
+            )
+        self.page = row[0]
+        metrics.increment('shard_pages_leased')
+        return row[0]
+
+    def renew(self, page, lease_seconds=DEFAULT_LEASE_SECONDS):
+        # Returns False when the lease was lost (it expired and another worker took the page)
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE units SET lease_expires = ? WHERE page = ? AND owner = ? AND state = 'leased'",
+                (time.time() + lease_seconds, page, self.owner)
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, page, downloaded):
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE units SET state = 'done', lease_expires = NULL, downloaded = ? WHERE page = ? AND owner = ?",
+                (downloaded, page, self.owner)
+            )
+        metrics.increment('shard_pages_done')
+
+    def release(self, page):
+        # Hands an unfinished page back to the queue right away
+        with self._transaction() as conn:
+            conn.execute("UPDATE units SET state = 'queued', owner = NULL, lease_expires = NULL WHERE page = ? AND owner = ?", (page, self.owner))
+
+    def claim_post(self, post):
+        # A post belongs to the first page it was seen on; that page may re-process it after a crash
+        post_id = str(post['id'])
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO post_claims (post_id, page) VALUES (?, ?)", (post_id, self.page))
+            row = conn.execute("SELECT page FROM post_claims WHERE post_id = ?", (post_id,)).fetchone()
+        return row[0] == self.page
+
+    def claim_hash(self, md5, post):
+        post_id = str(post['id'])
+        with self._transaction() as conn:
+            conn.execute("INSERT OR IGNORE INTO hash_claims (md5, post_id) VALUES (?, ?)", (md5, post_id))
+            row = conn.execute("SELECT post_id FROM hash_claims WHERE md5 = ?", (md5,)).fetchone()
+        return row[0] == post_id
+
+    def release_hash(self, md5, post):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM hash_claims WHERE md5 = ? AND post_id = ?", (md5, str(post['id'])))
+
+    def status(self):
+        conn = self._conn()
+        counts = dict(conn.execute("SELECT state, COUNT(*) FROM units GROUP BY state").fetchall())
+        counts['downloaded'] = conn.execute("SELECT COALESCE(SUM(downloaded), 0) FROM units").fetchone()[0]
+        return counts
+
+    def close(self):
+        with self._conns_lock:
+            conns, self._conns = self._conns, []
+        for conn in conns:
+            conn.close()
+        self._local = threading.local()
+
+
+def run_shard_worker(job, queue_path=None, lease_seconds=DEFAULT_LEASE_SECONDS, multithread=False, max_workers=None, hash_snapshot=None):
+    # Leases pages of the job until none are left; returns the number of images this worker downloaded.
+    # hash_snapshot is a digest store saved by run_sharded_job; without it the worker scans the library itself.
+    from rulescrape import run_script
+    from rulescrape import load_user_settings
+    from digests import DigestStore
+    logger = logging.getLogger("shards")
+    booru_type, limit = job['booru_type'], job['limit']
+    page_size = min(limit, get_max_page_size(booru_type))
+    num_pages = -(-limit // page_size) if page_size > 0 else 0
+    queue_path = queue_path or get_shard_queue_path(booru_type, job)
+    claims = ShardQueue(queue_path)
+    claims.add_pages(num_pages)
+    hash_algorithm = load_user_settings().get('hash_algorithm', 'md5')
+    # Memory-mapped, so the workers of one machine share a single copy of the snapshot in the page cache
+    hash_index = DigestStore.load(hash_snapshot) if hash_snapshot else scan_job_library(booru_type, hash_algorithm)
+    downloaded = 0
+    try:
+        while True:
+            page = claims.lease(lease_seconds)
+            if page is None:
+                break
+            logger.info(f"[shards.run_shard_worker] {claims.owner} leased page {page} of {num_pages} from {queue_path}")
+            # Keep the lease alive while the page is downloading
+            stop_renewing = threading.Event()
+
+            def renew_lease(page=page):
+                renewer = ShardQueue(queue_path, owner=claims.owner)
+                try:
+                    while not stop_renewing.wait(lease_seconds / 3):
+                        if not renewer.renew(page, lease_seconds):
+                            logger.warning(f"[shards.run_shard_worker] Lost the lease on page {page}.")
+                            break
+                finally:
+                    renewer.close()
+
+            renewer = threading.Thread(target=renew_lease, name="rulescrape-shard-lease", daemon=True)
+            renewer.start()
+            try:
+                count = run_script(
+                    booru_type, job['tag'], min(page_size, limit - page * page_size),
+                    multithread=multithread, max_workers=max_workers,
+                    org_method=job.get('org_method'), post_filter=job.get('post_filter'), variant=job.get('variant', 'original'),
+                    resume=True, hash_algorithm=hash_algorithm, hash_index=hash_index, first_page=page, page_size=page_size, claims=claims
+                )
+            except BaseException:
+                claims.release(page)
+                raise
+            finally:
+                stop_renewing.set()
+                renewer.join()
+            claims.complete(page, count)
+            downloaded += count
+    finally:
+        claims.close()
+        hash_index.close()
+    logger.info(f"[shards.run_shard_worker] Worker {claims.owner} finished; downloaded {downloaded} images.")
+    return downloaded
+
+
+def scan_job_library(booru_type, hash_algorithm):
+    from rulescrape import load_user_settings
+    from library import scan_library_hashes
+    processes = load_user_settings().get('hash_processes') or None
+    return scan_library_hashes(os.path.join("images", booru_type), algorithm=hash_algorithm, processes=processes)
+
+
+def _worker_process(job, queue_path, lease_seconds, multithread, max_workers, hash_snapshot):
+    return run_shard_worker(job, queue_path=queue_path, lease_seconds=lease_seconds, multithread=multithread, max_workers=max_workers, hash_snapshot=hash_snapshot)
+
+
+def run_sharded_job(job, processes=2, queue_path=None, lease_seconds=DEFAULT_LEASE_SECONDS, multithread=False, max_workers=None):
+    # Runs the job in several local processes; more machines can join by running a worker on the same queue file
+    import concurrent.futures
+    from rulescrape import load_user_settings
+    queue_path = queue_path or get_shard_queue_path(job['booru_type'], job)
+    # The library is hashed once here instead of once per worker, each with its own process pool.
+    # Other machines on the same queue file take their own snapshot, so it is named per host and process.
+    hash_snapshot = f"{queue_path}.{socket.gethostname()}-{os.getpid()}.digests"
+    os.makedirs(os.path.dirname(hash_snapshot) or '.', exist_ok=True)
+    hash_index = scan_job_library(job['booru_type'], load_user_settings().get('hash_algorithm', 'md5'))
+    try:
+        hash_index.save(hash_snapshot)
+    finally:
+        hash_index.close()
+    try:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max(1, processes)) as pool:
+            futures = [pool.submit(_worker_process, job, queue_path, lease_seconds, multithread, max_workers, hash_snapshot) for _ in range(max(1, processes))]
+            downloaded = sum(future.result() for future in futures)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(hash_snapshot)
+    shard_queue = ShardQueue(queue_path)
+    status = shard_queue.status()
+    shard_queue.close()
+    logging.getLogger("shards").info(f"[shards.run_sharded_job] Sharded job finished: {downloaded} images downloaded, pages {status}")
+    return downloaded
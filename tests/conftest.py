@@ -0,0 +1,87 @@
+import os
+import sys
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The modules live at the top level of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # Libraries are resolved relative to the working directory (images/<booru>/)
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def fake_site(workdir, monkeypatch):
+    # A site with 1000 posts that caps 'limit' at its max_page_size, and a CDN serving each post's bytes
+    import requests
+    import rulescrape
+    from booru_api import get_max_page_size
+    from writer import DownloadBuffer
+    site = {'pages': [], 'images': [], 'fail_images': set(), 'fail_pages': set()}
+
+    def fetch_booru_posts(booru_type, tags=None, limit=10, page=0):
+        site['pages'].append((limit, page))
+        if page in site['fail_pages']:
+            raise requests.ConnectionError("connection reset")
+        limit = min(limit, get_max_page_size(booru_type))
+        return [{'id': i, 'tag_string': 'a', 'file_url': f"https://cdn.example.com/{i}.jpg"} for i in range(page * limit + 1, min((page + 1) * limit, 1000) + 1)]
+
+    def fetch_image(image_url, hedge=False, desc=None, job=None, spill_dir=None):
+        site['images'].append(image_url)
+        if image_url in site['fail_images']:
+            raise OSError("connection reset")
+        body = DownloadBuffer(spill_dir)
+        body.append(image_url.encode('utf-8'))
+        return body.finish(), 'image/jpeg'
+
+    monkeypatch.setattr(rulescrape, 'fetch_booru_posts', fetch_booru_posts)
+    monkeypatch.setattr(rulescrape, 'fetch_image', fetch_image)
+    return site
+
+
+def make_body(path, size=200000):
+    return (path.encode('utf-8') * (size // len(path) + 1))[:size]
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Serves make_body(path) for every GET; requests whose Host is in server.slow_hosts trickle
+    def do_GET(self):
+        self.server.requests.append((self.headers.get('Host'), self.path))
+        body = make_body(self.path)
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            if self.headers.get('Host', '').split(':')[0] in self.server.slow_hosts:
+                for i in range(0, len(body), 1000):
+                    self.wfile.write(body[i:i + 1000])
+                    time.sleep(0.05)
+            else:
+                self.wfile.write(body)
+        except OSError:
+            pass
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), _Handler)
+    server.daemon_threads = True
+    server.requests = []
+    server.slow_hosts = set()
+    server.url = f"http://127.0.0.1:{server.server_address[1]}"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
@@ -0,0 +1,82 @@
+import time
+import threading
+
+import pytest
+
+import bandwidth
+
+
+@pytest.mark.parametrize("spec, rate", [
+    (None, 0), ("", 0), ("  ", 0), ("0", 0), (2048, 2048), ("500", 500), ("500KB", 500 * 1024),
+    ("2MB/s", 2 * 1024 ** 2), ("1.5 mib", int(1.5 * 1024 ** 2)), ("1gbps", 1024 ** 3),
+    ("fast", None), ("5TB", None), (-1, None),
+])
+def test_parse_bandwidth(spec, rate):
+    if rate is None:
+        with pytest.raises(ValueError):
+            bandwidth.parse_bandwidth(spec)
+    else:
+        assert bandwidth.parse_bandwidth(spec) == rate
+
+
+@pytest.mark.parametrize("spec", ["fast", "2XB", "-1", -5, "1 MB per second"])
+def test_parse_bandwidth_rejects_invalid_values(spec):
+    with pytest.raises(ValueError):
+        bandwidth.parse_bandwidth(spec)
+
+
+def test_format_bandwidth():
+    assert bandwidth.format_bandwidth(0) == "unlimited"
+    assert bandwidth.format_bandwidth(500) == "500 B/s"
+    assert bandwidth.format_bandwidth(1536) == "1.5 KB/s"
+    assert bandwidth.format_bandwidth(2 * 1024 ** 2) == "2.0 MB/s"
+
+
+def test_unlimited_never_waits():
+    limiter = bandwidth.BandwidthLimiter()
+    started = time.monotonic()
+    for _ in range(1000):
+        limiter.acquire(1024 * 1024)
+    assert time.monotonic() - started < 0.5
+
+
+def test_rate_is_enforced():
+    limiter = bandwidth.BandwidthLimiter()
+    limiter.set_rate(1024 * 1024)
+    started = time.monotonic()
+    for _ in range(10):
+        limiter.acquire(64 * 1024)
+    # 640 KB at 1 MB/s, less the initial burst allowance
+    assert time.monotonic() - started >= 0.3
+
+
+def test_jobs_share_the_cap_fairly():
+    limiter = bandwidth.BandwidthLimiter()
+    limiter.set_rate(2 * 1024 * 1024)
+    received = {'busy': 0, 'quiet': 0}
+    stop = threading.Event()
+
+    def download(job):
+        while not stop.is_set():
+            limiter.acquire(16 * 1024, job=job, host="cdn")
+            received[job] += 16 * 1024
+
+    # One job with four download threads against a job with one
+    threads = [threading.Thread(target=download, args=('busy',)) for _ in range(4)]
+    threads.append(threading.Thread(target=download, args=('quiet',)))
+    for t in threads:
+        t.start()
+    time.sleep(1.0)
+    stop.set()
+    for t in threads:
+        t.join()
+    assert received['quiet'] > 0.3 * (received['busy'] + received['quiet'])
+
+
+def test_forget_drops_job_counters():
+    limiter = bandwidth.BandwidthLimiter()
+    limiter.set_rate(1024 ** 3)
+    limiter.acquire(1024, job='a', host='h')
+    limiter.acquire(1024, job='b', host='h')
+    limiter.forget('a')
+    assert set(limiter._served) == {'b', ('b', 'h')}
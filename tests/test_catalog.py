@@ -0,0 +1,103 @@
+import os
+import csv
+import json
+
+import pytest
+
+import library
+from catalog import Catalog, build_query_sql, export_rows, get_catalog_path, rebuild_catalog
+
+POSTS = [
+    {'id': 1, 'tags': 'cat_girl solo blue_eyes', 'rating': 'safe', 'score': 20, 'width': 1200, 'height': 800, 'file_url': 'https://example.com/1.jpg'},
+    {'id': 2, 'tags': 'cat_girl ai_generated green_eyes', 'rating': 'explicit', 'score': 50, 'width': 2000, 'height': 2000, 'file_url': 'https://example.com/2.png'},
+    {'id': 3, 'tags': 'dog solo', 'rating': 'questionable', 'file_url': 'https://example.com/3.gif'},
+]
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    output_dir = str(tmp_path / "images" / "rule34")
+    with Catalog(output_dir) as catalog:
+        for post in POSTS:
+            catalog.add(post, path=os.path.join(output_dir, f"post_{post['id']}.jpg"))
+    return Catalog(output_dir)
+
+
+def ids(catalog, expression):
+    return [row['id'] for row in catalog.query(expression)]
+
+
+def test_tag_queries(catalog):
+    assert catalog.count() == 3
+    assert ids(catalog, "") == [1, 2, 3]
+    assert ids(catalog, "cat_girl") == [1, 2]
+    assert ids(catalog, "solo -dog") == [1]
+    assert ids(catalog, "~blue_eyes ~green_eyes") == [1, 2]
+
+
+def test_metadata_queries(catalog):
+    assert ids(catalog, "rating:safe") == [1]
+    assert ids(catalog, "rating:q,e") == [2, 3]
+    # Posts without a score are never rejected, like in the download filter
+    assert ids(catalog, "score>=30") == [2, 3]
+    assert ids(catalog, "ext:png,gif") == [2, 3]
+    assert len(catalog.query("", limit=2)) == 2
+
+
+def test_paths_are_relative_to_the_library(catalog):
+    assert catalog.query("dog")[0]['path'] == "post_3.jpg"
+
+
+def test_variants_of_a_post_are_separate_rows(tmp_path):
+    output_dir = str(tmp_path / "images" / "rule34")
+    with Catalog(output_dir) as catalog:
+        catalog.add(POSTS[0], path=os.path.join(output_dir, "post_1.jpg"))
+        catalog.add(POSTS[0], path=os.path.join(output_dir, "post_1_sample.jpg"), variant='sample')
+        catalog.add(POSTS[0], path=os.path.join(output_dir, "post_1.jpg"))
+    rows = catalog.query("cat_girl")
+    assert [(row['id'], row['variant'], row['path']) for row in rows] == [(1, 'original', "post_1.jpg"), (1, 'sample', "post_1_sample.jpg")]
+
+
+def test_update_paths(catalog):
+    output_dir = catalog.output_dir
+    catalog.update_paths([(os.path.join(output_dir, "post_3.jpg"), os.path.join(output_dir, "dog", "post_3.jpg"))])
+    assert catalog.query("dog")[0]['path'] == os.path.join("dog", "post_3.jpg")
+
+
+def test_query_sql_uses_parameters():
+    sql, params = build_query_sql("cat_girl' -x score>=1")
+    assert "cat_girl'" not in sql
+    assert params == ["cat_girl'", 'x', 1.0]
+
+
+@pytest.mark.parametrize("fmt", ["csv", "json", "jsonl"])
+def test_export_rows(catalog, tmp_path, fmt):
+    path = str(tmp_path / f"export.{fmt}")
+    assert export_rows(catalog.query("solo"), path) == 2
+    with open(path, 'r', encoding='utf-8') as f:
+        if fmt == 'csv':
+            rows = list(csv.DictReader(f))
+        elif fmt == 'json':
+            rows = json.load(f)
+        else:
+            rows = [json.loads(line) for line in f]
+    assert [str(row['id']) for row in rows] == ['1', '3']
+    with pytest.raises(ValueError):
+        export_rows([], str(tmp_path / "export.xml"))
+
+
+def test_rebuild_catalog(workdir):
+    output_dir = os.path.join("images", "rule34")
+    for name in ("post_1.jpg", "post_1_sample.jpg", "post_2.png", "post_9.jpg"):
+        os.makedirs(os.path.join(output_dir, "x"), exist_ok=True)
+        open(os.path.join(output_dir, "x", name), 'wb').close()
+    library.save_post_metadata(output_dir, POSTS[0])
+    library.save_post_metadata(output_dir, POSTS[1])
+
+    assert rebuild_catalog("rule34") == 3
+    rows = Catalog(output_dir).query("")
+    assert [(row['id'], row['variant'], row['path']) for row in rows] == [
+        (1, 'original', os.path.join("x", "post_1.jpg")),
+        (1, 'sample', os.path.join("x", "post_1_sample.jpg")),
+        (2, 'original', os.path.join("x", "post_2.png")),
+    ]
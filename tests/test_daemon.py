@@ -0,0 +1,93 @@
+import threading
+
+import pytest
+
+import daemon
+
+
+@pytest.fixture
+def job_daemon(workdir, monkeypatch):
+    # Jobs are queued but never run
+    monkeypatch.setattr(daemon.RulescrapeDaemon, '_run', lambda self: None)
+    return daemon.RulescrapeDaemon()
+
+
+def test_submit_fills_in_defaults(job_daemon):
+    job = job_daemon.submit({'tag': 'cat_girl', 'limit': 5})
+    assert job.state == 'queued'
+    assert job.params == dict(daemon.JOB_DEFAULTS, tag='cat_girl', limit=5)
+    assert job_daemon.get_job(job.id) is job
+
+
+@pytest.mark.parametrize("request_fields", [
+    {'bogus': 1},
+    {'booru_type': 'nowhere'},
+    {'limit': 0},
+    {'limit': True},
+    {'max_workers': -1},
+    {'multithread': 'yes'},
+    {'hedge': 1},
+    {'org_method': 'By colour'},
+    {'post_filter': 'rating:bogus'},
+    {'variant': 'huge'},
+    {'hash_algorithm': 'crc32'},
+    {'fsync_policy': 'bogus'},
+    {'booru_type': ['rule34']},
+    {'tag': 7},
+    {'org_method': None},
+    {'post_filter': 5},
+    {'variant': 3},
+    {'fsync_policy': 1},
+    {'hash_algorithm': ['md5']},
+])
+def test_submit_rejects_invalid_jobs(job_daemon, request_fields):
+    with pytest.raises(ValueError):
+        job_daemon.submit(request_fields)
+    assert job_daemon.list_jobs() == []
+
+
+def test_submit_checks_the_configured_fsync_policy(job_daemon, monkeypatch):
+    import rulescrape
+    monkeypatch.setattr(rulescrape, 'load_user_settings', lambda: {'fsync_policy': 'sometimes'})
+    with pytest.raises(ValueError):
+        job_daemon.submit({})
+    assert job_daemon.submit({'fsync_policy': 'none'}).params['fsync_policy'] == 'none'
+
+
+def test_finished_jobs_are_pruned(job_daemon, monkeypatch):
+    monkeypatch.setattr(daemon, 'MAX_FINISHED_JOBS', 2)
+    running = job_daemon.submit({})
+    running.state = 'running'
+    finished = []
+    for i in range(4):
+        job = job_daemon.submit({})
+        job.state = 'finished'
+        job.finished = i + 1
+        finished.append(job)
+    job_daemon.submit({})
+    assert {job.id for job in job_daemon.list_jobs()} == {running.id, finished[2].id, finished[3].id, str(6)}
+
+
+def test_cancel_queued_job(job_daemon):
+    job = job_daemon.submit({})
+    assert job_daemon.cancel(job.id).state == 'cancelled'
+    assert job.cancel_event.is_set()
+    assert job_daemon.cancel("missing") is None
+
+
+def test_http_api(job_daemon):
+    server = daemon.ThreadingHTTPServer(('127.0.0.1', 0), daemon._DaemonRequestHandler)
+    server.rulescrape_daemon = job_daemon
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        client = daemon.DaemonClient(f"http://127.0.0.1:{server.server_address[1]}")
+        job = client.submit(tag='cat_girl', limit=3)
+        assert client.status(job['id'])['params']['tag'] == 'cat_girl'
+        with pytest.raises(RuntimeError, match="fsync policy"):
+            client.submit(fsync_policy='bogus')
+        with pytest.raises(RuntimeError, match="variant must be a string"):
+            client.submit(variant=3)
+        assert client.cancel(job['id'])['state'] == 'cancelled'
+    finally:
+        server.shutdown()
+        server.server_close()
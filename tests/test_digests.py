@@ -0,0 +1,91 @@
+import os
+import random
+import hashlib
+
+import pytest
+
+import digests
+import metrics
+from digests import DigestStore, to_digest
+
+
+def md5(i):
+    return hashlib.md5(str(i).encode('ascii')).hexdigest()
+
+
+def test_to_digest():
+    assert to_digest(md5(1)) == bytes.fromhex(md5(1))
+    assert to_digest(bytes.fromhex(md5(1))) == bytes.fromhex(md5(1))
+    with pytest.raises(ValueError):
+        to_digest("abcd")
+    with pytest.raises(ValueError):
+        to_digest("not hex")
+
+
+def test_add_contains_discard():
+    store = DigestStore([md5(1), md5(2)])
+    assert md5(1) in store and md5(3) not in store
+    assert store.add(md5(3)) is True
+    assert store.add(md5(3)) is False
+    store.discard(md5(1))
+    store.discard(md5(99))
+    assert md5(1) not in store
+    assert sorted(store) == sorted([md5(2), md5(3)])
+    assert len(store) == 2
+
+
+def test_matches_a_set_across_merges(monkeypatch):
+    # Small merge thresholds so the sorted array is rebuilt several times
+    monkeypatch.setattr(digests, 'MERGE_MIN', 64)
+    rng = random.Random(7)
+    merges = metrics.snapshot().get('digest_store_merges', 0)
+    store = DigestStore()
+    expected = set()
+    for _ in range(600):
+        value = md5(rng.randrange(300))
+        if rng.random() < 0.3:
+            store.discard(value)
+            expected.discard(value)
+        else:
+            assert store.add(value) == (value not in expected)
+            expected.add(value)
+    store.update(md5(i) for i in range(700, 900))
+    expected.update(md5(i) for i in range(700, 900))
+    assert metrics.snapshot().get('digest_store_merges', 0) - merges >= 2
+    assert len(store) == len(expected)
+    assert set(store) == expected
+    assert all(md5(i) in store for i in range(900) if md5(i) in expected)
+    assert not any(md5(i) in store for i in range(900, 1200))
+
+
+@pytest.mark.parametrize("use_mmap", [True, False])
+def test_save_and_load(tmp_path, use_mmap):
+    path = str(tmp_path / "library.digests")
+    store = DigestStore(md5(i) for i in range(1000))
+    store.discard(md5(5))
+    store.save(path)
+
+    loaded = DigestStore.load(path, use_mmap=use_mmap)
+    assert len(loaded) == 999
+    assert md5(4) in loaded and md5(5) not in loaded and md5(1000) not in loaded
+    # A loaded store still takes additions
+    assert loaded.add(md5(1000)) is True
+    assert md5(1000) in loaded
+    loaded.close()
+    assert len(loaded) == 0
+    os.remove(path)
+
+
+def test_load_empty_store(tmp_path):
+    path = str(tmp_path / "empty.digests")
+    DigestStore().save(path)
+    loaded = DigestStore.load(path)
+    assert len(loaded) == 0 and md5(1) not in loaded
+    loaded.close()
+
+
+def test_load_rejects_other_files(tmp_path):
+    path = tmp_path / "other.bin"
+    path.write_bytes(b"x" * 64)
+    with pytest.raises(ValueError):
+        DigestStore.load(str(path))
@@ -0,0 +1,64 @@
+import os
+import hashlib
+import importlib.util
+
+import pytest
+
+import hashing
+from library import scan_library_hashes
+
+
+def test_hash_buffers_matches_hashlib():
+    chunks = [b"abc", b"", b"def" * 1000]
+    data = b"".join(chunks)
+    digests = hashing.hash_buffers(chunks, ['md5', 'blake2b'])
+    assert digests == {'md5': hashlib.md5(data).hexdigest(), 'blake2b': hashlib.blake2b(data, digest_size=16).hexdigest()}
+
+
+@pytest.mark.parametrize("size", [0, 100, hashing.MMAP_THRESHOLD + 5])
+def test_hash_file_small_and_mapped(tmp_path, size):
+    path = tmp_path / "post_1.jpg"
+    data = os.urandom(size)
+    path.write_bytes(data)
+    assert hashing.hash_file(str(path), ('md5',)) == {'md5': hashlib.md5(data).hexdigest()}
+
+
+def test_hash_file_missing(tmp_path):
+    assert hashing.hash_file(str(tmp_path / "missing.jpg")) is None
+
+
+def test_every_algorithm_fits_the_digest_store():
+    for algorithm in hashing.ALGORITHMS:
+        package = {'xxh128': 'xxhash', 'blake3': 'blake3'}.get(algorithm)
+        if package and importlib.util.find_spec(package) is None:
+            with pytest.raises(ValueError, match=package):
+                hashing.check_algorithm(algorithm)
+            continue
+        assert len(hashing.hash_buffers([b"x"], [algorithm])[algorithm]) == 32
+
+
+def test_unknown_algorithm():
+    with pytest.raises(ValueError):
+        hashing.check_algorithm('crc32')
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_hash_files_keeps_order(tmp_path, monkeypatch, processes):
+    monkeypatch.setattr(hashing, 'PARALLEL_SCAN_MIN_FILES', 4)
+    paths = []
+    for i in range(10):
+        path = tmp_path / f"post_{i}.jpg"
+        path.write_bytes(str(i).encode('ascii'))
+        paths.append(str(path))
+    paths.append(str(tmp_path / "missing.jpg"))
+    results = list(hashing.hash_files(paths, 'md5', processes=processes))
+    assert results == [hashlib.md5(str(i).encode('ascii')).hexdigest() for i in range(10)] + [None]
+
+
+def test_scan_library_hashes(tmp_path):
+    (tmp_path / "jpg" / "a").mkdir(parents=True)
+    (tmp_path / "jpg" / "a" / "post_1.jpg").write_bytes(b"one")
+    (tmp_path / "post_2.png").write_bytes(b"two")
+    (tmp_path / "post_3.json").write_bytes(b"not an image")
+    store = scan_library_hashes(str(tmp_path), algorithm='blake2b', processes=1)
+    assert sorted(store) == sorted(hashlib.blake2b(data, digest_size=16).hexdigest() for data in (b"one", b"two"))
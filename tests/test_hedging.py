@@ -0,0 +1,43 @@
+import hedging
+from conftest import make_body
+
+
+def test_get_alternate_url():
+    assert hedging.get_alternate_url("https://wimg.rule34.xxx/images/1/a.jpg?99") == "https://us.rule34.xxx/images/1/a.jpg?99"
+    assert hedging.get_alternate_url("https://us.rule34.xxx/images/1/a.jpg") == "https://wimg.rule34.xxx/images/1/a.jpg"
+    assert hedging.get_alternate_url("https://example.com/a.jpg") == "https://example.com/a.jpg"
+
+
+def test_rate_tracker_needs_enough_samples():
+    tracker = hedging.TransferRateTracker(window=10)
+    for rate in range(1, hedging.HEDGE_MIN_SAMPLES):
+        tracker.record(rate * 100, 1.0)
+    assert tracker.median() is None
+    tracker.record(0, 1.0)
+    assert tracker.median() is None
+    tracker.record(1000, 1.0)
+    assert tracker.median() == 300
+
+
+def test_hedged_fetch_without_hedge(http_server, monkeypatch):
+    monkeypatch.setattr(hedging, 'rate_tracker', hedging.TransferRateTracker())
+    body, content_type = hedging.hedged_fetch(http_server.url + "/fast.jpg")
+    assert b"".join(body) == make_body("/fast.jpg")
+    assert content_type == 'image/jpeg'
+    assert len(http_server.requests) == 1
+
+
+def test_slow_transfer_is_hedged_to_the_mirror(http_server, monkeypatch):
+    port = http_server.server_address[1]
+    http_server.slow_hosts.add('127.0.0.1')
+    tracker = hedging.TransferRateTracker()
+    for _ in range(hedging.HEDGE_MIN_SAMPLES):
+        tracker.record(10 * 1024 * 1024, 1.0)
+    monkeypatch.setattr(hedging, 'rate_tracker', tracker)
+    monkeypatch.setattr(hedging, 'HEDGE_MIN_ELAPSED', 0.2)
+    monkeypatch.setitem(hedging.ALTERNATE_HOSTS, '127.0.0.1', f"localhost:{port}")
+
+    body, _ = hedging.hedged_fetch(http_server.url + "/slow.jpg")
+
+    assert b"".join(body) == make_body("/slow.jpg")
+    assert [host.split(':')[0] for host, _ in http_server.requests] == ['127.0.0.1', 'localhost']
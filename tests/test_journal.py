@@ -0,0 +1,80 @@
+import json
+
+from journal import JobJournal, get_job_id
+
+PARAMS = {'booru_type': 'rule34', 'tag': 'cat_girl', 'limit': 3}
+POSTS = [{'id': 1, 'tags': 'a'}, {'id': 2, 'tags': 'b'}, {'id': 3, 'tags': 'c'}]
+
+
+def read_records(journal):
+    with open(journal.path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def test_job_id_depends_on_params_only():
+    assert get_job_id(PARAMS) == get_job_id(dict(reversed(list(PARAMS.items()))))
+    assert get_job_id(PARAMS) != get_job_id(dict(PARAMS, limit=4))
+
+
+def test_resume_after_crash(tmp_path):
+    journal = JobJournal(str(tmp_path), PARAMS)
+    assert journal.start() is False
+    journal.record_page(0, POSTS)
+    journal.record_post(POSTS[0], 'done', md5='aa')
+    journal.record_post(POSTS[1], 'queued')
+    journal.record_post(POSTS[2], 'failed', reason="timeout")
+    journal.close()
+    # A crash in the middle of a write leaves a torn last line
+    with open(journal.path, 'a', encoding='utf-8') as f:
+        f.write('{"t":"post","id":')
+
+    resumed = JobJournal(str(tmp_path), PARAMS)
+    assert resumed.start(resume=True) is True
+    assert resumed.pages == {0: POSTS}
+    assert resumed.post_states == {'1': 'done', '2': 'queued', '3': 'failed'}
+    assert resumed.done_hashes == {'aa'}
+    assert resumed.is_settled(POSTS[0])
+    assert not resumed.is_settled(POSTS[1]) and not resumed.is_settled(POSTS[2])
+    resumed.close()
+
+
+def test_resume_without_journal_starts_fresh(tmp_path):
+    journal = JobJournal(str(tmp_path), PARAMS)
+    assert journal.start(resume=True) is False
+    journal.close()
+    assert read_records(journal) == [{'t': 'job', 'job_id': journal.job_id, 'params': PARAMS}]
+
+
+def test_finish_compacts_to_one_line_per_post(tmp_path):
+    journal = JobJournal(str(tmp_path), PARAMS)
+    journal.start()
+    journal.record_page(0, POSTS)
+    journal.record_page_done(0)
+    journal.record_post(POSTS[0], 'queued')
+    journal.record_post(POSTS[0], 'done', md5='aa')
+    journal.record_post(POSTS[1], 'queued')
+    journal.record_post(POSTS[2], 'duplicate')
+    journal.finish()
+
+    records = read_records(journal)
+    assert records[0]['t'] == 'job' and records[-1] == {'t': 'finished'}
+    # A post still queued when the job ended counts as failed and keeps its metadata for a retry
+    assert records[1:-1] == [
+        {'t': 'post', 'id': '1', 'state': 'done'},
+        {'t': 'post', 'id': '2', 'state': 'failed', 'post': POSTS[1]},
+        {'t': 'post', 'id': '3', 'state': 'duplicate'},
+    ]
+
+    retried = JobJournal(str(tmp_path), PARAMS)
+    retried.start(resume=True)
+    assert retried.finished
+    assert retried.retry_posts == {'2': POSTS[1]}
+    retried.close()
+
+
+def test_writes_after_close_are_ignored(tmp_path):
+    journal = JobJournal(str(tmp_path), PARAMS)
+    journal.start()
+    journal.close()
+    journal.record_post(POSTS[0], 'done')
+    assert len(read_records(journal)) == 1
@@ -0,0 +1,113 @@
+import os
+
+import booru_api
+import library
+
+
+def make_file(path, data=b"x"):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_get_dest_dir():
+    post = {'id': 1, 'tags': 'cat_girl solo', 'file_url': 'https://example.com/a/b.PNG?x=1'}
+    assert library.get_dest_dir(post, "lib", "By extension and first tag") == os.path.join("lib", "png", "cat_girl")
+    assert library.get_dest_dir(post, "lib", "By tag only") == os.path.join("lib", "cat_girl")
+    assert library.get_dest_dir(post, "lib", "Flat (no folders)") == "lib"
+    assert library.get_dest_dir({'id': 2, 'tags': '', 'file_url': 'x.xyz'}, "lib", "By extension only", ext=".xyz") == os.path.join("lib", "other")
+
+
+def test_plan_reorganize_uses_stored_metadata(workdir):
+    output_dir = os.path.join("images", "rule34")
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_1_sample.jpg"))
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_2.jpg"))
+    library.save_post_metadata(output_dir, {'id': 1, 'tags': 'dog', 'file_url': 'https://example.com/1.jpg'})
+
+    moves, missing, conflicts = library.plan_reorganize(output_dir, "By tag only")
+
+    assert sorted(dest for _, dest in moves) == [os.path.join(output_dir, "dog", "post_1.jpg"), os.path.join(output_dir, "dog", "post_1_sample.jpg")]
+    assert missing == [os.path.join(output_dir, "jpg", "cat", "post_2.jpg")]
+    assert conflicts == []
+
+
+def test_plan_reorganize_reports_duplicate_destinations(workdir):
+    output_dir = os.path.join("images", "rule34")
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
+    make_file(os.path.join(output_dir, "jpg", "dog", "post_1.jpg"))
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_2.jpg"))
+    make_file(os.path.join(output_dir, "post_2.jpg"))
+    library.save_post_metadata(output_dir, {'id': 1, 'tags': 'dog', 'file_url': 'https://example.com/1.jpg'})
+    library.save_post_metadata(output_dir, {'id': 2, 'tags': 'dog', 'file_url': 'https://example.com/2.jpg'})
+
+    moves, missing, conflicts = library.plan_reorganize(output_dir, "Flat (no folders)")
+
+    assert [dest for _, dest in moves] == [os.path.join(output_dir, "post_1.jpg")]
+    # Both copies of post 1 want the same path, and post 2 is already there
+    assert sorted(src for src, _ in moves + conflicts) == [
+        os.path.join(output_dir, "jpg", "cat", "post_1.jpg"),
+        os.path.join(output_dir, "jpg", "cat", "post_2.jpg"),
+        os.path.join(output_dir, "jpg", "dog", "post_1.jpg")
+    ]
+    assert len(conflicts) == 2
+
+
+def test_apply_move_is_safe_to_repeat(tmp_path):
+    src = str(tmp_path / "a" / "post_1.jpg")
+    dest = str(tmp_path / "b" / "post_1.jpg")
+    make_file(src)
+    assert library.apply_move(src, dest) == "moved"
+    make_file(src, b"other")
+    assert library.apply_move(src, dest) == "conflict"
+    assert library.apply_move(dest, dest) == "skipped"
+
+
+def test_reorganize_fetches_missing_metadata(workdir, monkeypatch):
+    output_dir = os.path.join("images", "rule34")
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_2.jpg"))
+    requested = []
+
+    def fake_fetch(booru_type, tags=None, limit=10, page=0):
+        requested.append(tags)
+        # Post 2 no longer exists on the site
+        return [{'id': 1, 'tags': 'dog', 'file_url': 'https://example.com/1.jpg'}] if tags == "id:1" else []
+
+    monkeypatch.setattr(booru_api, 'fetch_booru_posts', fake_fetch)
+    results, moves = library.reorganize("rule34", "By tag only")
+
+    assert sorted(requested) == ["id:1", "id:2"]
+    assert results['fetched_metadata'] == 1
+    assert results['missing_metadata'] == 1
+    assert os.path.exists(os.path.join(output_dir, "dog", "post_1.jpg"))
+    assert os.path.exists(os.path.join(output_dir, "jpg", "cat", "post_2.jpg"))
+
+
+def test_reorganize_offline_leaves_files_without_metadata(workdir, monkeypatch):
+    output_dir = os.path.join("images", "rule34")
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
+
+    def fake_fetch(*args, **kwargs):
+        raise AssertionError("fetched while offline")
+
+    monkeypatch.setattr(booru_api, 'fetch_booru_posts', fake_fetch)
+
+    results, moves = library.reorganize("rule34", "By tag only", fetch_missing=False)
+
+    assert results == {'planned': 0, 'missing_metadata': 1}
+    assert moves == []
+    assert os.path.exists(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
+
+
+def test_dry_run_plans_from_fetched_metadata_without_writing(workdir, monkeypatch):
+    output_dir = os.path.join("images", "rule34")
+    make_file(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
+    monkeypatch.setattr(booru_api, 'fetch_booru_posts', lambda *args, **kwargs: [{'id': 1, 'tags': 'dog', 'file_url': 'https://example.com/1.jpg'}])
+
+    results, moves = library.reorganize("rule34", "By tag only", dry_run=True)
+
+    assert results == {'planned': 1, 'missing_metadata': 0, 'fetched_metadata': 1}
+    assert moves == [(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"), os.path.join(output_dir, "dog", "post_1.jpg"))]
+    assert not os.path.exists(library.get_metadata_dir(output_dir))
+    assert os.path.exists(os.path.join(output_dir, "jpg", "cat", "post_1.jpg"))
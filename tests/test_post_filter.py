@@ -0,0 +1,56 @@
+import pytest
+
+from post_filter import FilterError, apply_filter, build_search_tags, compile_filter
+
+POSTS = [
+    {'id': 1, 'tags': 'cat_girl solo', 'rating': 'safe', 'score': 20, 'width': 1200, 'height': 800, 'file_url': 'https://example.com/1.jpg'},
+    {'id': 2, 'tags': 'cat_girl ai_generated', 'rating': 'explicit', 'score': 50, 'width': 2000, 'height': 2000, 'file_url': 'https://example.com/2.png'},
+    {'id': 3, 'tag_string': 'dog solo', 'rating': 's', 'score': 5, 'image_width': 640, 'image_height': 480, 'file_size': 6 * 1024 * 1024, 'file_ext': 'png', 'file_url': 'https://example.com/3.png'},
+]
+
+
+def ids(expression):
+    return [post['id'] for post in apply_filter(POSTS, compile_filter(expression))]
+
+
+def test_tag_terms():
+    assert ids("cat_girl") == [1, 2]
+    assert ids("+solo -ai_generated") == [1, 3]
+    assert ids("~dog ~ai_generated") == [2, 3]
+
+
+def test_numeric_terms():
+    assert ids("score>=20") == [1, 2]
+    assert ids("width>1000 height<1000") == [1]
+    # rule34-style posts report no file size, which never rejects them
+    assert ids("size<=5MB") == [1, 2]
+
+
+def test_extension_term():
+    assert ids("ext:png") == [2, 3]
+
+
+def test_ratings_stay_per_site():
+    # 'safe' is the gelbooru-style rating, Danbooru's 's' is 'sensitive'
+    assert ids("rating:safe") == [1]
+    assert ids("rating:sensitive") == [3]
+    assert ids("rating:s") == [1, 3]
+    assert ids("rating:q,e") == [2]
+
+
+def test_empty_filter_keeps_everything():
+    post_filter = compile_filter("")
+    assert not post_filter
+    assert apply_filter(POSTS, post_filter) == POSTS
+
+
+@pytest.mark.parametrize("expression", ["rating:bogus", "size<=5XB", "score>>3", "width<=10MB"])
+def test_invalid_terms(expression):
+    with pytest.raises(FilterError):
+        compile_filter(expression)
+
+
+def test_build_search_tags():
+    assert build_search_tags("cat_girl", False) == "cat_girl"
+    assert build_search_tags("cat_girl", True) == "cat_girl -ai -ai_generated -ai_assisted"
+    assert build_search_tags("", True) == "-ai -ai_generated -ai_assisted"
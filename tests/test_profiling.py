@@ -0,0 +1,74 @@
+import os
+import json
+import time
+import threading
+import tracemalloc
+
+import pytest
+
+import rulescrape
+from profiling import NULL_PROFILER, RunProfiler
+
+
+def profiler_threads():
+    return [t for t in threading.enumerate() if t.name == "rulescrape-profiler"]
+
+
+def busy(seconds):
+    deadline = time.perf_counter() + seconds
+    data = []
+    while time.perf_counter() < deadline:
+        data.append(bytearray(1024))
+    return data
+
+
+def test_report_per_phase(tmp_path):
+    report_dir = str(tmp_path / "report")
+    profiler = RunProfiler(report_dir, label="test")
+    profiler.start()
+    with profiler.phase('setup'):
+        busy(0.05)
+    for _ in range(2):
+        with profiler.phase('download'):
+            kept = busy(0.1)
+    assert profiler.stop() == report_dir
+    del kept
+
+    assert not profiler_threads()
+    assert not tracemalloc.is_tracing()
+    with open(os.path.join(report_dir, "summary.json"), 'r', encoding='utf-8') as f:
+        summary = json.load(f)
+    assert set(summary['phases']) == {'setup', 'download'}
+    download = summary['phases']['download']
+    assert download['calls'] == 2
+    assert download['wall_seconds'] >= 0.2
+    assert download['peak_memory_bytes'] > 0
+    files = os.listdir(report_dir)
+    for name in ("download.pstats", "download.txt", "setup.pstats", "memory.txt"):
+        assert name in files
+
+
+def test_collectors_can_be_turned_off(tmp_path):
+    profiler = RunProfiler(str(tmp_path), use_cprofile=False, use_tracemalloc=False, use_sampler=False)
+    profiler.start()
+    with profiler.phase('download'):
+        busy(0.01)
+    profiler.stop()
+    assert sorted(os.listdir(tmp_path)) == ["summary.json"]
+
+
+def test_null_profiler():
+    with NULL_PROFILER.phase('download'):
+        pass
+    NULL_PROFILER.start()
+    assert NULL_PROFILER.stop() is None
+
+
+def test_failed_setup_stops_the_profiler(fake_site, tmp_path):
+    with pytest.raises(ValueError):
+        rulescrape.run_script('rule34', 'a', 3, fsync_policy='bogus', profile=str(tmp_path / "report"))
+    assert not profiler_threads()
+    assert not tracemalloc.is_tracing()
+    # The journal was closed; the same job starts cleanly afterwards
+    assert rulescrape.run_script('rule34', 'a', 3, profile=str(tmp_path / "report2")) == 3
+    assert not profiler_threads()
@@ -0,0 +1,45 @@
+import os
+
+import pytest
+import requests
+
+import rulescrape
+
+
+def test_pages_never_exceed_the_site_cap(fake_site):
+    assert rulescrape.run_script('danbooru', 'a', 450) == 450
+    assert fake_site['pages'] == [(200, 0), (200, 1), (200, 2)]
+    assert len([name for name in os.listdir(os.path.join("images", "danbooru")) if name.startswith("post_")]) == 450
+
+
+def test_resume_retries_only_failed_posts(fake_site):
+    fake_site['fail_images'].add("https://cdn.example.com/3.jpg")
+    assert rulescrape.run_script('danbooru', 'a', 5) == 4
+
+    fake_site['fail_images'].clear()
+    fake_site['pages'].clear()
+    fake_site['images'].clear()
+    # Posts finished by the first run count towards the limit
+    assert rulescrape.run_script('danbooru', 'a', 5, resume=True) == 5
+    assert fake_site['pages'] == []
+    assert fake_site['images'] == ["https://cdn.example.com/3.jpg"]
+
+
+def test_failed_page_fetch_leaves_the_job_resumable(fake_site):
+    fake_site['fail_pages'].add(1)
+    with pytest.raises(requests.ConnectionError):
+        rulescrape.run_script('danbooru', 'a', 600)
+    assert len(fake_site['images']) == 200
+
+    fake_site['fail_pages'].clear()
+    fake_site['pages'].clear()
+    assert rulescrape.run_script('danbooru', 'a', 600, resume=True) == 600
+    assert fake_site['pages'] == [(200, 1), (200, 2)]
+
+
+def test_multithreaded_run_downloads_no_more_than_the_limit(fake_site):
+    fake_site['fail_images'].add("https://cdn.example.com/3.jpg")
+    assert rulescrape.run_script('danbooru', 'a', 210, multithread=True, max_workers=8) == 210
+    assert fake_site['pages'] == [(200, 0), (200, 1)]
+    # The failed post is replaced by exactly one more
+    assert len(fake_site['images']) == 211
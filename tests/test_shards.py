@@ -0,0 +1,107 @@
+import time
+
+import pytest
+
+from shards import ShardQueue
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    return str(tmp_path / "job.shards.sqlite")
+
+
+def test_pages_are_leased_once_in_order(queue_path):
+    a = ShardQueue(queue_path, owner="a")
+    b = ShardQueue(queue_path, owner="b")
+    a.add_pages(3)
+    b.add_pages(3)
+    assert [a.lease(), b.lease(), a.lease()] == [0, 1, 2]
+    assert b.lease() is None
+    assert a.status() == {'leased': 3, 'downloaded': 0}
+    a.close()
+    b.close()
+
+
+def test_expired_lease_is_handed_to_another_worker(queue_path):
+    a = ShardQueue(queue_path, owner="a")
+    b = ShardQueue(queue_path, owner="b")
+    a.add_pages(1)
+    assert a.lease(lease_seconds=0.05) == 0
+    assert b.lease() is None
+    time.sleep(0.1)
+    assert b.lease() == 0
+    # The first worker finds out it lost the page when it tries to renew
+    assert a.renew(0) is False
+    assert b.renew(0) is True
+    a.complete(0, downloaded=5)
+    assert b.status() == {'leased': 1, 'downloaded': 0}
+    b.complete(0, downloaded=7)
+    assert b.status() == {'done': 1, 'downloaded': 7}
+    a.close()
+    b.close()
+
+
+def test_released_page_is_queued_again(queue_path):
+    a = ShardQueue(queue_path, owner="a")
+    b = ShardQueue(queue_path, owner="b")
+    a.add_pages(1)
+    page = a.lease()
+    b.release(page)
+    assert b.lease() is None
+    a.release(page)
+    assert b.lease() == page
+    a.close()
+    b.close()
+
+
+def test_post_and_hash_claims(queue_path):
+    a = ShardQueue(queue_path, owner="a")
+    b = ShardQueue(queue_path, owner="b")
+    a.add_pages(2)
+    a.lease()
+    b.lease()
+    post = {'id': 42}
+    other = {'id': 43}
+    assert a.claim_post(post) is True
+    assert b.claim_post(post) is False
+    # The owning page may process its post again, e.g. after a crash
+    assert a.claim_post(post) is True
+
+    assert a.claim_hash("aa", post) is True
+    assert b.claim_hash("aa", other) is False
+    a.release_hash("aa", post)
+    assert b.claim_hash("aa", other) is True
+    a.close()
+    b.close()
+
+
+def test_shard_worker_fetches_every_post_of_each_page(fake_site, monkeypatch):
+    import booru_api
+    from shards import get_shard_queue_path, run_shard_worker
+    monkeypatch.setitem(booru_api.BOORU_APIS['rule34'], 'max_page_size', 5)
+    job = {'booru_type': 'rule34', 'tag': 'a', 'limit': 12}
+
+    assert run_shard_worker(job) == 12
+    assert sorted(page for _, page in fake_site['pages']) == [0, 1, 2]
+    queue = ShardQueue(get_shard_queue_path('rule34', job))
+    assert queue.status() == {'done': 3, 'downloaded': 12}
+    queue.close()
+
+
+def test_page_whose_fetch_failed_is_queued_again(fake_site, monkeypatch):
+    import booru_api
+    import requests
+    from shards import get_shard_queue_path, run_shard_worker
+    monkeypatch.setitem(booru_api.BOORU_APIS['rule34'], 'max_page_size', 5)
+    job = {'booru_type': 'rule34', 'tag': 'a', 'limit': 12}
+    fake_site['fail_pages'].add(1)
+
+    with pytest.raises(requests.ConnectionError):
+        run_shard_worker(job)
+    queue = ShardQueue(get_shard_queue_path('rule34', job))
+    assert queue.status() == {'done': 1, 'queued': 2, 'downloaded': 5}
+
+    fake_site['fail_pages'].clear()
+    assert run_shard_worker(job) == 7
+    assert queue.status() == {'done': 3, 'downloaded': 12}
+    queue.close()
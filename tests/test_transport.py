@@ -0,0 +1,77 @@
+import os
+import json
+import time
+
+import pytest
+import requests
+
+import transport
+from booru_api import get_session
+from conftest import make_body
+
+
+@pytest.fixture
+def cassette_dir(tmp_path):
+    yield str(tmp_path / "cassette")
+    transport.configure('live')
+
+
+def fetch(url):
+    response = get_session().get(url, stream=True, timeout=10)
+    return response.status_code, response.headers.get('Content-Type'), b"".join(response.iter_content(chunk_size=8192))
+
+
+def test_configure_validates_its_arguments(tmp_path):
+    with pytest.raises(ValueError):
+        transport.configure('tape')
+    with pytest.raises(ValueError):
+        transport.configure('record')
+    with pytest.raises(ValueError):
+        transport.configure('replay', str(tmp_path), latency_scale=-1)
+    with pytest.raises(ValueError, match="No cassette"):
+        transport.configure('replay', str(tmp_path))
+
+
+def test_record_then_replay_without_network(http_server, cassette_dir):
+    transport.configure('record', cassette_dir)
+    recorded = [fetch(http_server.url + "/a.jpg"), fetch(http_server.url + "/b.jpg?x=1")]
+    assert recorded[0] == (200, 'image/jpeg', make_body("/a.jpg"))
+    with open(os.path.join(cassette_dir, transport.CASSETTE_INDEX), 'r', encoding='utf-8') as f:
+        entries = [json.loads(line) for line in f]
+    assert [entry['key'] for entry in entries] == [f"GET {http_server.url}/a.jpg", f"GET {http_server.url}/b.jpg?x=1"]
+    assert entries[0]['size'] == len(make_body("/a.jpg"))
+
+    transport.configure('replay', cassette_dir, latency_scale=0)
+    requests_seen = len(http_server.requests)
+    assert [fetch(http_server.url + "/a.jpg"), fetch(http_server.url + "/b.jpg?x=1")] == recorded
+    assert len(http_server.requests) == requests_seen
+    with pytest.raises(requests.ConnectionError):
+        fetch(http_server.url + "/never-recorded.jpg")
+
+
+def test_repeated_requests_replay_in_order(tmp_path):
+    cassette = transport.Cassette(str(tmp_path))
+    for body in (b"first", b"second"):
+        cassette.add("GET https://example.com/posts", 200, "OK", {'Content-Type': 'application/json'}, body, 0.0, [[len(body), 0.0]])
+    adapter = transport.ReplayAdapter(transport.Cassette(str(tmp_path)), latency_scale=0)
+    request = requests.Request('GET', "https://example.com/posts").prepare()
+    bodies = [adapter.send(request).content for _ in range(3)]
+    assert bodies == [b"first", b"second", b"second"]
+
+
+def test_replay_keeps_recorded_timing(tmp_path):
+    cassette = transport.Cassette(str(tmp_path))
+    body = b"x" * 1000
+    cassette.add("GET https://example.com/slow.jpg", 200, "OK", {}, body, 0.1, [[500, 0.1], [1000, 0.2]])
+    request = requests.Request('GET', "https://example.com/slow.jpg").prepare()
+
+    started = time.monotonic()
+    response = transport.ReplayAdapter(cassette, latency_scale=1.0).send(request, stream=True)
+    assert b"".join(response.iter_content(chunk_size=250)) == body
+    # 0.1s to the first byte, then 0.2s to read the body
+    assert time.monotonic() - started >= 0.28
+
+    started = time.monotonic()
+    response = transport.ReplayAdapter(cassette, latency_scale=0.1).send(request, stream=True)
+    assert b"".join(response.iter_content(chunk_size=250)) == body
+    assert time.monotonic() - started < 0.2
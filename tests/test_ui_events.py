@@ -0,0 +1,49 @@
+import threading
+
+import ui_events
+
+
+def test_nothing_is_queued_without_a_listener():
+    events = ui_events.UIEventQueue()
+    events.post('error', "lost")
+    events.post_progress(1, 10)
+    assert events.drain() == (None, [], 0, {})
+
+
+def test_drain_returns_one_batch_per_frame():
+    events = ui_events.UIEventQueue()
+    events.listen()
+    events.post('error', "one")
+    events.post('duplicate', "two")
+    events.post_progress(1, 10)
+    events.post_progress(2, 10)
+    assert events.drain() == ((2, 10), [('error', "one"), ('duplicate', "two")], 0, {'error': 1, 'duplicate': 1})
+    # Messages and progress are handed out once; the per-job counts stay
+    assert events.drain() == (None, [], 0, {'error': 1, 'duplicate': 1})
+    events.reset()
+    assert events.drain() == (None, [], 0, {})
+
+
+def test_overflow_drops_messages_but_keeps_counts(monkeypatch):
+    monkeypatch.setattr(ui_events, 'MAX_PENDING_MESSAGES', 10)
+    events = ui_events.UIEventQueue()
+    events.listen()
+
+    def post_many():
+        for i in range(100):
+            events.post('skipped', f"post {i}")
+
+    threads = [threading.Thread(target=post_many) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    progress, messages, dropped, counts = events.drain()
+    assert len(messages) == 10
+    assert dropped == 390
+    assert counts == {'skipped': 400}
+
+
+def test_format_counts():
+    assert ui_events.format_counts({}) == ""
+    assert ui_events.format_counts({'present': 3, 'error': 2, 'other': 9, 'warning': 0}) == "Errors: 2 · Already present: 3"
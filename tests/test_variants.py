@@ -0,0 +1,53 @@
+import pytest
+
+from booru_api import get_variant_basename, parse_variant, select_variant
+
+GELBOORU_POST = {
+    'id': 7, 'file_url': 'https://img.example.com/images/7.png', 'width': 4000, 'height': 3000,
+    'sample_url': 'https://img.example.com/samples/7.jpg', 'sample_width': 850, 'sample_height': 638,
+    'preview_url': 'https://img.example.com/thumbs/7.jpg', 'preview_width': 150, 'preview_height': 113,
+}
+
+DANBOORU_POST = {
+    'id': 8, 'file_url': 'https://cdn.example.com/original/8.png', 'image_width': 2000, 'image_height': 1000,
+    'large_file_url': 'https://cdn.example.com/sample/8.jpg', 'preview_file_url': 'https://cdn.example.com/180x180/8.jpg',
+    'media_asset': {'variants': [
+        {'type': '180x180', 'url': 'https://cdn.example.com/180x180/8.jpg', 'width': 180, 'height': 90},
+        {'type': 'sample', 'url': 'https://cdn.example.com/sample/8.jpg', 'width': 850, 'height': 425},
+    ]},
+}
+
+
+def test_parse_variant():
+    assert parse_variant(None) == ('original', None)
+    assert parse_variant(" Sample ") == ('sample', None)
+    assert parse_variant("min:1280") == ('min', 1280)
+    with pytest.raises(ValueError):
+        parse_variant("huge")
+    with pytest.raises(ValueError):
+        parse_variant("min:big")
+
+
+def test_select_named_variants():
+    assert select_variant(GELBOORU_POST, 'sample') == ('sample', GELBOORU_POST['sample_url'])
+    assert select_variant(GELBOORU_POST, 'preview') == ('preview', GELBOORU_POST['preview_url'])
+    assert select_variant(DANBOORU_POST, 'sample') == ('sample', DANBOORU_POST['large_file_url'])
+
+
+def test_select_min_variant():
+    assert select_variant(GELBOORU_POST, 'min:800') == ('sample', GELBOORU_POST['sample_url'])
+    assert select_variant(GELBOORU_POST, 'min:1000') == ('original', GELBOORU_POST['file_url'])
+    # Danbooru's media_asset dimensions make its preview eligible
+    assert select_variant(DANBOORU_POST, 'min:150') == ('preview', DANBOORU_POST['preview_file_url'])
+
+
+def test_missing_variant_falls_back_to_original():
+    post = {'id': 9, 'file_url': 'https://img.example.com/9.gif'}
+    assert select_variant(post, 'sample') == ('original', post['file_url'])
+    assert select_variant(post, 'min:5000') == ('original', post['file_url'])
+    assert select_variant({'id': 10}, 'original') == ('original', None)
+
+
+def test_variant_basenames_do_not_collide():
+    assert get_variant_basename({'id': 7}, 'original') == "post_7"
+    assert get_variant_basename({'id': 7}, 'sample') == "post_7_sample"
@@ -0,0 +1,97 @@
+import os
+import threading
+
+import pytest
+
+import writer
+
+
+def test_download_buffer_stays_in_memory_below_threshold(tmp_path):
+    body = writer.DownloadBuffer(str(tmp_path), spill_threshold=100)
+    body.append(b"a" * 60)
+    body.append(b"b" * 40)
+    assert body.spilled_path is None
+    assert len(body) == body.memory_size == 100
+    assert b"".join(body) == b"a" * 60 + b"b" * 40
+
+
+def test_download_buffer_spills_above_threshold(tmp_path):
+    body = writer.DownloadBuffer(str(tmp_path), spill_threshold=100)
+    for _ in range(5):
+        body.append(b"c" * 30)
+    assert body.spilled_path is not None and body.spilled_path.startswith(str(tmp_path))
+    assert len(body) == 150
+    assert body.memory_size == 0
+    assert b"".join(body.finish()) == b"c" * 150
+    body.discard()
+    assert os.listdir(tmp_path) == []
+
+
+def test_writer_writes_buffers_and_spilled_files(tmp_path):
+    spilled = writer.DownloadBuffer(str(tmp_path / ".partial"), spill_threshold=10)
+    spilled.append(b"s" * 50)
+    written = []
+    with writer.WriteBehindWriter(num_threads=2, fsync_policy='file') as w:
+        w.write(str(tmp_path / "a" / "one.jpg"), [b"one", b"!"], on_done=written.append)
+        w.write(str(tmp_path / "b" / "two.jpg"), spilled.finish(), on_done=written.append)
+    assert sorted(written) == [str(tmp_path / "a" / "one.jpg"), str(tmp_path / "b" / "two.jpg")]
+    assert (tmp_path / "a" / "one.jpg").read_bytes() == b"one!"
+    # The spill file is renamed into place, not copied
+    assert (tmp_path / "b" / "two.jpg").read_bytes() == b"s" * 50
+    assert os.listdir(tmp_path / ".partial") == []
+
+
+def test_writer_reports_failures(tmp_path):
+    (tmp_path / "blocker").write_bytes(b"")
+    errors = []
+    with writer.WriteBehindWriter(fsync_policy='none') as w:
+        w.write(str(tmp_path / "blocker" / "x.jpg"), [b"data"], on_error=lambda path, e: errors.append(path))
+    assert errors == [str(tmp_path / "blocker" / "x.jpg")]
+
+
+def test_writer_applies_backpressure(tmp_path):
+    release = threading.Event()
+
+    class BlockingChunks:
+        # write() sizes the chunks on the caller's thread; the writer thread then blocks on them
+        def __init__(self):
+            self.iterations = 0
+
+        def __iter__(self):
+            self.iterations += 1
+            if self.iterations > 1:
+                release.wait(5)
+            return iter([b"x" * 10])
+
+    w = writer.WriteBehindWriter(num_threads=1, max_pending_bytes=15, fsync_policy='none')
+    w.write(str(tmp_path / "first"), BlockingChunks())
+    second = threading.Thread(target=w.write, args=(str(tmp_path / "second"), [b"y" * 10]))
+    second.start()
+    second.join(0.2)
+    assert second.is_alive()
+    assert w.pending_bytes() == 10
+    release.set()
+    second.join(5)
+    w.close()
+    assert (tmp_path / "first").read_bytes() == b"x" * 10
+    assert (tmp_path / "second").read_bytes() == b"y" * 10
+
+
+def test_invalid_fsync_policy():
+    with pytest.raises(ValueError):
+        writer.check_fsync_policy('bogus')
+    with pytest.raises(ValueError):
+        writer.WriteBehindWriter(fsync_policy='bogus')
+
+
+def test_remove_stale_spills(tmp_path):
+    old = tmp_path / "download-old.part"
+    new = tmp_path / "download-new.part"
+    other = tmp_path / "keep.txt"
+    for path in (old, new, other):
+        path.write_bytes(b"")
+    os.utime(old, (0, 0))
+    os.utime(other, (0, 0))
+    writer.remove_stale_spills(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == ["download-new.part", "keep.txt"]
+    writer.remove_stale_spills(str(tmp_path / "missing"))
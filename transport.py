@@ -0,0 +1,249 @@
+import os
+import io
+import json
+import time
+import hashlib
+import logging
+import threading
+import datetime
+
+import requests
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+import metrics
+
+# How API and CDN requests reach the network:
+#   live   - straight to the sites (default)
+#   record - to the sites, and every response is also written to a cassette directory
+#   replay - served from a cassette, with the recorded latencies multiplied by latency_scale
+MODES = ['live', 'record', 'replay']
+
+# Cassette layout: index.jsonl (one line per response) and bodies/<key hash>_<n>.bin
+CASSETTE_INDEX = "index.jsonl"
+CASSETTE_BODIES = "bodies"
+
+# Bodies are stored decoded, so these no longer describe them
+_DROPPED_HEADERS = {'content-encoding', 'transfer-encoding', 'content-length'}
+
+_config = {'mode': 'live', 'cassette_dir': None, 'latency_scale': 1.0}
+
+
+def configure(mode='live', cassette_dir=None, latency_scale=1.0):
+    # Applies to the whole process; the shared session is rebuilt with the new adapter
+    from booru_api import reset_session
+    if mode not in MODES:
+        raise ValueError(f"Unsupported transport mode '{mode}'. Use one of: {', '.join(MODES)}")
+    if mode != 'live' and not cassette_dir:
+        raise ValueError(f"Transport mode '{mode}' needs a cassette directory")
+    if latency_scale is None or latency_scale < 0:
+        raise ValueError(f"Invalid latency scale '{latency_scale}'")
+    if mode == 'replay' and not os.path.isfile(os.path.join(cassette_dir, CASSETTE_INDEX)):
+        raise ValueError(f"No cassette found in {cassette_dir}")
+    _config.update(mode=mode, cassette_dir=cassette_dir, latency_scale=latency_scale)
+    reset_session()
+    if mode != 'live':
+        logging.getLogger("transport").info(f"[transport.configure] Transport mode {mode}, cassette {cassette_dir}" + (f", latency x{latency_scale}" if mode == 'replay' else ""))
+
+
+def create_adapter(pool_connections=16, pool_maxsize=64):
+    mode = _config['mode']
+    if mode == 'record':
+        return RecordingAdapter(Cassette(_config['cassette_dir']), pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    if mode == 'replay':
+        return ReplayAdapter(Cassette(_config['cassette_dir']), latency_scale=_config['latency_scale'])
+    return HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+
+
+def get_request_key(request):
+    return f"{request.method} {request.url}"
+
+
+class Cassette:
+    # Recorded responses keyed by method and URL. A URL requested several times keeps every
+    # recording; replay serves them in the same order and repeats the last one.
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._served = {}
+        index_path = os.path.join(path, CASSETTE_INDEX)
+        if os.path.isfile(index_path):
+            with open(index_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if line:
+                        entry = json.loads(line)
+                        self._entries.setdefault(entry['key'], []).append(entry)
+
+    def __len__(self):
+        with self._lock:
+            return sum(len(entries) for entries in self._entries.values())
+
+    def add(self, key, status, reason, headers, body, ttfb, timeline):
+        # timeline: [bytes received, seconds since the headers arrived] after each read
+        with self._lock:
+            entries = self._entries.setdefault(key, [])
+            body_name = f"{hashlib.sha1(key.encode('utf-8')).hexdigest()}_{len(entries)}.bin"
+            entry = {
+                'key': key, 'status': status, 'reason': reason,
+                'headers': {name: value for name, value in headers.items() if name.lower() not in _DROPPED_HEADERS},
+                'body': body_name, 'size': len(body),
+                'ttfb': round(ttfb, 6), 'timeline': [[size, round(seconds, 6)] for size, seconds in timeline],
+                'recorded_at': datetime.datetime.now().isoformat(timespec='seconds')
+            }
+            entry['headers']['Content-Length'] = str(len(body))
+            os.makedirs(os.path.join(self.path, CASSETTE_BODIES), exist_ok=True)
+            with open(os.path.join(self.path, CASSETTE_BODIES, body_name), 'wb') as f:
+                f.write(body)
+            with open(os.path.join(self.path, CASSETTE_INDEX), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+            entries.append(entry)
+        metrics.increment('transport_recorded')
+
+    def next_entry(self, key):
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return None
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+            return entries[min(served, len(entries) - 1)]
+
+    def read_body(self, entry):
+        with open(os.path.join(self.path, CASSETTE_BODIES, entry['body']), 'rb') as f:
+            return f.read()
+
+
+class _RecordingStream:
+    # Stands in for response.raw: passes reads through (decoded) and records the body and its
+    # timing. The response is written to the cassette once it has been read to the end.
+    def __init__(self, raw, on_complete):
+        self._raw = raw
+        self._on_complete = on_complete
+        self._body = io.BytesIO()
+        self._timeline = []
+        self._started = time.monotonic()
+        self._complete = False
+
+    def read(self, amt=None, decode_content=True):
+        data = self._raw.read(amt, decode_content=True)
+        if data:
+            self._body.write(data)
+            self._timeline.append((self._body.tell(), time.monotonic() - self._started))
+        elif not self._complete:
+            self._complete = True
+            self._on_complete(self._body.getvalue(), self._timeline)
+        return data
+
+    def stream(self, amt=None, decode_content=True):
+        # requests reads through stream() when present, which also maps urllib3 errors to its own
+        while True:
+            data = self.read(amt)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        self._raw.close()
+
+    def release_conn(self):
+        self._raw.release_conn()
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, cassette, **kwargs):
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        started = time.monotonic()
+        response = super().send(request, stream=stream, timeout=timeout, verify=verify, cert=cert, proxies=proxies)
+        ttfb = time.monotonic() - started
+        key = get_request_key(request)
+        status, reason, headers = response.status_code, response.reason, dict(response.headers)
+
+        def on_complete(body, timeline):
+            self.cassette.add(key, status, reason, headers, body, ttfb, timeline)
+
+        response.raw = _RecordingStream(response.raw, on_complete)
+        return response
+
+
+class _ReplayStream:
+    # Serves a recorded body, pacing each read to the recorded time at which that many bytes
+    # had arrived (multiplied by latency_scale)
+    def __init__(self, body, timeline, latency_scale):
+        self._body = io.BytesIO(body)
+        self._timeline = timeline
+        self._latency_scale = latency_scale
+        self._started = time.monotonic()
+        self._point = 0
+
+    def _arrival_time(self, offset):
+        timeline = self._timeline
+        while self._point < len(timeline) and timeline[self._point][0] < offset:
+            self._point += 1
+        if self._point >= len(timeline):
+            return timeline[-1][1] if timeline else 0.0
+        # Interpolate inside the recorded read that delivered this offset
+        size, seconds = timeline[self._point]
+        prev_size, prev_seconds = timeline[self._point - 1] if self._point else (0, 0.0)
+        if size == prev_size:
+            return seconds
+        return prev_seconds + (seconds - prev_seconds) * (offset - prev_size) / (size - prev_size)
+
+    def read(self, amt=None, decode_content=True):
+        data = self._body.read(amt)
+        if data and self._latency_scale:
+            delay = self._arrival_time(self._body.tell()) * self._latency_scale - (time.monotonic() - self._started)
+            if delay > 0:
+                time.sleep(delay)
+        return data
+
+    def stream(self, amt=None, decode_content=True):
+        while True:
+            data = self.read(amt)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        pass
+
+    def release_conn(self):
+        pass
+
+
+class ReplayAdapter(BaseAdapter):
+    # Answers every request from the cassette; nothing is sent to the network
+    def __init__(self, cassette, latency_scale=1.0):
+        super().__init__()
+        self.cassette = cassette
+        self.latency_scale = latency_scale
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        key = get_request_key(request)
+        entry = self.cassette.next_entry(key)
+        if entry is None:
+            metrics.increment('transport_replay_misses')
+            raise requests.ConnectionError(f"No recorded response for {key} in cassette {self.cassette.path}", request=request)
+        body = self.cassette.read_body(entry)
+        if self.latency_scale:
+            time.sleep(entry['ttfb'] * self.latency_scale)
+        response = requests.Response()
+        response.status_code = entry['status']
+        response.reason = entry['reason']
+        response.headers = CaseInsensitiveDict(entry['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.elapsed = datetime.timedelta(seconds=entry['ttfb'] * self.latency_scale)
+        response.raw = _ReplayStream(body, entry['timeline'], self.latency_scale)
+        metrics.increment('transport_replayed')
+        return response
+
+    def close(self):
+        pass
@@ -0,0 +1,66 @@
+import threading
+from collections import deque
+
+# Download threads post progress and messages here; the GUI drains everything in one batch per
+# frame on the Tk thread. Posting is O(1), never waits for the GUI, and is a no-op while no GUI
+# is listening (CLI, daemon).
+
+# Messages waiting for the next frame beyond this are dropped (and counted); the totals per kind stay exact
+MAX_PENDING_MESSAGES = 1000
+
+# Kinds shown in the GUI summary, in display order
+KINDS = [('error', "Errors"), ('warning', "Warnings"), ('duplicate', "Duplicates"), ('skipped', "Skipped"), ('present', "Already present")]
+
+
+class UIEventQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.listening = False
+        self._progress = None
+        self._messages = deque(maxlen=MAX_PENDING_MESSAGES)
+        self._dropped = 0
+        self._counts = {}
+
+    def listen(self, listening=True):
+        self.listening = listening
+
+    def reset(self):
+        # Called when a job starts; counts are per job
+        with self._lock:
+            self._progress = None
+            self._messages.clear()
+            self._dropped = 0
+            self._counts = {}
+
+    def post(self, kind, message):
+        if not self.listening:
+            return
+        with self._lock:
+            self._counts[kind] = self._counts.get(kind, 0) + 1
+            if len(self._messages) == MAX_PENDING_MESSAGES:
+                self._dropped += 1
+            self._messages.append((kind, message))
+
+    def post_progress(self, processed, total):
+        # Only the latest value matters, so progress updates between two frames collapse into one
+        if not self.listening:
+            return
+        with self._lock:
+            self._progress = (processed, total)
+
+    def drain(self):
+        # Returns (progress or None, [(kind, message)], dropped message count, {kind: count for the job})
+        with self._lock:
+            progress, self._progress = self._progress, None
+            messages = list(self._messages)
+            self._messages.clear()
+            dropped, self._dropped = self._dropped, 0
+            counts = dict(self._counts)
+        return progress, messages, dropped, counts
+
+
+def format_counts(counts):
+    return " · ".join(f"{label}: {counts[kind]}" for kind, label in KINDS if counts.get(kind))
+
+
+events = UIEventQueue()
@@ -0,0 +1,270 @@
+import os
+import time
+import queue
+import shutil
+import logging
+import tempfile
+import threading
+import uuid
+
+import metrics
+
+# fsync policies:
+#   none  - leave durability to the OS
+#   file  - fsync every file (and its directory) before it is reported written
+#   batch - fsync files and their directories in groups of FSYNC_BATCH_SIZE and on close
+FSYNC_POLICIES = ['none', 'file', 'batch']
+FSYNC_BATCH_SIZE = 32
+
+# A download larger than this is spilled to a temp file instead of being held in memory
+SPILL_THRESHOLD = 16 * 1024 * 1024
+SPILL_READ_SIZE = 1024 * 1024
+# Spill files go to this directory inside the library (skipped by library scans)
+SPILL_DIRNAME = ".partial"
+# Spill files left behind by a crash are removed when a later job starts
+SPILL_MAX_AGE = 24 * 60 * 60
+
+
+def check_fsync_policy(fsync_policy):
+    if fsync_policy not in FSYNC_POLICIES:
+        raise ValueError(f"Unsupported fsync policy '{fsync_policy}'. Use one of: {', '.join(FSYNC_POLICIES)}")
+    return fsync_policy
+
+
+def _fsync_dir(path):
+    # Directory fsync is POSIX only; elsewhere the rename is as durable as it gets
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DownloadBuffer:
+    # Body of one download. Chunks stay in memory up to spill_threshold bytes; past that they
+    # are moved to a temp file in spill_dir (next to the library, so the writer can rename it
+    # into place). Iterating yields the body in chunks either way.
+    def __init__(self, spill_dir=None, spill_threshold=SPILL_THRESHOLD):
+        self.spill_dir = spill_dir
+        self.spill_threshold = spill_threshold
+        self.size = 0
+        self.spilled_path = None
+        self._chunks = []
+        self._file = None
+
+    def append(self, chunk):
+        self.size += len(chunk)
+        if self._file is not None:
+            self._file.write(chunk)
+            return
+        self._chunks.append(chunk)
+        if self.spill_threshold is not None and self.size > self.spill_threshold:
+            self._spill()
+
+    def _spill(self):
+        spill_dir = self.spill_dir or tempfile.gettempdir()
+        os.makedirs(spill_dir, exist_ok=True)
+        # Not mkstemp: its owner-only mode would carry over to the library file after the rename
+        self.spilled_path = os.path.join(spill_dir, f"download-{uuid.uuid4().hex}.part")
+        self._file = open(self.spilled_path, 'xb')
+        self._file.writelines(self._chunks)
+        self._chunks = []
+        metrics.increment('downloads_spilled')
+
+    @property
+    def memory_size(self):
+        # Bytes held in memory, which is what the writer's queue limit is about
+        return 0 if self.spilled_path else self.size
+
+    def finish(self):
+        # Called once the download is complete; a spill file is flushed and closed
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        return self
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        if self.spilled_path is None:
+            yield from self._chunks
+            return
+        self.finish()
+        with open(self.spilled_path, 'rb') as f:
+            while True:
+                chunk = f.read(SPILL_READ_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def discard(self):
+        self.finish()
+        self._chunks = []
+        if self.spilled_path is not None:
+            try:
+                os.remove(self.spilled_path)
+            except OSError:
+                pass
+            self.spilled_path = None
+        self.size = 0
+
+
+def remove_stale_spills(spill_dir, max_age=SPILL_MAX_AGE):
+    if not os.path.isdir(spill_dir):
+        return
+    cutoff = time.time() - max_age
+    for name in os.listdir(spill_dir):
+        path = os.path.join(spill_dir, name)
+        try:
+            if name.endswith(".part") and os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+class WriteBehindWriter:
+    # Bounded disk stage: network workers hand off in-memory buffers and a small pool of
+    # writer threads creates directories, writes and renames files. write() blocks while
+    # more than max_pending_bytes are queued so a slow disk pushes back on the downloaders.
+    # A spilled DownloadBuffer is already on disk; it is renamed into place and not counted.
+    def __init__(self, num_threads=2, max_pending_bytes=256 * 1024 * 1024, fsync_policy='batch'):
+        self.fsync_policy = check_fsync_policy(fsync_policy)
+        self.max_pending_bytes = max_pending_bytes
+        self._queue = queue.Queue()
+        self._pending_bytes = 0
+        self._pending_cond = threading.Condition()
+        self._known_dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._unsynced = []
+        self._sync_lock = threading.Lock()
+        self._closed = False
+        self._threads = []
+        for i in range(max(1, num_threads)):
+            t = threading.Thread(target=self._run, name=f"rulescrape-writer-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def write(self, path, chunks, on_error=None, on_done=None):
+        if self._closed:
+            raise RuntimeError("Write-behind writer is closed")
+        size = chunks.memory_size if isinstance(chunks, DownloadBuffer) else sum(len(chunk) for chunk in chunks)
+        with self._pending_cond:
+            if self._pending_bytes > 0 and self._pending_bytes + size > self.max_pending_bytes:
+                metrics.increment('writer_backpressure_waits')
+                while self._pending_bytes > 0 and self._pending_bytes + size > self.max_pending_bytes:
+                    self._pending_cond.wait()
+            self._pending_bytes += size
+        self._queue.put((path, chunks, size, on_error, on_done))
+
+    def pending_bytes(self):
+        with self._pending_cond:
+            return self._pending_bytes
+
+    def _ensure_dir(self, directory):
+        with self._dirs_lock:
+            if directory in self._known_dirs:
+                return
+        os.makedirs(directory, exist_ok=True)
+        with self._dirs_lock:
+            self._known_dirs.add(directory)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            path, chunks, size, on_error, on_done = item
+            callback, args = on_done, (path,)
+            try:
+                self._write_file(path, chunks)
+                metrics.increment('writer_files_written')
+                metrics.increment('writer_bytes_written', len(chunks) if isinstance(chunks, DownloadBuffer) else size)
+            except Exception as e:
+                if isinstance(chunks, DownloadBuffer):
+                    chunks.discard()
+                logging.getLogger("writer").error(f"[writer.WriteBehindWriter] Failed to write {path}: {e}")
+                metrics.increment('writer_failures')
+                callback, args = on_error, (path, e)
+            finally:
+                with self._pending_cond:
+                    self._pending_bytes -= size
+                    self._pending_cond.notify_all()
+            if callback is not None:
+                try:
+                    callback(*args)
+                except Exception as e:
+                    logging.getLogger("writer").warning(f"[writer.WriteBehindWriter] Callback for {path} failed: {e}")
+
+    def _write_file(self, path, chunks):
+        directory = os.path.dirname(path) or '.'
+        self._ensure_dir(directory)
+        temp_path = path + ".tmp"
+        try:
+            if isinstance(chunks, DownloadBuffer) and chunks.spilled_path:
+                # shutil.move is a rename when the spill file is on the same filesystem
+                shutil.move(chunks.finish().spilled_path, temp_path)
+                chunks.spilled_path = None
+                if self.fsync_policy == 'file':
+                    with open(temp_path, 'rb') as f:
+                        os.fsync(f.fileno())
+            else:
+                with open(temp_path, 'wb') as f:
+                    f.writelines(chunks)
+                    if self.fsync_policy == 'file':
+                        f.flush()
+                        os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        if self.fsync_policy == 'file':
+            _fsync_dir(directory)
+        elif self.fsync_policy == 'batch':
+            with self._sync_lock:
+                self._unsynced.append(path)
+                batch_ready = len(self._unsynced) >= FSYNC_BATCH_SIZE
+            if batch_ready:
+                self.sync()
+
+    def sync(self):
+        with self._sync_lock:
+            paths, self._unsynced = self._unsynced, []
+        if not paths:
+            return
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+            except OSError as e:
+                logging.getLogger("writer").warning(f"[writer.WriteBehindWriter.sync] Could not fsync {path}: {e}")
+        for directory in {os.path.dirname(path) or '.' for path in paths}:
+            _fsync_dir(directory)
+        metrics.increment('writer_fsync_batches')
+
+    def close(self):
+        # Waits for every queued write, then makes the last batch durable
+        if self._closed:
+            return
+        self._closed = True
+        for _ in self._threads:
+            self._queue.put(None)
+        for t in self._threads:
+            t.join()
+        if self.fsync_policy == 'batch':
+            self.sync()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()